@@ -0,0 +1,50 @@
+import gc
+import json
+import time
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def measure(function, iterations, warmup=1):
+    """
+    Call function() `iterations` times (after `warmup` untimed calls) and
+    summarize its latency in milliseconds.
+    """
+    for _ in range(warmup):
+        function()
+    gc.collect()
+    timings = []
+    for _ in range(iterations):
+        start = time.time()
+        function()
+        timings.append((time.time() - start) * 1000)
+    return summarize(timings)
+
+
+def summarize(timings, operations=None):
+    """
+    Latency stats of a list of timings (ms). `operations` is the number of
+    operations of all the timings (one per timing by default).
+    """
+    total = sum(timings)
+    operations = operations or len(timings)
+    return {
+        'iterations': len(timings),
+        'mean_ms': total / len(timings),
+        'p50_ms': percentile(timings, 0.5),
+        'p95_ms': percentile(timings, 0.95),
+        'min_ms': min(timings),
+        'max_ms': max(timings),
+        'ops_per_sec': operations / (total / 1000) if total else None
+    }
+
+
+def report(results):
+    """
+    Print the results of a suite as JSON, for run.py.
+    """
+    print json.dumps(results, sort_keys=True)
@@ -0,0 +1,373 @@
+"""
+In-process fakes of Redis, Docker, SSH and the HTTP sessions to the nodes,
+so the benchmarks measure dookio itself. Every fake can add a latency per
+round trip to simulate the network.
+"""
+import io
+import json
+import time
+import hashlib
+import tarfile
+import fnmatch
+import threading
+
+from docker.errors import APIError
+
+
+class FakeRedis(object):
+    """
+    The subset of StrictRedis used by dookio, kept in memory. Lua scripts
+    are run by the python functions registered for their source.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = 0
+        self._data = {}
+        self._lock = threading.RLock()
+        self._scripts = {}
+        self._loaded = {}
+
+    def round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def register_script(self, source, function):
+        self._scripts[source] = function
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def script_load(self, source):
+        self.round_trip()
+        sha = hashlib.sha1(source).hexdigest()
+        self._loaded[sha] = self._scripts[source]
+        return sha
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        self.round_trip()
+        with self._lock:
+            return self._loaded[sha](self, list(keys_and_args[:numkeys]),
+                                     list(keys_and_args[numkeys:]))
+
+    def __getattr__(self, name):
+        command = getattr(self, '_' + name, None)
+        if command is None:
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.round_trip()
+            with self._lock:
+                return command(*args, **kwargs)
+        return call
+
+    # Commands (called with the lock held).
+    def _get(self, key):
+        return self._data.get(key)
+
+    def _set(self, key, value):
+        self._data[key] = str(value)
+
+    def _setex(self, key, ttl, value):
+        self._data[key] = str(value)
+
+    def _mget(self, keys):
+        return [self._data.get(key) for key in keys]
+
+    def _delete(self, *keys):
+        return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    def _exists(self, key):
+        return key in self._data
+
+    def _expire(self, key, ttl):
+        return key in self._data
+
+    def _publish(self, channel, message):
+        return 0
+
+    def _scan_iter(self, match=None):
+        return [key for key in list(self._data)
+                if match is None or fnmatch.fnmatch(key, match)]
+
+    def _rpush(self, key, *values):
+        items = self._data.setdefault(key, [])
+        items.extend(str(value) for value in values)
+        return len(items)
+
+    def _lrange(self, key, start, end):
+        items = self._data.get(key, [])
+        end = len(items) if end == -1 else end + 1
+        return items[start:end]
+
+    def _llen(self, key):
+        return len(self._data.get(key, []))
+
+    def _lrem(self, key, count, value):
+        items = self._data.get(key, [])
+        kept = [item for item in items if item != value]
+        self._data[key] = kept
+        return len(items) - len(kept)
+
+    def _hset(self, key, field, value):
+        self._data.setdefault(key, {})[field] = str(value)
+
+    def _hmset(self, key, mapping):
+        self._data.setdefault(key, {}).update(
+            (field, str(value)) for field, value in mapping.iteritems())
+
+    def _hget(self, key, field):
+        return self._data.get(key, {}).get(field)
+
+    def _hmget(self, key, fields):
+        values = self._data.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def _hgetall(self, key):
+        return dict(self._data.get(key, {}))
+
+    def _hdel(self, key, *fields):
+        values = self._data.get(key, {})
+        return sum(1 for field in fields if values.pop(field, None))
+
+    def _sadd(self, key, *members):
+        self._data.setdefault(key, set()).update(members)
+
+    def _srem(self, key, *members):
+        self._data.setdefault(key, set()).difference_update(members)
+
+    def _smembers(self, key):
+        return set(self._data.get(key, set()))
+
+    def _zadd(self, key, score, member):
+        self._data.setdefault(key, {})[member] = float(score)
+
+    def _zrem(self, key, member):
+        return self._data.get(key, {}).pop(member, None) is not None
+
+    def _sorted(self, key):
+        members = self._data.get(key, {})
+        return sorted(members, key=lambda member: (members[member], member))
+
+    def _zrange(self, key, start, end):
+        members = self._sorted(key)
+        end = len(members) if end == -1 else end + 1
+        return members[start:end]
+
+    def _zcard(self, key):
+        return len(self._data.get(key, {}))
+
+    def _zrangebyscore(self, key, low, high):
+        low, high = float(low), float(high)
+        members = self._data.get(key, {})
+        return [member for member in self._sorted(key)
+                if low <= members[member] <= high]
+
+    def _zremrangebyscore(self, key, low, high):
+        members = self._zrangebyscore(key, low, high)
+        for member in members:
+            del self._data[key][member]
+        return len(members)
+
+
+class FakePipeline(object):
+    """
+    Buffers the commands and runs them in a single round trip.
+    """
+    def __init__(self, redis_cli):
+        self._redis = redis_cli
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._redis, '_' + name)
+
+        def buffer(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return buffer
+
+    def execute(self):
+        self._redis.round_trip()
+        with self._redis._lock:
+            results = [command(*args, **kwargs)
+                       for command, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+class FakeResponse(object):
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    A requests session to a simulated node, answering `content` after
+    `latency` seconds.
+    """
+    def __init__(self, content, latency=0):
+        self.content = content
+        self.latency = latency
+
+    def get(self, url, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeResponse(self.content)
+
+
+class FakeDocker(object):
+    """
+    The subset of the docker client used by the node. Every call takes
+    `latency` seconds; builds read the whole context and answer
+    `build_steps` lines.
+    """
+    def __init__(self, latency=0, build_steps=10):
+        self.latency = latency
+        self.build_steps = build_steps
+        self._lock = threading.Lock()
+        self._containers = {}
+        # container id -> its Config (the resource limits)
+        self._configs = {}
+        self._images = set()
+        self._next_id = 0
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_containers(self, user, repo, ports):
+        for port in ports:
+            self.create_container('{}_{}_{}'.format(user, repo, port),
+                                  '{}/{}'.format(user, repo))
+            self._containers[self._last_id]['Ports'] = [
+                {'PrivatePort': 80, 'PublicPort': port}]
+
+    def ping(self):
+        return 'OK'
+
+    def close(self):
+        pass
+
+    def containers(self, **kwargs):
+        self._call()
+        with self._lock:
+            return [dict(container)
+                    for container in self._containers.itervalues()]
+
+    def create_container(self, name, image, **kwargs):
+        self._call()
+        with self._lock:
+            self._next_id += 1
+            self._last_id = '{:064x}'.format(self._next_id)
+            self._containers[self._last_id] = {
+                'Id': self._last_id, 'Names': ['/' + name],
+                'Image': image, 'Ports': []}
+            self._configs[self._last_id] = {
+                'Memory': kwargs.get('mem_limit') or 0,
+                'CpuShares': kwargs.get('cpu_shares') or 0}
+            return {'Id': self._last_id}
+
+    def inspect_container(self, container):
+        self._call()
+        with self._lock:
+            return {'Id': container, 'Config': dict(self._configs[container])}
+
+    def start(self, container, port_bindings=None):
+        self._call()
+        with self._lock:
+            self._containers[container]['Ports'] = [
+                {'PrivatePort': private, 'PublicPort': public}
+                for private, public in (port_bindings or {}).iteritems()]
+
+    def kill(self, container):
+        self._call()
+
+    def remove_container(self, container, **kwargs):
+        self._call()
+        with self._lock:
+            self._containers.pop(container.get('Id', container), None)
+            self._configs.pop(container.get('Id', container), None)
+
+    def build(self, fileobj=None, tag=None, **kwargs):
+        self._call()
+        if fileobj is not None:
+            for chunk in fileobj:
+                pass
+            close = getattr(fileobj, 'close', None)
+            if close:
+                close()
+        self._images.add('{}:latest'.format(tag))
+        return ('{{"stream": "Step {} : RUN true\\n"}}'.format(step)
+                for step in range(self.build_steps))
+
+    def tag(self, image, repository, tag=None, force=False):
+        self._call()
+        self._images.add('{}:{}'.format(repository, tag))
+
+    def inspect_image(self, image):
+        self._call()
+        if image not in self._images:
+            raise APIError('No such image: {}'.format(image), None,
+                           explanation='No such image')
+        return {'Id': image}
+
+    def images(self):
+        return [{'Id': image, 'RepoTags': [image]} for image in self._images]
+
+
+class FakeChannel(object):
+    def recv_exit_status(self):
+        return 0
+
+
+class FakeSSH(object):
+    """
+    An ssh session to the server: `tar -cz` of the requested paths with the
+    contents in `files`, after `latency` seconds.
+    """
+    def __init__(self, files, latency=0):
+        self.files = files
+        self.latency = latency
+
+    def exec_command(self, command):
+        ssh = self
+
+        class Stdin(object):
+            channel = type('Channel', (object,), {
+                'shutdown_write': lambda self: None})()
+
+            def write(self, paths):
+                ssh._paths = paths.split('\0')
+
+        class Stdout(object):
+            channel = FakeChannel()
+
+            def __init__(self):
+                self._stream = None
+
+            def read(self, size=-1):
+                if self._stream is None:
+                    self._stream = ssh._tar()
+                return self._stream.read(size)
+
+        return Stdin(), Stdout(), None
+
+    def _tar(self):
+        if self.latency:
+            time.sleep(self.latency)
+        stream = io.BytesIO()
+        with tarfile.open(fileobj=stream, mode='w:gz') as tar:
+            for path in self._paths:
+                content = self.files[path]
+                info = tarfile.TarInfo(path)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        stream.seek(0)
+        return stream
@@ -0,0 +1,133 @@
+"""
+Benchmarks of the node: port allocation under churn, /containers and
+deploys (code fetch, build and container start), driven through
+werkzeug's test client with fake Docker and SSH.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'node'))
+
+WORKDIR = tempfile.mkdtemp(prefix='dookio-bench-')
+# The node reads its configuration when imported.
+for name, value in [('DOOKIO_SERVER_ADDRESS', 'localhost'),
+                    ('DOOKIO_SERVER_USER', 'bench'),
+                    ('DOOKIO_SERVER_USER_PASSWORD', 'bench'),
+                    ('DOOKIO_SERVER_ROOT', '/home'),
+                    ('DOOKIO_NODE_ROOT', WORKDIR)]:
+    os.environ.setdefault(name, value)
+
+from mock import patch
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from common import measure, summarize, report
+from fakes import FakeDocker, FakeRedis, FakeSSH
+
+from src import node
+from src.ports import PortAllocator
+from src.pools import ConnectionPool
+from src.utils import get_port, make_port_available
+
+
+def bench_ports(args):
+    allocator = PortAllocator(4567, 32768,
+                              os.path.join(WORKDIR, 'PORTS_JOURNAL'))
+    used = []
+    timings = []
+    with patch('src.utils.port_allocator', allocator):
+        for _ in range(args.churn):
+            start = time.time()
+            # Keep around half of the range in use.
+            if used and (len(used) > 12000 or random.random() < 0.5):
+                make_port_available(used.pop(random.randrange(len(used))))
+            else:
+                used.append(get_port())
+            timings.append((time.time() - start) * 1000)
+    return {'node.port_churn': summarize(timings)}
+
+
+def code_files(version):
+    files = {'Dockerfile': 'FROM ubuntu\nADD . /app\n'}
+    for i in range(50):
+        files['app/module{}.py'.format(i)] = 'VERSION = {}\n'.format(
+            version if i == 0 else 0) + 'x = 1\n' * 200
+    return files
+
+
+def manifest_of(files):
+    return dict((path, {'sha1': hashlib.sha1(content).hexdigest(),
+                        'mode': 0644})
+                for path, content in files.iteritems())
+
+
+def bench_node(args):
+    docker = FakeDocker(args.docker_latency)
+    docker.add_containers('git', 'apache', range(4567, 4567 + args.containers))
+    docker.add_containers('git', 'other', range(20000, 20000 + 10))
+    code = {'files': code_files(0)}
+    ssh = FakeSSH(code['files'], args.ssh_latency)
+    docker_clients = ConnectionPool(lambda: docker, lambda cli: True,
+                                    lambda cli: None, 10)
+    ssh_clients = ConnectionPool(lambda: ssh, lambda cli: True,
+                                 lambda cli: None, 4)
+    allocator = PortAllocator(30000, 32768,
+                              os.path.join(WORKDIR, 'NODE_PORTS_JOURNAL'))
+    client = Client(node.application, BaseResponse)
+
+    def deploy(version=None):
+        if version is not None:
+            code['files'] = ssh.files = code_files(version)
+        response = client.get('/?user=git&repo=apache')
+        assert response.status_code == 200, response.data
+
+    versions = iter(xrange(1, 10 ** 6))
+    with patch('src.node.docker_clients', docker_clients), \
+            patch('src.node.status_clients', docker_clients), \
+            patch('src.node.ssh_clients', ssh_clients), \
+            patch('src.node.OBJECTS_DIRECTORY',
+                  os.path.join(WORKDIR, '.objects')), \
+            patch('src.node.fetch_manifest',
+                  lambda url, conf: manifest_of(code['files'])), \
+            patch('src.node.redis_cli', FakeRedis()), \
+            patch('src.utils.port_allocator', allocator):
+        return {
+            'node.containers_get': measure(
+                lambda: client.get(
+                    '/containers?action=get&user=git&repo=apache').data,
+                args.iterations),
+            'node.deploy_cached_image': measure(
+                deploy, args.iterations),
+            'node.deploy_new_code': measure(
+                lambda: deploy(next(versions)), args.iterations)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--churn', type=int, default=50000)
+    parser.add_argument('--containers', type=int, default=200)
+    parser.add_argument('--docker-latency', type=float, default=0.001)
+    parser.add_argument('--ssh-latency', type=float, default=0.005)
+    args = parser.parse_args()
+
+    random.seed(0)
+    try:
+        results = {}
+        results.update(bench_ports(args))
+        results.update(bench_node(args))
+        report(results)
+    finally:
+        shutil.rmtree(WORKDIR)
+
+
+if __name__ == '__main__':
+    main()
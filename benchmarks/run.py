@@ -0,0 +1,82 @@
+"""
+Run the benchmarks of the server and the node and write their results as
+JSON. With --compare, fail if any benchmark got slower than the baseline.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+SUITES = ['server_bench.py', 'node_bench.py']
+
+
+def run_suite(suite, iterations):
+    """
+    Every suite runs in its own process: the server and the node are both
+    imported as `src`.
+    """
+    output = subprocess.check_output(
+        [sys.executable, os.path.join(BENCHMARKS, suite),
+         '--iterations', str(iterations)])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold):
+    """
+    The benchmarks whose p50 is more than `threshold` (a fraction) slower
+    than in the baseline, as (name, baseline p50, p50).
+    """
+    regressions = []
+    for name, stats in sorted(results.iteritems()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if stats['p50_ms'] > before['p50_ms'] * (1 + threshold):
+            regressions.append((name, before['p50_ms'], stats['p50_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--output', help='Write the results to this file.')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='A previous --output file.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown of the p50 (default: 20%%).')
+    args = parser.parse_args()
+
+    results = {}
+    for suite in SUITES:
+        results.update(run_suite(suite, args.iterations))
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    for name, stats in sorted(results.iteritems()):
+        print '{:<30} p50 {:>10.3f} ms  p95 {:>10.3f} ms'.format(
+            name, stats['p50_ms'], stats['p95_ms'])
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)['results'],
+                                  args.threshold)
+        for name, before, after in regressions:
+            print 'REGRESSION {}: p50 {:.3f} ms -> {:.3f} ms'.format(
+                name, before, after)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
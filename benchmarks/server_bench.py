@@ -0,0 +1,171 @@
+"""
+Benchmarks of the server: /apps, the /containers fan-out and deploys,
+driven through werkzeug's test client with fake Redis and nodes.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+from mock import patch
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from common import measure, report
+from fakes import FakeRedis, FakeSession, FakeResponse
+
+from src import routing
+from src.server import application
+from src.scheduler import ClusterState
+
+
+# python equivalents of the routing scripts, for the fake redis.
+def add_backends(redis_cli, keys, args):
+    redis_cli._hset(keys[4], keys[0], args[0])
+    if not redis_cli._llen(keys[0]):
+        redis_cli._rpush(keys[0], args[1])
+    for backend in args[2:]:
+        redis_cli._lrem(keys[0], 0, backend)
+        redis_cli._rpush(keys[0], backend)
+        redis_cli._hdel(keys[3], backend)
+    return update_index(redis_cli, keys)
+
+
+def remove_backends(redis_cli, keys, args):
+    for backend in args:
+        redis_cli._lrem(keys[0], 0, backend)
+        redis_cli._hdel(keys[3], backend)
+    return update_index(redis_cli, keys)
+
+
+def swap_backends(redis_cli, keys, args):
+    redis_cli._hset(keys[4], keys[0], args[0])
+    redis_cli._delete(keys[0], keys[3])
+    redis_cli._rpush(keys[0], *args[1:])
+    return update_index(redis_cli, keys)
+
+
+def update_index(redis_cli, keys):
+    replicas = max(redis_cli._llen(keys[0]) - 1, 0)
+    redis_cli._zadd(keys[1], 0, keys[0])
+    redis_cli._hset(keys[2], keys[0], replicas)
+    return replicas
+
+
+def remove_app(redis_cli, keys, args):
+    redis_cli._zrem(keys[1], keys[0])
+    redis_cli._hdel(keys[2], keys[0])
+    redis_cli._hdel(keys[4], keys[0])
+    redis_cli._delete(keys[3])
+    return redis_cli._delete(keys[0])
+
+
+def list_apps(redis_cli, keys, args):
+    apps = redis_cli._zrange(keys[0], int(args[0]), int(args[1]))
+    result = [redis_cli._zcard(keys[0])]
+    for app, replicas in zip(apps, redis_cli._hmget(keys[1], apps)):
+        result.extend([app, replicas or 0])
+    return result
+
+
+def fake_redis(latency):
+    redis_cli = FakeRedis(latency)
+    for script, function in [(routing.ADD_BACKENDS, add_backends),
+                             (routing.REMOVE_BACKENDS, remove_backends),
+                             (routing.SWAP_BACKENDS, swap_backends),
+                             (routing.REMOVE_APP, remove_app),
+                             (routing.LIST_APPS, list_apps)]:
+        redis_cli.register_script(script.script, function)
+        # The shas are cached per process, load them in this redis.
+        script.sha = None
+    return redis_cli
+
+
+def nodes_of(count):
+    return ['http://10.0.{}.{}'.format(i // 256, i % 256)
+            for i in range(count)]
+
+
+def bench_apps(args, client, redis_cli):
+    for i in range(args.apps):
+        conf = {'repo': 'app{}'.format(i),
+                'application_address': 'app{}.git.localhost'.format(i)}
+        routing.add_backends(redis_cli, conf, [('http://10.0.0.1', 4567),
+                                               ('http://10.0.0.2', 4567)])
+    return {
+        'server.apps_all': measure(
+            lambda: client.get('/apps').data, args.iterations),
+        'server.apps_page_json': measure(
+            lambda: client.get('/apps?page=10&format=json').data,
+            args.iterations)
+    }
+
+
+def bench_fanout(args, client, redis_cli):
+    containers = json.dumps([{'Id': 'abc', 'Names': ['/git_apache_4567'],
+                              'Ports': [{'PublicPort': 4567}]}])
+    sessions = dict((node, FakeSession(containers, args.node_latency))
+                    for node in nodes_of(args.nodes))
+    with patch('src.utils.get_nodes', lambda: sorted(sessions)), \
+            patch('src.utils.get_session', sessions.get):
+        return {
+            'server.containers_fanout': measure(
+                lambda: client.get(
+                    '/containers?action=get&user=git&repo=apache').data,
+                args.iterations)
+        }
+
+
+def bench_deploy(args, client, redis_cli):
+    cluster_state = ClusterState('spread')
+    for node in nodes_of(args.nodes):
+        cluster_state.update(node, {'cpus': 4, 'load': 0.5,
+                                    'memory_total': 8000,
+                                    'memory_free': 4000,
+                                    'free_ports': 10 ** 6})
+    sessions = dict((node, FakeSession('[]', args.node_latency))
+                    for node in nodes_of(args.nodes))
+    ports = iter(xrange(4567, 10 ** 6))
+
+    def deploy_container(node, conf):
+        if args.node_latency:
+            time.sleep(args.node_latency)
+        return FakeResponse(json.dumps({'id': 'abc', 'port': next(ports)}))
+
+    with patch('src.utils.cluster_state', cluster_state), \
+            patch('src.utils.get_session', sessions.get), \
+            patch('src.utils.deploy_container', deploy_container):
+        return {
+            'server.deploy_replicas': measure(
+                lambda: client.get(
+                    '/?user=git&repo=apache&mode=recreate'
+                    '&multiplicator={}'.format(args.replicas)).data,
+                args.iterations)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--apps', type=int, default=10000)
+    parser.add_argument('--nodes', type=int, default=20)
+    parser.add_argument('--replicas', type=int, default=50)
+    parser.add_argument('--node-latency', type=float, default=0.01)
+    parser.add_argument('--redis-latency', type=float, default=0.0002)
+    args = parser.parse_args()
+
+    redis_cli = fake_redis(args.redis_latency)
+    client = Client(application, BaseResponse)
+    results = {}
+    with patch('src.server.redis.StrictRedis', lambda **kwargs: redis_cli):
+        for bench in (bench_apps, bench_fanout, bench_deploy):
+            results.update(bench(args, client, redis_cli))
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
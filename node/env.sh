@@ -7,3 +7,42 @@ export DOOKIO_SERVER_USER_PASSWORD="<linux_password>"
 export DOOKIO_SERVER_ROOT="/home"
 # The root of the node machine, that will be used for storing app's data  e.g /root
 export DOOKIO_NODE_ROOT="/tmp"
+# The range of ports published by the containers e.g 4567-32767
+export DOOKIO_PORT_RANGE_START="4567"
+export DOOKIO_PORT_RANGE_END="32768"
+# Seconds the container index can be served without asking docker.
+export DOOKIO_CONTAINER_INDEX_TTL="5"
+# Long-lived docker clients and ssh sessions kept open by the node.
+export DOOKIO_DOCKER_POOL_SIZE="10"
+export DOOKIO_SSH_POOL_SIZE="4"
+# Docker clients kept apart for the lookups (/capacity, /containers), and
+# seconds a request waits for a pooled client before answering 503.
+export DOOKIO_STATUS_POOL_SIZE="2"
+export DOOKIO_POOL_TIMEOUT="30"
+# Bytes the cache of the pushed files (DOOKIO_NODE_ROOT/.objects) can take
+# before the least recently used ones are evicted.
+export DOOKIO_OBJECTS_MAX_SIZE="2147483648"
+# The dookio server app e.g http://123.123.123.123:8000
+export DOOKIO_SERVER_URL="http://localhost:8000"
+# Registry used for sharing the images between nodes e.g 123.123.123.1:5001
+# export DOOKIO_REGISTRY=""
+# How the server reaches this node e.g http://123.123.123.2
+export DOOKIO_NODE_ADDRESS="http://0.0.0.0"
+# The redis used by the server (for the node registry)
+export DOOKIO_REDIS_URL="redis://localhost:6379/0"
+# Threads answering requests, and how many of them can be deploying.
+export DOOKIO_WORKERS="16"
+export DOOKIO_MAX_DEPLOYS="8"
+# Seconds given to the in-flight requests to finish on shutdown.
+export DOOKIO_SHUTDOWN_TIMEOUT="30"
+# Seconds a container has to publish its port before the port is considered
+# leaked (the container died) and given back.
+export DOOKIO_PORT_GRACE="120"
+# Seconds between two refills of the warm containers of the apps (see the
+# /warm endpoint of the server), and whether they are kept paused.
+export DOOKIO_WARM_POOL_INTERVAL="10"
+export DOOKIO_WARM_POOL_PAUSE="false"
+# Memory (bytes) and CPU shares (1024 per CPU) the limits of the containers
+# of this node can add up to. Unset: all of the memory and CPUs.
+# export DOOKIO_NODE_MEMORY="8589934592"
+# export DOOKIO_NODE_CPU_SHARES="4096"
@@ -1,6 +1,16 @@
-from src.node import application
+import logging
+
+from src.node import (application, reconcile, start_index_watcher,
+                      start_heartbeat, start_warm_pool)
+from shared.serving import serve
 
 
 if __name__ == '__main__':
-    from werkzeug.serving import run_simple
-    run_simple('0.0.0.0', 5000, application)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    reconcile()
+    start_index_watcher()
+    start_heartbeat()
+    start_warm_pool()
+    serve(application, '0.0.0.0', 5000)
@@ -0,0 +1,130 @@
+import os
+import time
+import hashlib
+import tarfile
+import tempfile
+
+# Build contexts bigger than this are spooled to disk.
+CONTEXT_MEMORY = 32 * 1024 * 1024
+# Blobs used less than this many seconds ago are never evicted (a build may
+# be about to read them).
+EVICTION_GRACE = 10 * 60
+
+
+def object_path(objects_path, digest):
+    """
+    Where a blob is stored in the content-addressed cache.
+    """
+    return os.path.join(objects_path, digest[:2], digest)
+
+
+def missing_paths(objects_path, manifest):
+    """
+    One path per blob of the manifest that is not cached yet. The cached
+    ones are marked as used, so they are the last ones evicted.
+    """
+    seen = set()
+    paths = []
+    for path, entry in sorted(manifest.iteritems()):
+        digest = entry.get('sha1')
+        if not digest or digest in seen:
+            continue
+        seen.add(digest)
+        try:
+            os.utime(object_path(objects_path, digest), None)
+        except OSError:
+            paths.append(path)
+    return paths
+
+
+def store_object(objects_path, fileobj):
+    """
+    Store the content of a file-like object in the cache and return its
+    digest.
+    """
+    if not os.path.exists(objects_path):
+        os.makedirs(objects_path)
+    digest = hashlib.sha1()
+    fd, aux_path = tempfile.mkstemp(dir=objects_path)
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in iter(lambda: fileobj.read(64 * 1024), ''):
+            digest.update(chunk)
+            f.write(chunk)
+    digest = digest.hexdigest()
+    path = object_path(objects_path, digest)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    os.rename(aux_path, path)
+    return digest
+
+
+def store_objects(objects_path, stream):
+    """
+    Store every regular file of a streamed tar.gz in the cache.
+    """
+    digests = []
+    with tarfile.open(fileobj=stream, mode='r|gz') as tar:
+        for member in tar:
+            if member.isfile():
+                digests.append(
+                    store_object(objects_path, tar.extractfile(member)))
+    return digests
+
+
+def build_context(objects_path, manifest):
+    """
+    Put together the tar build context of a manifest from the cache.
+    """
+    context = tempfile.SpooledTemporaryFile(max_size=CONTEXT_MEMORY)
+    with tarfile.open(fileobj=context, mode='w') as tar:
+        for path in sorted(manifest):
+            entry = manifest[path]
+            info = tarfile.TarInfo(path)
+            if 'dir' in entry:
+                info.type = tarfile.DIRTYPE
+                info.mode = entry['mode']
+                tar.addfile(info)
+                continue
+            if 'link' in entry:
+                info.type = tarfile.SYMTYPE
+                info.linkname = entry['link']
+                tar.addfile(info)
+                continue
+            blob = object_path(objects_path, entry['sha1'])
+            info.size = os.path.getsize(blob)
+            info.mode = entry['mode']
+            with open(blob, 'rb') as f:
+                tar.addfile(info, f)
+    context.seek(0)
+    return context
+
+
+def evict_objects(objects_path, max_size):
+    """
+    Remove the least recently used blobs until the cache fits in
+    `max_size` bytes (the ones used in the last EVICTION_GRACE seconds are
+    kept anyway). Returns how many were removed.
+    """
+    blobs = []
+    for prefix in os.listdir(objects_path):
+        directory = os.path.join(objects_path, prefix)
+        if not os.path.isdir(directory):
+            # Blobs being stored.
+            continue
+        for name in os.listdir(directory):
+            st = os.stat(os.path.join(directory, name))
+            blobs.append((st.st_mtime, st.st_size,
+                          os.path.join(directory, name)))
+    size = sum(blob[1] for blob in blobs)
+    removed = 0
+    now = time.time()
+    for mtime, blob_size, path in sorted(blobs):
+        if size <= max_size or now - mtime < EVICTION_GRACE:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        size -= blob_size
+        removed += 1
+    return removed
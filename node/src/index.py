@@ -0,0 +1,94 @@
+import threading
+import time
+
+
+def app_name(container):
+    """
+    The user_repo application a container belongs to.
+    (The containers name: e.g /git_apache_4567 (With /)).
+    """
+    name = container.get('Names')[0]
+    return name[1:].rsplit('_', 1)[0]
+
+
+class ContainerIndex(object):
+    """
+    The containers of the node grouped by user_repo application.
+
+    The index is rebuilt from `cli.containers()` at most once every `ttl`
+    seconds, and right away after a local change or a docker event
+    invalidates it, so lookups don't hit the docker daemon. The containers
+    whose id is in `hidden()` (e.g. the warm ones) are left out.
+    """
+    def __init__(self, ttl, hidden=set):
+        self.ttl = ttl
+        self.hidden = hidden
+        self._lock = threading.Lock()
+        self._apps = {}
+        self._expires = 0
+        # Bumped by every invalidation, so a refresh that started before
+        # one doesn't publish its (older) containers.
+        self._generation = 0
+
+    def _refresh(self, cli, generation):
+        apps = {}
+        hidden = self.hidden()
+        for cont in cli.containers():
+            if cont.get('Id') not in hidden:
+                apps.setdefault(app_name(cont), []).append(cont)
+        with self._lock:
+            if generation == self._generation:
+                self._apps = apps
+                self._expires = time.time() + self.ttl
+        return apps
+
+    def _lookup(self, cli):
+        with self._lock:
+            if time.time() < self._expires:
+                return self._apps
+            generation = self._generation
+        # docker is asked outside the lock, so invalidations don't wait.
+        return self._refresh(cli, generation)
+
+    def get(self, cli, user, repo):
+        """
+        Get the running containers of the user/repo application.
+        """
+        apps = self._lookup(cli)
+        return list(apps.get('{}_{}'.format(user, repo), []))
+
+    def all(self, cli):
+        """
+        Get the running containers of every application.
+        """
+        return dict((app, list(containers))
+                    for app, containers in self._lookup(cli).iteritems())
+
+    def invalidate(self):
+        """
+        Force a refresh on the next lookup.
+        """
+        with self._lock:
+            self._generation += 1
+            self._expires = 0
+
+    def watch(self, cli):
+        """
+        Invalidate the index on every docker event (a container dying,
+        being started by hand...) from a background thread.
+        """
+        def follow_events():
+            while True:
+                try:
+                    for event in cli.events():
+                        self.invalidate()
+                except Exception:
+                    pass
+                # The events stream was closed, reconnect.
+                self.invalidate()
+                time.sleep(1)
+
+        thread = threading.Thread(target=follow_events)
+        thread.daemon = True
+        thread.start()
+        return thread
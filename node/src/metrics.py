@@ -0,0 +1,35 @@
+import os
+import time
+
+from contextlib import contextmanager
+
+from shared.metrics import Histogram
+
+# The node label of the metrics of this node.
+NODE_ADDRESS = os.environ.get('DOOKIO_NODE_ADDRESS', 'http://0.0.0.0')
+
+
+stage_seconds = Histogram(
+    'dookio_node_stage_seconds',
+    'Seconds spent in each stage of the deploys.',
+    ('stage', 'app', 'node'))
+
+
+def app_label(conf):
+    return '{}/{}'.format(conf.get('user'), conf.get('repo'))
+
+
+@contextmanager
+def span(stage, app=''):
+    """
+    Time the block as a stage of the deploys (even if it fails).
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.time() - start, stage, app, NODE_ADDRESS)
+
+
+def expose():
+    return stage_seconds.expose()
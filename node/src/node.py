@@ -1,11 +1,13 @@
 import docker
 import os
 import json
-import tarfile
+import time
+import redis
+import logging
+import threading
 
 from werkzeug.wrappers import Request, Response
 from paramiko import SSHClient, AutoAddPolicy
-from scp import SCPClient
 
 from .utils import (
     create_container,
@@ -13,13 +15,223 @@ from .utils import (
     stop_containers,
     get_containers,
     create_image,
-    remove_image)
+    build_image_once,
+    context_digest,
+    fetch_manifest,
+    fetch_code,
+    iter_chunks,
+    remove_image,
+    job_logger,
+    capacity_report,
+    send_heartbeat,
+    reconcile_ports,
+    reconcile_resources,
+    release_dead_ports,
+    find_image,
+    refill_warm_pool,
+    claim_warm_containers,
+    container_index)
+from .pools import ConnectionPool, PoolTimeout
+from .cache import missing_paths, store_objects, build_context, evict_objects
+from .metrics import span, app_label, expose
+
+from shared.keys import WARM_POOL_KEY, RESOURCES_KEY, get_resources
+
+logger = logging.getLogger(__name__)
 
 SERVER_MACHINE_ADDRESS = os.environ['DOOKIO_SERVER_ADDRESS']
 SERVER_USERNAME = os.environ['DOOKIO_SERVER_USER']
 SERVER_USERNAME_PASSWORD = os.environ['DOOKIO_SERVER_USER_PASSWORD']
 SERVER_ROOT_DIRECTORY = os.environ['DOOKIO_SERVER_ROOT']
 LOCAL_ROOT_DIRECTORY = os.environ['DOOKIO_NODE_ROOT']
+SERVER_URL = os.environ.get('DOOKIO_SERVER_URL',
+                            'http://{}:8000'.format(SERVER_MACHINE_ADDRESS))
+# Registry used for sharing the images between nodes e.g 123.123.123.1:5001
+REGISTRY = os.environ.get('DOOKIO_REGISTRY')
+# Content-addressed cache of the files of every application.
+OBJECTS_DIRECTORY = os.environ.get('DOOKIO_OBJECTS_ROOT',
+                                   '{}/.objects'.format(LOCAL_ROOT_DIRECTORY))
+# Bytes the cache may take before the least recently used files are evicted.
+OBJECTS_MAX_SIZE = int(os.environ.get('DOOKIO_OBJECTS_MAX_SIZE',
+                                      2 * 1024 * 1024 * 1024))
+# How the server reaches this node (as written in the NODES file).
+NODE_ADDRESS = os.environ.get('DOOKIO_NODE_ADDRESS', 'http://0.0.0.0')
+REDIS_URL = os.environ.get('DOOKIO_REDIS_URL', 'redis://localhost:6379/0')
+# Seconds between heartbeats, and before the server considers the node dead.
+HEARTBEAT_INTERVAL = float(os.environ.get('DOOKIO_HEARTBEAT_INTERVAL', 5))
+HEARTBEAT_TTL = float(os.environ.get('DOOKIO_HEARTBEAT_TTL', 15))
+# Seconds a new port has to be published by its container before it is
+# considered leaked (its container died) and released.
+PORT_GRACE = float(os.environ.get('DOOKIO_PORT_GRACE', 120))
+DOCKER_POOL_SIZE = int(os.environ.get('DOOKIO_DOCKER_POOL_SIZE', 10))
+SSH_POOL_SIZE = int(os.environ.get('DOOKIO_SSH_POOL_SIZE', 4))
+# Docker clients of the lookups (/capacity, /containers?action=get), apart
+# from the ones of the deploys so they never wait for a build.
+STATUS_POOL_SIZE = int(os.environ.get('DOOKIO_STATUS_POOL_SIZE', 2))
+# Seconds a request waits for a pooled client before giving up.
+POOL_TIMEOUT = float(os.environ.get('DOOKIO_POOL_TIMEOUT', 30))
+# Seconds between two refills of the warm containers, and whether they are
+# kept paused (no CPU used, but claiming them takes an unpause).
+WARM_POOL_INTERVAL = float(os.environ.get('DOOKIO_WARM_POOL_INTERVAL', 10))
+WARM_POOL_PAUSE = os.environ.get(
+    'DOOKIO_WARM_POOL_PAUSE', 'false').lower() == 'true'
+# Deploys (image builds) answered at the same time. Keep it under the
+# number of workers so the status endpoints always have a thread.
+MAX_DEPLOYS = int(os.environ.get('DOOKIO_MAX_DEPLOYS', 8))
+deploy_slots = threading.BoundedSemaphore(MAX_DEPLOYS)
+
+redis_cli = redis.StrictRedis.from_url(REDIS_URL)
+
+
+def connect_docker(timeout=10):
+    """
+    Create docker socket.
+    """
+    return docker.Client(base_url='unix://var/run/docker.sock',
+                         version='1.12',
+                         timeout=timeout)
+
+
+def docker_is_healthy(cli):
+    try:
+        return cli.ping() == 'OK'
+    except Exception:
+        return False
+
+
+def connect_ssh():
+    """
+    Establish ssh connection with the server.
+    """
+    ssh = SSHClient()
+    ssh.load_system_host_keys()
+    ssh.set_missing_host_key_policy(AutoAddPolicy())
+    ssh.connect(SERVER_MACHINE_ADDRESS,
+                username=SERVER_USERNAME,
+                password=SERVER_USERNAME_PASSWORD)
+    return ssh
+
+
+def ssh_is_healthy(ssh):
+    transport = ssh.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        transport.send_ignore()
+    except Exception:
+        return False
+    return True
+
+
+def docker_pool(size):
+    return ConnectionPool(connect_docker, docker_is_healthy,
+                          lambda cli: cli.close(), size, timeout=POOL_TIMEOUT)
+
+
+docker_clients = docker_pool(DOCKER_POOL_SIZE)
+status_clients = docker_pool(STATUS_POOL_SIZE)
+# The background threads have a client each.
+heartbeat_clients = docker_pool(1)
+warm_pool_clients = docker_pool(1)
+ssh_clients = ConnectionPool(connect_ssh, ssh_is_healthy,
+                             lambda ssh: ssh.close(), SSH_POOL_SIZE,
+                             timeout=POOL_TIMEOUT)
+
+
+def build_from_cache(cli, conf, manifest, log=None):
+    """
+    Build the image of the application from the local cache. Only the files
+    that are not cached yet are fetched from the server (over an already
+    established ssh session).
+    """
+    paths = missing_paths(OBJECTS_DIRECTORY, manifest)
+    if paths:
+        if log:
+            log('Fetching {} files from the server'.format(len(paths)))
+        with ssh_clients.connection() as ssh:
+            with span('fetch_code', app_label(conf)):
+                code = fetch_code(ssh, conf, paths)
+                store_objects(OBJECTS_DIRECTORY, code)
+            if code.channel.recv_exit_status() != 0:
+                raise Exception(
+                    'The code of {}/{} could not be fetched from the '
+                    'server.'.format(conf.get('user'), conf.get('repo')))
+    if missing_paths(OBJECTS_DIRECTORY, manifest):
+        raise Exception(
+            'The code of {}/{} changed while being fetched. '
+            'Please try again.'.format(conf.get('user'), conf.get('repo')))
+
+    # The build context is put together from the cache.
+    with span('build_context', app_label(conf)):
+        context = build_context(OBJECTS_DIRECTORY, manifest)
+    if paths:
+        evict_objects(OBJECTS_DIRECTORY, OBJECTS_MAX_SIZE)
+    create_image(cli, conf, iter_chunks(context), log=log)
+
+
+def reconcile():
+    """
+    Sync the port allocator (and the reserved resources) with the running
+    containers. Called once before serving, so nothing is being allocated
+    while it runs.
+    """
+    with docker_clients.connection() as cli:
+        reconcile_ports(cli)
+        reconcile_resources(cli)
+
+
+def start_heartbeat():
+    """
+    Register the node in the registry and keep sending heartbeats (with
+    the capacity report of the node) from a background thread.
+    """
+    def heartbeat():
+        while True:
+            try:
+                with heartbeat_clients.connection() as cli:
+                    release_dead_ports(cli, PORT_GRACE)
+                    report = capacity_report(cli)
+                send_heartbeat(redis_cli, NODE_ADDRESS, report, HEARTBEAT_TTL)
+            except Exception:
+                logger.exception('The heartbeat could not be sent')
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def start_warm_pool():
+    """
+    Keep the warm containers asked by the server (per app) started, from a
+    background thread.
+    """
+    def refill():
+        while True:
+            try:
+                pipe = redis_cli.pipeline()
+                pipe.hgetall(WARM_POOL_KEY)
+                pipe.hgetall(RESOURCES_KEY)
+                sizes, resources = pipe.execute()
+                with warm_pool_clients.connection() as cli:
+                    refill_warm_pool(cli, sizes, WARM_POOL_PAUSE, resources)
+            except Exception:
+                logger.exception('The warm pool could not be refilled')
+            time.sleep(WARM_POOL_INTERVAL)
+
+    thread = threading.Thread(target=refill)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def start_index_watcher():
+    """
+    Keep the container index up to date with the docker events. Called
+    once before serving.
+    """
+    return container_index.watch(connect_docker(timeout=None))
 
 
 @Request.application
@@ -31,16 +243,33 @@ def application(request):
     Please notice that the code path in that remote
     machine has to match with the pattern defined in the env vars.
     """
-    # Create docker socket
-    cli = docker.Client(base_url='unix://var/run/docker.sock',
-                        version='1.12',
-                        timeout=10)
+    if request.path == '/metrics':
+        return Response(expose(), mimetype='text/plain; version=0.0.4')
+    try:
+        return handle(request)
+    except PoolTimeout, e:
+        return Response('The node is busy: {}\n'.format(e), status=503)
+
 
+def handle(request):
+    """
+    Apply the request. Docker clients are only borrowed from the pools for
+    as long as they are needed.
+    """
     conf = {
         'action': request.args.get('action'),
         'path': request.path,
         'user': request.args.get('user'),
         'repo': request.args.get('repo'),
+        # The deploy job of the server this request belongs to (if any).
+        'job': request.args.get('job'),
+        # Deploy this image (context digest) of the app, if it is available.
+        'digest': request.args.get('digest'),
+        # When the server stops waiting for the deploy (if it does).
+        'deadline': (time.time() + float(request.args['timeout'])
+                     if request.args.get('timeout') else None),
+        'ports': [int(port) for port in
+                  request.args.get('ports', '').split(',') if port],
         'local_path': '{}/{}/{}'.format(
             LOCAL_ROOT_DIRECTORY,
             request.args.get('user'),
@@ -54,52 +283,122 @@ def application(request):
     # Extract some values from the conf dict.
     action = conf.get('action')
     path = conf.get('path')
-    local_path = conf.get('local_path')
-    remote_path = conf.get('remote_path')
+
+    if path == '/capacity':
+        with status_clients.connection() as cli:
+            return Response(json.dumps(capacity_report(cli)),
+                            mimetype='application/json')
 
     if path == '/containers':
-        containers = []
         if action == 'get':
-            containers = get_containers(cli, conf)
-        elif action == 'stop':
-            try:
-                stop_containers(cli, conf)
-            except Exception, e:
-                return Response(str(e), status=400)
-        elif action == 'start':
-            try:
-                containers = start_container(cli, conf)
-            except Exception, e:
-                return Response(str(e), status=400)
-        elif action == 'remove':
+            with status_clients.connection() as cli:
+                return Response(json.dumps(get_containers(cli, conf)))
+        with docker_clients.connection() as cli:
+            return change_containers(cli, conf, request)
+
+    # Extra deploys are turned away right away instead of queueing up.
+    if not deploy_slots.acquire(False):
+        return Response(
+            'The node is busy with {} deploys. Please try again later.\n'
+            .format(MAX_DEPLOYS), status=429)
+    try:
+        with span('deploy', app_label(conf)):
+            with docker_clients.connection() as cli:
+                return deploy(cli, conf)
+    finally:
+        deploy_slots.release()
+
+
+def change_containers(cli, conf, request):
+    """
+    Stop, start, remove or claim the containers of the application.
+    """
+    action = conf.get('action')
+    containers = []
+    if action == 'stop':
+        try:
             stop_containers(cli, conf)
-            remove_image(cli, conf)
+        except Exception, e:
+            return Response(str(e), status=400)
+    elif action == 'start':
+        try:
+            containers = start_container(
+                cli, dict(conf, **get_resources(redis_cli, conf)))
+        except Exception, e:
+            return Response(str(e), status=400)
+    elif action == 'remove':
+        try:
+            stop_containers(cli, conf)
+        except Exception:
+            # Not running: the image is removed anyway.
+            pass
+        remove_image(cli, conf)
+    elif action == 'claim':
+        containers = claim_warm_containers(
+            cli, conf, int(request.args.get('count', 1)),
+            conf.get('digest'))
 
-        return Response(json.dumps(containers))
+    return Response(json.dumps(containers))
 
-    if not os.path.exists(local_path):
-        os.makedirs(local_path)
 
-    # Establish ssh connection
-    ssh = SSHClient()
-    ssh.load_system_host_keys()
-    ssh.set_missing_host_key_policy(AutoAddPolicy())
-    ssh.connect(SERVER_MACHINE_ADDRESS,
-                username=SERVER_USERNAME,
-                password=SERVER_USERNAME_PASSWORD)
-    scp = SCPClient(ssh.get_transport())
-    # Fetch code from server
-    scp.get('{}/code.tar.gz'.format(remote_path), local_path)
-    # Extract files
-    with tarfile.open("{}/code.tar.gz".format(local_path), 'r:gz') as f:
-        f.extractall('{}'.format(local_path))
-
-    create_image(cli, conf)
+def deploy(cli, conf):
+    """
+    Build the image of the application (if needed) and start a container.
+    If an image (digest) is asked for and it is available, it is used
+    instead.
+    """
+    log = job_logger(redis_cli, conf.get('job'))
+    # The containers are created with the limits of the app.
+    conf = dict(conf, **get_resources(redis_cli, conf))
+
+    digest = conf.get('digest')
+    image = digest and find_image(cli, conf, digest, REGISTRY)
+    if image:
+        conf = dict(conf, image=image)
+    else:
+        # The image is only built if the code changed since the last build.
+        try:
+            manifest = fetch_manifest(SERVER_URL, conf)
+            digest = context_digest(manifest)
+            built = build_image_once(
+                cli, conf, digest,
+                lambda: build_from_cache(cli, conf, manifest, log), REGISTRY)
+        except Exception, e:
+            log('The image could not be built in {}: {}'.format(
+                NODE_ADDRESS, e))
+            return Response(str(e), status=400)
+        if not built:
+            log('The code did not change, reusing its image in {}'.format(
+                NODE_ADDRESS))
+        # Created from the image of the digest (rather than "latest"), so
+        # the server can tell which code the container runs.
+        conf = dict(conf, image='{}/{}:{}'.format(
+            conf.get('user'), conf.get('repo'), digest))
+
+    if past_deadline(conf):
+        return deadline_response(conf, log)
     try:
         container, port = create_container(cli, conf)
     except Exception, e:
         return Response(str(e), status=400)
-    else:
-        return Response(
-            json.dumps({'id': container.get('Id'),
-                        'port': '{}'.format(port)}))
+    if past_deadline(conf):
+        # The server won't route it: nobody would ever stop it.
+        stop_containers(cli, dict(conf, ports=[port]))
+        return deadline_response(conf, log)
+    return Response(
+        json.dumps({'id': container.get('Id'),
+                    'port': '{}'.format(port),
+                    'digest': digest}))
+
+
+def past_deadline(conf):
+    deadline = conf.get('deadline')
+    return deadline is not None and time.time() >= deadline
+
+
+def deadline_response(conf, log):
+    message = ('The replica of {}/{} was not ready before the server gave '
+               'up waiting for it in {}'.format(
+                   conf.get('user'), conf.get('repo'), NODE_ADDRESS))
+    log(message)
+    return Response(message + '\n', status=504)
@@ -0,0 +1,98 @@
+import threading
+import time
+import Queue
+
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of long-lived connections (docker clients, ssh
+    sessions...) shared by the requests of the node.
+
+    Connections are created lazily, up to `size`. The ones that have been
+    idle for more than `check_after` seconds are health checked before
+    being handed out, and broken ones are closed and replaced. Borrowers
+    wait up to `timeout` seconds for a connection (None: forever).
+    """
+    def __init__(self, connect, is_healthy, close, size, check_after=30,
+                 timeout=None):
+        self.size = size
+        self.check_after = check_after
+        self.timeout = timeout
+        self._connect = connect
+        self._is_healthy = is_healthy
+        self._close = close
+        self._idle = Queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _checkout(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except Queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self._connect()
+                    except:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                # Every connection is busy, wait for one (or for a slot
+                # freed by a discarded connection).
+                wait = 1
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        raise PoolTimeout(
+                            'All of the {} connections are busy.'.format(
+                                self.size))
+                try:
+                    conn, last_used = self._idle.get(timeout=wait)
+                except Queue.Empty:
+                    continue
+
+            if (time.time() - last_used < self.check_after or
+                    self._is_healthy(conn)):
+                return conn
+            self._discard(conn)
+
+    def _checkin(self, conn):
+        self._idle.put((conn, time.time()))
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        try:
+            self._close(conn)
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of the `with` block.
+        """
+        conn = self._checkout()
+        try:
+            yield conn
+        except:
+            if self._is_healthy(conn):
+                self._checkin(conn)
+            else:
+                self._discard(conn)
+            raise
+        else:
+            self._checkin(conn)
@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+
+from collections import deque
+
+
+class PortAllocator(object):
+    """
+    Hand out the ports published by the containers of the node.
+
+    Used ports are kept in a bitmap and free ones in a free-list, so both
+    allocating and releasing are O(1). Every change is written to an
+    append-only journal before being applied, and the journal is replayed
+    the first time the allocator is used.
+    """
+    def __init__(self, start, end, journal_path):
+        self.start = start
+        self.end = end
+        self.journal_path = journal_path
+        self.reconciled = False
+        self._lock = threading.Lock()
+        self._used = None
+        self._used_count = 0
+        self._free = None
+        self._journal = None
+        # Used port -> when it was allocated (or loaded).
+        self._allocated = {}
+
+    def _load(self):
+        """
+        Build the bitmap and free-list from the journal (once).
+        """
+        if self._used is not None:
+            return
+        self._used = bytearray(self.end - self.start)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    self._set(int(line[1:]), line[0] == '+')
+        self._free = deque(port for port in xrange(self.start, self.end)
+                           if not self._is_used(port))
+        self._allocated = dict.fromkeys(
+            (port for port in xrange(self.start, self.end)
+             if self._is_used(port)), time.time())
+        self._journal = open(self.journal_path, 'a')
+
+    def _in_range(self, port):
+        return self.start <= port < self.end
+
+    def _is_used(self, port):
+        return bool(self._used[port - self.start])
+
+    def _set(self, port, used):
+        if self._in_range(port):
+            value = 1 if used else 0
+            self._used_count += value - self._used[port - self.start]
+            self._used[port - self.start] = value
+
+    def _write(self, entry):
+        self._journal.write('{}\n'.format(entry))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def allocate(self):
+        """
+        Reserve a free port.
+        """
+        with self._lock:
+            self._load()
+            while self._free:
+                port = self._free.popleft()
+                # Ports marked as used by a reconciliation are skipped.
+                if not self._is_used(port):
+                    self._write('+{}'.format(port))
+                    self._set(port, True)
+                    self._allocated[port] = time.time()
+                    return port
+        raise Exception('There are no more available ports!')
+
+    def release(self, port):
+        """
+        Give a port back to the free-list.
+        """
+        port = int(port)
+        with self._lock:
+            self._load()
+            if not self._in_range(port) or not self._is_used(port):
+                return
+            self._write('-{}'.format(port))
+            self._set(port, False)
+            self._allocated.pop(port, None)
+            self._free.append(port)
+
+    def release_unpublished(self, published_ports, grace):
+        """
+        Release the used ports that no container publishes anymore (their
+        container died or was removed by hand), except the ones allocated
+        in the last `grace` seconds, whose container may be starting.
+        Returns the released ports.
+        """
+        published = set(int(port) for port in published_ports)
+        with self._lock:
+            self._load()
+            deadline = time.time() - grace
+            released = sorted(port for port, allocated
+                              in self._allocated.iteritems()
+                              if port not in published and
+                              allocated <= deadline)
+            for port in released:
+                self._write('-{}'.format(port))
+                self._set(port, False)
+                del self._allocated[port]
+                self._free.append(port)
+        return released
+
+    def available(self):
+        """
+        Number of ports that can still be allocated.
+        """
+        with self._lock:
+            self._load()
+            return len(self._used) - self._used_count
+
+    def reconcile(self, used_ports):
+        """
+        Make the allocator match the ports really published by docker and
+        compact the journal accordingly.
+        """
+        used_ports = set(int(port) for port in used_ports
+                         if self._in_range(int(port)))
+        with self._lock:
+            self._load()
+            self._used = bytearray(self.end - self.start)
+            self._used_count = 0
+            for port in used_ports:
+                self._set(port, True)
+            self._allocated = dict.fromkeys(used_ports, time.time())
+            self._free = deque(port for port in xrange(self.start, self.end)
+                               if not self._is_used(port))
+
+            aux_path = '{}.aux'.format(self.journal_path)
+            with open(aux_path, 'w') as f:
+                for port in sorted(used_ports):
+                    f.write('+{}\n'.format(port))
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal.close()
+            os.rename(aux_path, self.journal_path)
+            self._journal = open(self.journal_path, 'a')
+            self.reconciled = True
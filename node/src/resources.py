@@ -0,0 +1,70 @@
+import threading
+
+# What the containers can ask for: the memory limit (bytes) and the CPU
+# shares (1024 per CPU).
+RESOURCES = ('memory', 'cpu_shares')
+
+
+class NoCapacity(Exception):
+    pass
+
+
+class ResourceLedger(object):
+    """
+    The memory and CPU shares reserved by the containers of the node, so
+    the limits of the new ones never add up to more than the node has.
+
+    Reservations are keyed by the port of the container (unique in the
+    node and known before the container is created) and go away when the
+    port is released. Containers without limits don't reserve anything.
+    """
+    def __init__(self, memory, cpu_shares):
+        self.capacity = {'memory': memory, 'cpu_shares': cpu_shares}
+        self.reconciled = False
+        self._lock = threading.Lock()
+        # port -> {'memory': bytes, 'cpu_shares': shares}
+        self._reserved = {}
+
+    def _allocated(self):
+        return dict((resource, sum(request.get(resource) or 0
+                                   for request in self._reserved.itervalues()))
+                    for resource in RESOURCES)
+
+    def allocated(self):
+        with self._lock:
+            return self._allocated()
+
+    def reserve(self, port, request):
+        """
+        Reserve the resources asked for by the container of `port`. Raises
+        NoCapacity if they don't fit in what is left.
+        """
+        request = dict((resource, request.get(resource) or 0)
+                       for resource in RESOURCES)
+        with self._lock:
+            allocated = self._allocated()
+            for resource in RESOURCES:
+                if request[resource] and (
+                        allocated[resource] + request[resource] >
+                        self.capacity[resource]):
+                    raise NoCapacity(
+                        'The node has {} {} left and {} were asked for.'
+                        .format(self.capacity[resource] - allocated[resource],
+                                resource, request[resource]))
+            if any(request.itervalues()):
+                self._reserved[int(port)] = request
+
+    def release(self, port):
+        with self._lock:
+            self._reserved.pop(int(port), None)
+
+    def reconcile(self, reserved):
+        """
+        Replace the reservations with the ones of the running containers
+        (port -> request).
+        """
+        with self._lock:
+            self._reserved = dict(
+                (int(port), request) for port, request in reserved.iteritems()
+                if any(request.get(resource) for resource in RESOURCES))
+            self.reconciled = True
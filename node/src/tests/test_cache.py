@@ -0,0 +1,89 @@
+import os
+import time
+import shutil
+import tarfile
+import tempfile
+import unittest
+import hashlib
+
+from StringIO import StringIO
+
+from src.cache import (object_path,
+                       missing_paths,
+                       store_object,
+                       store_objects,
+                       build_context,
+                       evict_objects)
+
+
+class ObjectCacheTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.objects_path = tempfile.mkdtemp()
+        self.dockerfile = 'FROM ubuntu\n'
+        self.digest = hashlib.sha1(self.dockerfile).hexdigest()
+        self.manifest = {
+            'Dockerfile': {'sha1': self.digest, 'mode': 0644},
+            'copy/Dockerfile': {'sha1': self.digest, 'mode': 0755},
+            'link': {'link': 'Dockerfile'},
+            'logs': {'dir': True, 'mode': 0700}
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.objects_path)
+
+    def test_missing_paths_asks_once_per_blob(self):
+        assert missing_paths(self.objects_path, self.manifest) == [
+            'Dockerfile']
+
+        store_object(self.objects_path, StringIO(self.dockerfile))
+        assert missing_paths(self.objects_path, self.manifest) == []
+
+    def test_store_object_is_content_addressed(self):
+        digest = store_object(self.objects_path, StringIO(self.dockerfile))
+
+        assert digest == self.digest
+        with open(object_path(self.objects_path, digest)) as f:
+            assert f.read() == self.dockerfile
+
+    def test_store_objects_from_a_tar_stream(self):
+        stream = StringIO()
+        with tarfile.open(fileobj=stream, mode='w:gz') as tar:
+            info = tarfile.TarInfo('Dockerfile')
+            info.size = len(self.dockerfile)
+            tar.addfile(info, StringIO(self.dockerfile))
+        stream.seek(0)
+
+        assert store_objects(self.objects_path, stream) == [self.digest]
+
+    def test_build_context_from_the_cache(self):
+        store_object(self.objects_path, StringIO(self.dockerfile))
+        context = build_context(self.objects_path, self.manifest)
+
+        with tarfile.open(fileobj=context, mode='r') as tar:
+            members = dict((m.name, m) for m in tar.getmembers())
+            assert sorted(members) == [
+                'Dockerfile', 'copy/Dockerfile', 'link', 'logs']
+            assert members['copy/Dockerfile'].mode == 0755
+            assert members['link'].issym()
+            assert members['logs'].isdir()
+            assert members['logs'].mode == 0700
+            assert tar.extractfile('Dockerfile').read() == self.dockerfile
+
+    def test_evict_the_least_recently_used_objects(self):
+        old = store_object(self.objects_path, StringIO('old'))
+        recent = store_object(self.objects_path, StringIO('recent'))
+        an_hour_ago = time.time() - 3600
+        os.utime(object_path(self.objects_path, old),
+                 (an_hour_ago, an_hour_ago))
+        os.utime(object_path(self.objects_path, recent),
+                 (an_hour_ago + 1, an_hour_ago + 1))
+
+        assert evict_objects(self.objects_path, 6) == 1
+        assert not os.path.exists(object_path(self.objects_path, old))
+        assert os.path.exists(object_path(self.objects_path, recent))
+        assert evict_objects(self.objects_path, 6) == 0
+
+    def test_recently_used_objects_are_not_evicted(self):
+        store_object(self.objects_path, StringIO(self.dockerfile))
+
+        assert evict_objects(self.objects_path, 0) == 0
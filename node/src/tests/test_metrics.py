@@ -0,0 +1,15 @@
+import unittest
+
+from src.metrics import span, stage_seconds
+
+
+class MetricsTestSuite(unittest.TestCase):
+    def test_span_is_recorded_even_if_it_fails(self):
+        def fail():
+            with span('test_stage', 'git/apache'):
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+
+        assert ('dookio_node_stage_seconds_count{stage="test_stage",'
+                'app="git/apache",node="http://0.0.0.0"} 1'
+                in stage_seconds.expose())
@@ -0,0 +1,73 @@
+import unittest
+from mock import Mock
+
+from src.pools import ConnectionPool, PoolTimeout
+
+
+class ConnectionPoolTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.connect = Mock(side_effect=lambda: Mock())
+        self.is_healthy = Mock(return_value=True)
+        self.close = Mock()
+
+    def pool(self, size=2, check_after=30, timeout=None):
+        return ConnectionPool(self.connect, self.is_healthy, self.close,
+                              size, check_after, timeout)
+
+    def test_connections_are_reused(self):
+        pool = self.pool()
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+
+        assert first is second
+        assert self.connect.call_count == 1
+
+    def test_concurrent_borrowers_get_different_connections(self):
+        pool = self.pool()
+        with pool.connection() as first:
+            with pool.connection() as second:
+                assert first is not second
+        assert self.connect.call_count == 2
+
+    def test_idle_connections_are_health_checked(self):
+        pool = self.pool(check_after=0)
+        with pool.connection() as first:
+            pass
+        self.is_healthy.return_value = False
+        with pool.connection() as second:
+            pass
+
+        assert first is not second
+        self.close.assert_called_once_with(first)
+
+    def test_broken_connections_are_discarded_on_error(self):
+        pool = self.pool()
+        self.is_healthy.return_value = False
+        try:
+            with pool.connection() as first:
+                raise IOError('Connection reset')
+        except IOError:
+            pass
+        with pool.connection() as second:
+            pass
+
+        assert first is not second
+        self.close.assert_called_once_with(first)
+
+    def test_failed_connects_do_not_use_up_the_pool(self):
+        pool = self.pool(size=1)
+        self.connect.side_effect = [IOError('Connection refused'), Mock()]
+        self.assertRaises(IOError, pool._checkout)
+
+        with pool.connection() as conn:
+            assert conn is not None
+
+    def test_borrowers_give_up_after_the_timeout(self):
+        pool = self.pool(size=1, timeout=0.05)
+        with pool.connection():
+            self.assertRaises(PoolTimeout, pool._checkout)
+
+        with pool.connection() as conn:
+            assert conn is not None
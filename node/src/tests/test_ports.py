@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from src.ports import PortAllocator
+
+
+class PortAllocatorTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.dir, 'PORTS_JOURNAL')
+        self.allocator = PortAllocator(4567, 4570, self.journal)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ports_are_allocated_only_once(self):
+        ports = [self.allocator.allocate() for i in range(3)]
+
+        assert sorted(ports) == [4567, 4568, 4569]
+        assert self.allocator.available() == 0
+        self.assertRaises(Exception, self.allocator.allocate)
+
+    def test_released_ports_can_be_allocated_again(self):
+        ports = [self.allocator.allocate() for i in range(3)]
+        self.allocator.release(ports[1])
+
+        assert self.allocator.allocate() == ports[1]
+
+    def test_releasing_an_unused_port_is_ignored(self):
+        self.allocator.release(4568)
+        self.allocator.release(9999)
+
+        assert self.allocator.available() == 3
+
+    def test_journal_is_replayed(self):
+        first = self.allocator.allocate()
+        second = self.allocator.allocate()
+        self.allocator.release(first)
+
+        allocator = PortAllocator(4567, 4570, self.journal)
+        assert allocator.available() == 2
+        assert allocator.allocate() != second
+
+    def test_reconcile_with_the_running_containers(self):
+        self.allocator.allocate()
+        self.allocator.reconcile([4569, 80])
+
+        assert self.allocator.reconciled
+        assert self.allocator.available() == 2
+        assert sorted([self.allocator.allocate(),
+                       self.allocator.allocate()]) == [4567, 4568]
+        with open(self.journal) as f:
+            assert f.read() == '+4569\n+4567\n+4568\n'
+
+    def test_unpublished_ports_are_released_after_the_grace_period(self):
+        ports = [self.allocator.allocate() for i in range(3)]
+
+        assert self.allocator.release_unpublished(ports[:1], 60) == []
+        assert self.allocator.release_unpublished(ports[:1], 0) == ports[1:]
+        assert self.allocator.available() == 2
+        with open(self.journal) as f:
+            assert f.read().splitlines()[-2:] == [
+                '-{}'.format(port) for port in ports[1:]]
+
+    def test_concurrent_allocations_never_share_a_port(self):
+        allocator = PortAllocator(4567, 4767, self.journal)
+        ports = []
+
+        def allocate():
+            for i in range(20):
+                ports.append(allocator.allocate())
+        threads = [threading.Thread(target=allocate) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(set(ports)) == 200
@@ -0,0 +1,43 @@
+import unittest
+
+from src.resources import ResourceLedger, NoCapacity
+
+GB = 1024 ** 3
+
+
+class ResourceLedgerTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.ledger = ResourceLedger(2 * GB, 2048)
+
+    def test_reservations_add_up_to_the_capacity(self):
+        self.ledger.reserve(4567, {'memory': GB, 'cpu_shares': 1024})
+        self.ledger.reserve(4568, {'memory': GB})
+
+        assert self.ledger.allocated() == {'memory': 2 * GB,
+                                           'cpu_shares': 1024}
+        self.assertRaises(NoCapacity, self.ledger.reserve, 4569,
+                          {'memory': 1})
+        self.ledger.reserve(4569, {'cpu_shares': 1024})
+
+    def test_containers_without_limits_always_fit(self):
+        self.ledger.reserve(4567, {'memory': 2 * GB})
+
+        self.ledger.reserve(4568, {})
+        assert self.ledger.allocated()['memory'] == 2 * GB
+
+    def test_released_ports_give_their_resources_back(self):
+        self.ledger.reserve(4567, {'memory': 2 * GB})
+        self.ledger.release(4567)
+
+        self.ledger.reserve(4568, {'memory': 2 * GB})
+        self.ledger.release(4569)
+        assert self.ledger.allocated()['memory'] == 2 * GB
+
+    def test_reconcile_with_the_running_containers(self):
+        self.ledger.reserve(4567, {'memory': GB})
+        self.ledger.reconcile({4568: {'memory': GB / 2, 'cpu_shares': 0},
+                               4569: {'memory': 0, 'cpu_shares': 0}})
+
+        assert self.ledger.reconciled
+        assert self.ledger.allocated() == {'memory': GB / 2,
+                                           'cpu_shares': 0}
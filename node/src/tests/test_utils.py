@@ -1,17 +1,43 @@
+import os
+import shutil
 import unittest
+import tempfile
+import threading
+import time
 from mock import patch, Mock
+from docker.errors import APIError
 
 from src.utils import (_reserve_container,
                        start_container,
                        stop_containers,
                        get_containers,
                        create_image,
+                       job_logger,
+                       fetch_code,
+                       fetch_manifest,
+                       build_image_once,
+                       find_image,
+                       release_dead_ports,
+                       context_digest,
+                       SERVER_TIMEOUT,
+                       iter_chunks,
                        remove_image,
-                       create_container)
+                       create_container,
+                       capacity_report,
+                       send_heartbeat,
+                       read_meminfo,
+                       refill_warm_pool,
+                       claim_warm_containers,
+                       pause_container,
+                       reconcile_resources,
+                       container_index)
+from src.warm import WarmPool
+from src.resources import ResourceLedger, NoCapacity
 
 
 class NodeUtilsTestSuite(unittest.TestCase):
     def setUp(self):
+        container_index.invalidate()
         self.port = 4567
         self.cli = Mock()
         self.conf = {
@@ -36,12 +62,57 @@ class NodeUtilsTestSuite(unittest.TestCase):
 
         assert mock_get_port.called
         assert self.cli.create_container.called
-        self.cli.create_container.assert_called_once_with(name=self.container_name[1:], image=self.tag, command="", ports=[80])
+        self.cli.create_container.assert_called_once_with(name=self.container_name[1:], image=self.tag, command="", ports=[80], mem_limit=0, cpu_shares=None)
         self.cli.start.assert_called_once_with(container=expected_container.get('Id'), port_bindings={80: self.port})
         assert not mock_make_port_available.called
         assert container is expected_container
         assert port == 4567
 
+    @patch('src.utils.get_port', Mock(return_value=4567))
+    @patch('src.utils.resource_ledger', ResourceLedger(1024, 1024))
+    def test_the_container_is_limited_to_the_resources_of_the_app(self):
+        self.cli.create_container.return_value = {'Id': 'sdffdfdsfsfds'}
+        _reserve_container(self.cli, dict(self.conf, memory=512,
+                                          cpu_shares=256))
+
+        kwargs = self.cli.create_container.call_args[1]
+        assert (kwargs['mem_limit'], kwargs['cpu_shares']) == (512, 256)
+        from src.utils import resource_ledger
+        assert resource_ledger.allocated() == {'memory': 512,
+                                               'cpu_shares': 256}
+
+    @patch('src.utils.get_port', Mock(return_value=4567))
+    @patch('src.utils.make_port_available')
+    @patch('src.utils.resource_ledger', ResourceLedger(1024, 1024))
+    def test_containers_that_do_not_fit_in_the_node_are_not_created(
+            self, mock_make_port_available):
+        self.assertRaises(NoCapacity, create_container, self.cli,
+                          dict(self.conf, memory=2048))
+
+        assert not self.cli.create_container.called
+        mock_make_port_available.assert_called_once_with(4567)
+
+    @patch('src.utils.resource_ledger', ResourceLedger(1024, 1024))
+    def test_reconcile_resources_with_the_running_containers(self):
+        self.cli.containers.return_value = [
+            {'Id': 'a', 'Ports': [{'PublicPort': 4567}]},
+            {'Id': 'b', 'Ports': []}]
+        self.cli.inspect_container.return_value = {
+            'Config': {'Memory': 512, 'CpuShares': 0}}
+
+        reconcile_resources(self.cli)
+
+        from src.utils import resource_ledger
+        self.cli.inspect_container.assert_called_once_with('a')
+        assert resource_ledger.allocated()['memory'] == 512
+
+    @patch('src.utils.get_port', Mock(return_value=4567))
+    def test_the_container_can_be_created_from_a_given_image(self):
+        self.cli.create_container.return_value = {'Id': 'sdffdfdsfsfds'}
+        _reserve_container(self.cli, dict(self.conf, image='git/portfolio:abc'))
+
+        assert self.cli.create_container.call_args[1]['image'] == 'git/portfolio:abc'
+
     @patch('src.utils._reserve_container')
     def test_create_container_if_success(self,
             mock_reserve_container):
@@ -136,6 +207,28 @@ class NodeUtilsTestSuite(unittest.TestCase):
         self.cli.remove_container.assert_called_with(
             expected_container.get("Id"), force=True)
 
+    @patch('src.utils.make_port_available')
+    def test_stop_container_only_on_the_given_ports(self,
+            mock_make_port_available):
+        old_container = {
+            "Names": [self.container_name],
+            "Ports": [{"PublicPort": self.port}],
+            "Id": "qwerty12345"
+        }
+        new_container = {
+            "Names": ["/git_portfolio_4568"],
+            "Ports": [{"PublicPort": 4568}],
+            "Id": "asdfg67890"
+        }
+
+        self.cli.containers.return_value = [old_container, new_container]
+        conf = dict(self.conf, ports=[self.port])
+        stop_containers(self.cli, conf)
+        mock_make_port_available.assert_called_once_with(self.port)
+        self.cli.kill.assert_called_once_with(old_container)
+        self.cli.remove_container.assert_called_once_with(
+            old_container.get("Id"), force=True)
+
     @patch('src.utils.make_port_available')
     def test_stop_container_if_no_containers_are_running(self,
             mock_make_port_available):
@@ -177,6 +270,107 @@ class NodeUtilsTestSuite(unittest.TestCase):
         assert expected_container in containers
         assert len(containers) == 1
 
+    def test_get_containers_with_five_digits_ports(self):
+        expected_container = {
+            "Names": ["/git_portfolio_14567"],
+            "Ports": [{"PublicPort": 14567}],
+            "Id": "qwerty12345"
+        }
+
+        self.cli.containers.return_value = [expected_container]
+
+        containers = get_containers(self.cli, self.conf)
+        assert containers == [expected_container]
+
+    def test_get_containers_is_served_from_the_index(self):
+        expected_container = {
+            "Names": [self.container_name],
+            "Ports": [{"PublicPort": self.port}],
+            "Id": "qwerty12345"
+        }
+
+        self.cli.containers.return_value = [expected_container]
+
+        get_containers(self.cli, self.conf)
+        containers = get_containers(self.cli, self.conf)
+        assert containers == [expected_container]
+        assert self.cli.containers.call_count == 1
+
+        container_index.invalidate()
+        get_containers(self.cli, self.conf)
+        assert self.cli.containers.call_count == 2
+
+    def test_a_refresh_older_than_an_invalidation_is_not_kept(self):
+        expected_container = {
+            "Names": [self.container_name],
+            "Ports": [{"PublicPort": self.port}],
+            "Id": "qwerty12345"
+        }
+
+        def containers():
+            # A container is started while docker is being asked.
+            container_index.invalidate()
+            return []
+        self.cli.containers.side_effect = containers
+        assert get_containers(self.cli, self.conf) == []
+
+        self.cli.containers.side_effect = None
+        self.cli.containers.return_value = [expected_container]
+        assert get_containers(self.cli, self.conf) == [expected_container]
+
+    def test_read_meminfo(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write('MemTotal:        2048 kB\n'
+                    'MemFree:          512 kB\n'
+                    'MemAvailable:    1024 kB\n')
+            f.flush()
+            assert read_meminfo(f.name) == (2048 * 1024, 1024 * 1024)
+        assert read_meminfo('/unexisting/meminfo') == (0, 0)
+
+    @patch('src.utils.port_allocator')
+    def test_capacity_report(self, mock_port_allocator):
+        self.cli.containers.return_value = [
+            {"Names": [self.container_name]},
+            {"Names": ["/git_apache_4568"], "Image": "git/apache:abc",
+             "Ports": [{"PublicPort": 4568}]},
+            {"Names": ["/git_apache_4569"]}]
+        mock_port_allocator.available.return_value = 100
+
+        report = capacity_report(self.cli)
+
+        assert report['containers'] == 3
+        assert report['apps'] == {'git_portfolio': 1, 'git_apache': 2}
+        assert report['ports'] == {'git_portfolio': [], 'git_apache': [4568]}
+        assert report['images'] == {'git_portfolio': {},
+                                    'git_apache': {4568: 'git/apache:abc'}}
+        assert report['free_ports'] == 100
+        assert report['cpus'] >= 1
+        assert report['cpu_shares_allocatable'] >= 1024
+        assert 'memory_allocated' in report
+
+    @patch('src.utils.port_allocator')
+    def test_release_dead_ports(self, mock_port_allocator):
+        self.cli.containers.return_value = [
+            {"Names": [self.container_name], "Ports": [{"PublicPort": 4567}]},
+            {"Names": ["/git_apache_4568"], "Ports": [{"PublicPort": 4568}]}]
+        release_dead_ports(self.cli, 60)
+
+        published, grace = mock_port_allocator.release_unpublished.call_args[0]
+        assert sorted(published) == [4567, 4568]
+        assert grace == 60
+
+    def test_send_heartbeat(self):
+        redis_cli = Mock()
+        pipe = redis_cli.pipeline.return_value
+        send_heartbeat(redis_cli, 'http://0.0.0.0', {'cpus': 1}, 15)
+
+        pipe.setex.assert_called_once_with(
+            'dookio:node:http://0.0.0.0', 15, '{"cpus": 1}')
+        assert pipe.zadd.call_args[0][0] == 'dookio:nodes'
+        assert pipe.zadd.call_args[0][2] == 'http://0.0.0.0'
+        pipe.publish.assert_called_once_with('dookio:nodes', 'http://0.0.0.0')
+        assert pipe.execute.called
+
     def test_create_image(self):
         local_path = self.conf.get('local_path')
         instructions = (x for x in range(10))
@@ -186,6 +380,181 @@ class NodeUtilsTestSuite(unittest.TestCase):
         assert containers == instructions
         self.cli.build.assert_called_once_with(path=local_path, tag=self.tag)
 
+    def test_create_image_from_a_streamed_context(self):
+        context = iter(['chunk'])
+        self.cli.build.return_value = []
+        create_image(self.cli, self.conf, context)
+
+        self.cli.build.assert_called_once_with(
+            fileobj=context, custom_context=True, encoding=None,
+            tag=self.tag)
+
+    def test_fetch_code_streams_only_the_requested_files(self):
+        ssh = Mock()
+        stdin = Mock()
+        stdout = Mock()
+        ssh.exec_command.return_value = (stdin, stdout, Mock())
+        conf = dict(self.conf, remote_path='/home/git/portfolio')
+
+        assert fetch_code(ssh, conf, ['Dockerfile', 'app.py']) is stdout
+        ssh.exec_command.assert_called_once_with(
+            'tar -C /home/git/portfolio/code -cz --null -T -')
+        stdin.write.assert_called_once_with('Dockerfile\0app.py')
+        assert stdin.channel.shutdown_write.called
+
+    @patch('src.utils.requests.get')
+    def test_fetch_manifest(self, mock_get):
+        mock_get.return_value.json.return_value = {}
+
+        assert fetch_manifest('http://server:8000', self.conf) == {}
+        mock_get.assert_called_once_with(
+            'http://server:8000/manifest',
+            params={'user': 'git', 'repo': 'portfolio'},
+            timeout=SERVER_TIMEOUT)
+
+    def test_create_image_if_the_build_fails(self):
+        self.cli.build.return_value = iter(
+            ['{"stream": "Step 0 : FROM nothing"}',
+             '{"error": "No such image"}'])
+
+        with self.assertRaises(Exception) as e:
+            create_image(self.cli, self.conf)
+        assert str(e.exception) == 'No such image'
+
+    def test_iter_chunks(self):
+        fileobj = Mock()
+        fileobj.read.side_effect = ['abc', 'def', '']
+
+        assert list(iter_chunks(fileobj)) == ['abc', 'def']
+        fileobj.close.assert_called_once_with()
+
+    def test_iter_chunks_can_be_closed_by_the_build(self):
+        fileobj = Mock()
+        fileobj.read.side_effect = ['abc', 'def', '']
+        chunks = iter_chunks(fileobj)
+        next(chunks)
+        chunks.close()
+
+        fileobj.close.assert_called_once_with()
+
+    def test_create_image_raises_build_errors(self):
+        self.cli.build.return_value = [
+            '{"stream": "Step 0 : FROM ubuntu"}',
+            '{"error": "Unknown instruction: RUNN"}']
+
+        self.assertRaises(Exception, create_image, self.cli, self.conf)
+
+    def test_create_image_logs_the_build_output(self):
+        self.cli.build.return_value = [
+            '{"stream": "Step 0 : FROM ubuntu\\n"}',
+            '{"stream": " ---> 5506de2b643b\\n"}']
+        log = Mock()
+        create_image(self.cli, self.conf, log=log)
+
+        assert [args[0][0] for args in log.call_args_list] == [
+            'Step 0 : FROM ubuntu', ' ---> 5506de2b643b']
+
+    def test_job_logger_appends_to_the_job_log(self):
+        redis_cli = Mock()
+        job_logger(redis_cli, 'abc')('Step 0 : FROM ubuntu')
+        job_logger(redis_cli, None)('Step 0 : FROM ubuntu')
+
+        redis_cli.rpush.assert_called_once_with(
+            'dookio:job:abc:log', 'Step 0 : FROM ubuntu')
+
+    def test_context_digest_does_not_depend_on_the_order(self):
+        first = {'a': {'sha1': '1', 'mode': 420},
+                 'b': {'sha1': '2', 'mode': 420}}
+        second = dict(reversed(first.items()))
+
+        assert context_digest(first) == context_digest(second)
+        assert context_digest(first) != context_digest({'a': first['a']})
+
+    def test_build_is_skipped_if_the_image_exists(self):
+        build = Mock()
+        built = build_image_once(self.cli, self.conf, 'abc', build)
+
+        assert built is False
+        assert not build.called
+        self.cli.inspect_image.assert_called_once_with(
+            '{}:abc'.format(self.tag))
+        self.cli.tag.assert_called_once_with(
+            '{}:abc'.format(self.tag), self.tag, tag='latest', force=True)
+
+    def test_find_image(self):
+        assert find_image(self.cli, self.conf, 'abc') == '{}:abc'.format(
+            self.tag)
+
+        self.cli.inspect_image.side_effect = APIError('Not found', Mock())
+        assert find_image(self.cli, self.conf, 'abc') is None
+
+    def test_build_when_the_image_does_not_exist(self):
+        self.cli.inspect_image.side_effect = APIError('Not found', Mock())
+        build = Mock()
+        built = build_image_once(self.cli, self.conf, 'abc', build)
+
+        assert built is True
+        assert build.called
+        self.cli.tag.assert_called_once_with(
+            self.tag, self.tag, tag='abc', force=True)
+
+    def test_image_is_pulled_from_the_registry_instead_of_built(self):
+        registry = 'localhost:5001'
+        remote = '{}/{}'.format(registry, self.tag)
+
+        def inspect_image(image):
+            if image != '{}:abc'.format(remote):
+                raise APIError('Not found', Mock())
+        self.cli.inspect_image.side_effect = inspect_image
+        self.cli.pull.return_value = ['{"status": "Download complete"}']
+        build = Mock()
+        built = build_image_once(self.cli, self.conf, 'abc', build, registry)
+
+        assert built is False
+        assert not build.called
+        self.cli.pull.assert_called_once_with(
+            remote, tag='abc', stream=True, insecure_registry=True)
+        self.cli.tag.assert_any_call(
+            '{}:abc'.format(remote), self.tag, tag='abc', force=True)
+
+    def test_built_images_are_pushed_to_the_registry(self):
+        registry = 'localhost:5001'
+        remote = '{}/{}'.format(registry, self.tag)
+        self.cli.inspect_image.side_effect = APIError('Not found', Mock())
+        self.cli.pull.return_value = [
+            '{"error": "Tag abc not found in repository"}']
+        self.cli.push.return_value = ['{"status": "Pushing tag"}']
+        build = Mock()
+        built = build_image_once(self.cli, self.conf, 'abc', build, registry)
+
+        assert built is True
+        assert build.called
+        self.cli.push.assert_called_once_with(
+            remote, tag='abc', stream=True, insecure_registry=True)
+
+    def test_concurrent_builds_of_the_same_code_are_shared(self):
+        built_images = []
+
+        def inspect_image(image):
+            if image not in built_images:
+                raise APIError('Not found', Mock())
+        self.cli.inspect_image.side_effect = inspect_image
+
+        def build():
+            time.sleep(0.05)
+            built_images.append('{}:abc'.format(self.tag))
+        build = Mock(side_effect=build)
+
+        threads = [threading.Thread(target=build_image_once,
+                                    args=(self.cli, self.conf, 'abc', build))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert build.call_count == 1
+
     def test_remove_image(self):
         expected_image = {
             "RepoTags": [self.tag],
@@ -208,3 +577,113 @@ class NodeUtilsTestSuite(unittest.TestCase):
         remove_image(self.cli, self.conf)
 
         assert not self.cli.remove_image.called
+
+
+class WarmContainersTestSuite(unittest.TestCase):
+    def setUp(self):
+        container_index.invalidate()
+        self.dir = tempfile.mkdtemp()
+        self.pool = WarmPool(os.path.join(self.dir, 'WARM_POOL'))
+        for patcher in [patch('src.utils.warm_pool', self.pool),
+                        patch.object(container_index, 'hidden',
+                                     self.pool.ids)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cli = Mock()
+        self.cli.inspect_image.return_value = {'Id': 'image'}
+        self.conf = {'user': 'git', 'repo': 'apache'}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def warm(self, container_id, port, image='image', paused=False):
+        container = {'Id': container_id, 'port': port, 'image': image,
+                     'paused': paused}
+        self.pool.add('git/apache', container)
+        return container
+
+    @patch('src.utils._reserve_container')
+    def test_refill_starts_the_missing_containers(self, mock_reserve):
+        self.warm('a', 4567)
+        self.cli.containers.return_value = [{'Id': 'a'}]
+        mock_reserve.return_value = {'Id': 'b'}, 4568
+
+        refill_warm_pool(self.cli, {'git/apache': '2'})
+
+        mock_reserve.assert_called_once_with(self.cli, self.conf)
+        assert self.pool.ids() == set(['a', 'b'])
+
+    @patch('src.utils._reserve_container')
+    @patch('src.utils.make_port_available')
+    def test_refill_retires_dead_and_outdated_containers(
+            self, mock_make_port_available, mock_reserve):
+        self.warm('a', 4567)
+        self.warm('b', 4568, image='old')
+        self.cli.containers.return_value = [{'Id': 'b'}]
+        mock_reserve.return_value = {'Id': 'c'}, 4569
+
+        refill_warm_pool(self.cli, {'git/apache': '1'})
+
+        assert self.pool.ids() == set(['c'])
+        self.cli.remove_container.assert_called_with('b', force=True)
+        assert sorted(call[0][0] for call in
+                      mock_make_port_available.call_args_list) == [4567, 4568]
+
+    @patch('src.utils.make_port_available', Mock())
+    def test_refill_retires_the_pool_of_apps_not_warmed_anymore(self):
+        self.warm('a', 4567)
+        self.cli.containers.return_value = [{'Id': 'a'}]
+
+        refill_warm_pool(self.cli, {})
+
+        assert self.pool.apps() == {}
+        self.cli.kill.assert_called_once_with('a')
+
+    @patch('src.utils.make_port_available')
+    def test_refill_does_not_retire_the_containers_claimed_meanwhile(
+            self, mock_make_port_available):
+        self.warm('a', 4567)
+        self.cli.containers.return_value = []
+        snapshot = self.pool.containers('git/apache')
+        # A claim hands it over to the app after the snapshot.
+        self.pool.take('git/apache', 1)
+
+        with patch.object(self.pool, 'containers', return_value=snapshot):
+            refill_warm_pool(self.cli, {'git/apache': '0'})
+
+        assert not self.cli.kill.called
+        assert not mock_make_port_available.called
+
+    def test_warm_containers_are_not_containers_of_the_app(self):
+        self.warm('a', 4567)
+        self.cli.containers.return_value = [
+            {'Id': 'a', 'Names': ['/git_apache_4567']},
+            {'Id': 'b', 'Names': ['/git_apache_4568']}]
+
+        assert get_containers(self.cli, self.conf) == [
+            {'Id': 'b', 'Names': ['/git_apache_4568']}]
+
+    def test_claim_hands_the_containers_over_to_the_app(self):
+        self.warm('a', 4567, paused=True)
+        self.warm('b', 4568)
+
+        claimed = claim_warm_containers(self.cli, self.conf, 1)
+
+        assert claimed == [{'id': 'a', 'port': 4567}]
+        self.cli.unpause.assert_called_once_with('a')
+        assert self.pool.ids() == set(['b'])
+
+    def test_claim_only_containers_of_the_given_digest(self):
+        self.warm('a', 4567, image='old')
+
+        assert claim_warm_containers(self.cli, self.conf, 1, 'abc') == []
+        self.cli.inspect_image.assert_called_once_with('git/apache:abc')
+        assert self.pool.ids() == set(['a'])
+
+    def test_pause_without_pause_in_the_client(self):
+        cli = Mock(spec=['_post', '_url', '_raise_for_status'])
+        pause_container(cli, 'a')
+
+        cli._url.assert_called_once_with('/containers/a/pause')
+        cli._raise_for_status.assert_called_once_with(
+            cli._post.return_value)
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.warm import WarmPool
+
+
+class WarmPoolTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'WARM_POOL')
+        self.pool = WarmPool(self.path)
+        self.first = {'Id': 'a', 'port': 4567, 'image': 'old', 'paused': False}
+        self.second = {'Id': 'b', 'port': 4568, 'image': 'new',
+                       'paused': False}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_containers_are_persisted(self):
+        self.pool.add('git/apache', self.first)
+        self.pool.add('git/nginx', self.second)
+
+        pool = WarmPool(self.path)
+        assert pool.containers('git/apache') == [self.first]
+        assert pool.apps() == {'git/apache': 1, 'git/nginx': 1}
+        assert pool.ids() == set(['a', 'b'])
+
+    def test_take_only_the_given_image(self):
+        self.pool.add('git/apache', self.first)
+        self.pool.add('git/apache', self.second)
+
+        assert self.pool.take('git/apache', 2, 'new') == [self.second]
+        assert self.pool.take('git/apache', 2) == [self.first]
+        assert self.pool.take('git/apache', 2) == []
+        assert self.pool.apps() == {}
+
+    def test_remove(self):
+        self.pool.add('git/apache', self.first)
+        self.pool.add('git/apache', self.second)
+        assert self.pool.remove('git/apache', set(['a'])) == [self.first]
+        assert self.pool.remove('git/apache', set(['a'])) == []
+
+        assert WarmPool(self.path).containers() == [self.second]
@@ -1,49 +1,185 @@
 import os
+import json
+import pipes
+import logging
+import hashlib
+import time
+import threading
+import multiprocessing
+import requests
 
-STARTING_PORT = 4567
-ENDING_PORT = 4700
+from docker.errors import APIError
 
+from .index import ContainerIndex
+from .ports import PortAllocator
+from .resources import ResourceLedger, NoCapacity
+from .warm import WarmPool
+from .metrics import span, app_label
 
-def read_used_ports():
+from shared.keys import NODES_KEY, NODE_KEY, JOB_LOG_KEY
+
+logger = logging.getLogger(__name__)
+
+STARTING_PORT = int(os.environ.get('DOOKIO_PORT_RANGE_START', 4567))
+ENDING_PORT = int(os.environ.get('DOOKIO_PORT_RANGE_END', 32768))
+
+# Bytes read at a time from the code stream.
+CHUNK_SIZE = 64 * 1024
+# Seconds to wait for the server to answer.
+SERVER_TIMEOUT = float(os.environ.get('DOOKIO_SERVER_TIMEOUT', 30))
+
+# Whether the registry used for sharing images talks plain HTTP.
+REGISTRY_INSECURE = os.environ.get(
+    'DOOKIO_REGISTRY_INSECURE', 'true').lower() == 'true'
+
+# Seconds the container index can be served without asking docker.
+CONTAINER_INDEX_TTL = float(os.environ.get('DOOKIO_CONTAINER_INDEX_TTL', 5))
+# Memory (bytes) and CPU shares (1024 per CPU) the limits of the containers
+# can add up to. 0 means all of the memory/CPUs of the machine.
+NODE_MEMORY = int(os.environ.get('DOOKIO_NODE_MEMORY', 0))
+NODE_CPU_SHARES = int(os.environ.get('DOOKIO_NODE_CPU_SHARES', 0))
+
+port_allocator = PortAllocator(STARTING_PORT, ENDING_PORT, 'PORTS_JOURNAL')
+warm_pool = WarmPool('WARM_POOL')
+container_index = ContainerIndex(CONTAINER_INDEX_TTL, hidden=warm_pool.ids)
+
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+
+def read_meminfo(path='/proc/meminfo'):
     """
-    Read the used ports from the USED_PORTS file.
+    Total and available memory of the machine (in bytes).
     """
-    lines = []
-    if os.path.exists("USED_PORTS"):
-        with open('USED_PORTS') as f:
-            lines = [line for line in f]
-            used_ports = [int(line.rstrip()) for line in lines]
-    else:
-        f = open('USED_PORTS', 'w')
-        f.close()
-        used_ports = []
-    return used_ports, lines
+    info = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0]) * 1024
+    except (IOError, ValueError):
+        return 0, 0
+    available = info.get('MemAvailable', info.get('MemFree', 0) +
+                         info.get('Buffers', 0) + info.get('Cached', 0))
+    return info.get('MemTotal', 0), available
+
+
+resource_ledger = ResourceLedger(
+    NODE_MEMORY or read_meminfo()[0],
+    NODE_CPU_SHARES or multiprocessing.cpu_count() * 1024)
+
+
+def capacity_report(cli):
+    """
+    How busy the node is, for the placement decisions of the server.
+    """
+    apps = container_index.all(cli)
+    memory_total, memory_free = read_meminfo()
+    allocated = resource_ledger.allocated()
+    return {
+        'cpus': multiprocessing.cpu_count(),
+        'load': os.getloadavg()[0],
+        'memory_total': memory_total,
+        'memory_free': memory_free,
+        # What the limits of the containers reserve, for the quotas.
+        'memory_allocatable': resource_ledger.capacity['memory'],
+        'memory_allocated': allocated['memory'],
+        'cpu_shares_allocatable': resource_ledger.capacity['cpu_shares'],
+        'cpu_shares_allocated': allocated['cpu_shares'],
+        'free_ports': port_allocator.available(),
+        'containers': sum(len(containers) for containers in apps.values()),
+        'apps': dict((app, len(containers))
+                     for app, containers in apps.iteritems()),
+        # What the server reconciles the desired replicas with.
+        'ports': dict((app, published_ports(containers))
+                      for app, containers in apps.iteritems()),
+        # And the image they run, so the outdated ones are replaced.
+        'images': dict((app, published_images(containers))
+                       for app, containers in apps.iteritems()),
+        # Warm containers that can be claimed when scaling up.
+        'warm': dict((app.replace('/', '_', 1), count)
+                     for app, count in warm_pool.apps().iteritems())
+    }
+
+
+def published_ports(containers):
+    """
+    The public ports of some containers.
+    """
+    return [port.get('PublicPort') for cont in containers
+            for port in cont.get('Ports') or [] if port.get('PublicPort')]
+
+
+def published_images(containers):
+    """
+    The image of some containers, by public port.
+    """
+    return dict((port.get('PublicPort'), cont.get('Image'))
+                for cont in containers
+                for port in cont.get('Ports') or [] if port.get('PublicPort'))
+
+
+def send_heartbeat(redis_cli, address, report, ttl):
+    """
+    Register the node (and its capacity report) in the node registry for
+    the next `ttl` seconds and let the server know right away.
+    """
+    pipe = redis_cli.pipeline()
+    pipe.setex(NODE_KEY.format(address), int(ttl), json.dumps(report))
+    pipe.zadd(NODES_KEY, time.time() + ttl, address)
+    pipe.publish(NODES_KEY, address)
+    pipe.execute()
 
 
 def get_port():
     """
     Assings a 'non-used' port.
     """
-    used_ports, _ = read_used_ports()
-    for port in range(STARTING_PORT, ENDING_PORT):
-        if port not in used_ports:
-            with open('USED_PORTS', 'a') as f:
-                f.write('{}\n'.format(port))
-            return int(port)
-    raise Exception('There are no more available ports!')
+    return port_allocator.allocate()
 
 
 def make_port_available(port):
     """
-    Free up recently used port.
+    Free up recently used port (and the resources of its container).
+    """
+    port_allocator.release(port)
+    resource_ledger.release(port)
+
+
+def reconcile_ports(cli):
     """
-    used_ports, lines = read_used_ports()
-    f = open('AUX_USED_PORTS', 'w')
-    for line in lines:
-        if port != int(line.rstrip()):
-            f.write(line)
-    f.close()
-    os.rename('AUX_USED_PORTS', 'USED_PORTS')
+    Sync the used ports with the ones published by the running containers.
+    """
+    port_allocator.reconcile(published_ports(cli.containers()))
+
+
+def reconcile_resources(cli):
+    """
+    Sync the reserved resources with the limits of the running containers.
+    """
+    reserved = {}
+    for cont in cli.containers():
+        ports = published_ports([cont])
+        if ports:
+            config = cli.inspect_container(cont.get('Id')).get('Config', {})
+            reserved[ports[0]] = {'memory': config.get('Memory'),
+                                  'cpu_shares': config.get('CpuShares')}
+    resource_ledger.reconcile(reserved)
+
+
+def release_dead_ports(cli, grace):
+    """
+    Give back the ports of the containers that died since they were
+    started (allocated more than `grace` seconds ago).
+    """
+    apps = container_index.all(cli)
+    released = port_allocator.release_unpublished(
+        [port for containers in apps.itervalues()
+         for port in published_ports(containers)] +
+        [container['port'] for container in warm_pool.containers()], grace)
+    for port in released:
+        resource_ledger.release(port)
+    return released
 
 
 def _reserve_container(cli, conf):
@@ -52,22 +188,32 @@ def _reserve_container(cli, conf):
     """
     user = conf.get('user')
     repo = conf.get('repo')
-    tag = "{}/{}".format(conf.get('user'), conf.get('repo'))
+    # The "latest" image of the app, unless a given one is asked for.
+    tag = conf.get('image') or "{}/{}".format(user, repo)
 
-    port = get_port()
+    with span('allocate_port', app_label(conf)):
+        port = get_port()
     try:
+        # The limits of the app must fit in what is left in the node.
+        resource_ledger.reserve(port, conf)
         # Create container (at this point only the port 80 will be open)
-        container = cli.create_container(
-            name="{}_{}_{}".format(user, repo, port),
-            image=tag,
-            command="",
-            ports=[80])
+        with span('create_container', app_label(conf)):
+            container = cli.create_container(
+                name="{}_{}_{}".format(user, repo, port),
+                image=tag,
+                command="",
+                ports=[80],
+                mem_limit=conf.get('memory') or 0,
+                cpu_shares=conf.get('cpu_shares') or None)
         # Register new port into file
-        cli.start(container=container.get('Id'), port_bindings={80: port})
+        with span('start_container', app_label(conf)):
+            cli.start(container=container.get('Id'),
+                      port_bindings={80: port})
     except:
         make_port_available(port)
         raise
     else:
+        container_index.invalidate()
         return container, port
 
 
@@ -77,6 +223,8 @@ def create_container(cli, conf):
     """
     try:
         container, port = _reserve_container(cli, conf)
+    except NoCapacity:
+        raise
     except:
         raise Exception(
             'The container could not be create. '
@@ -95,6 +243,8 @@ def start_container(cli, conf):
             'Use "scale" instead.')
     try:
         container, port = _reserve_container(cli, conf)
+    except NoCapacity:
+        raise
     except:
         raise Exception(
             'You cannot start an unexisting app. '
@@ -106,16 +256,22 @@ def start_container(cli, conf):
 def stop_containers(cli, conf):
     """
     Stop and kill containers associated with the user/repo application.
+    If a list of 'ports' is provided only the containers published on them
+    are stopped.
     Note: It doesn't remove the image. So the containers can be recreated
     with easy.
     """
     user = conf.get('user')
     repo = conf.get('repo')
+    only_ports = conf.get('ports')
     exist = False
     containers = get_containers(cli, conf)
     for cont in containers:
-        exist = True
         ports = cont.get('Ports')
+        if only_ports and not any(port.get('PublicPort') in only_ports
+                                  for port in ports):
+            continue
+        exist = True
         for port in ports:
             make_port_available(port.get('PublicPort'))
         cli.kill(cont)
@@ -124,43 +280,332 @@ def stop_containers(cli, conf):
         except:
             # When the container is currently blocked.
             pass
+    container_index.invalidate()
 
     if not exist:
         raise Exception('{}/{} is not running!'.format(user, repo))
 
 
+def pause_container(cli, container_id, pause=True):
+    """
+    Pause (or unpause) a container. Older docker-py clients have no
+    pause(), so the API is called directly.
+    """
+    action = 'pause' if pause else 'unpause'
+    method = getattr(cli, action, None)
+    if method is not None:
+        return method(container_id)
+    response = cli._post(cli._url('/containers/{0}/{1}'.format(
+        container_id, action)))
+    cli._raise_for_status(response)
+
+
+def latest_image_id(cli, conf):
+    """
+    The id of the image new containers of the app are created from (None
+    if it was never built in this node).
+    """
+    try:
+        return cli.inspect_image('{}/{}'.format(
+            conf.get('user'), conf.get('repo'))).get('Id')
+    except APIError:
+        return None
+
+
+def warm_up(cli, conf, image, pause=False):
+    """
+    Start a warm container of the application: it is left out of the
+    containers of the app until it is claimed.
+    """
+    container, port = _reserve_container(cli, conf)
+    if pause:
+        pause_container(cli, container.get('Id'))
+    warm_pool.add(app_label(conf), {'Id': container.get('Id'), 'port': port,
+                                    'image': image, 'paused': pause})
+    container_index.invalidate()
+    return container, port
+
+
+def retire_warm_container(cli, container):
+    """
+    Stop a warm container (already taken out of the warm pool).
+    """
+    try:
+        if container.get('paused'):
+            pause_container(cli, container['Id'], pause=False)
+        cli.kill(container['Id'])
+        cli.remove_container(container['Id'], force=True)
+    except Exception:
+        # It was already gone.
+        pass
+    make_port_available(container['port'])
+
+
+def refill_warm_pool(cli, sizes, pause=False, resources=None):
+    """
+    Keep sizes[user/repo] warm containers of every application, created
+    from its latest image (with the limits of resources[user/repo]). The
+    warm containers that died, are from an older image or are not wanted
+    anymore are stopped.
+    """
+    running = set(cont.get('Id') for cont in cli.containers())
+    for app in set(warm_pool.apps()) | set(sizes):
+        user, repo = app.split('/', 1)
+        conf = {'user': user, 'repo': repo}
+        if resources and resources.get(app):
+            conf.update(json.loads(resources[app]))
+        size = int(sizes.get(app, 0))
+        image = latest_image_id(cli, conf) if size else None
+        containers = warm_pool.containers(app)
+        keep = [container for container in containers
+                if container['Id'] in running and
+                container.get('image') == image][:size]
+        retired = [container for container in containers
+                   if container not in keep]
+        if retired:
+            # Only the ones still in the pool: a claim may have handed some
+            # over to the app since the snapshot.
+            for container in warm_pool.remove(
+                    app, set(container['Id'] for container in retired)):
+                retire_warm_container(cli, container)
+        if image:
+            for _ in range(size - len(keep)):
+                with span('warm_up', app):
+                    warm_up(cli, conf, image, pause)
+
+
+def claim_warm_containers(cli, conf, count, digest=None):
+    """
+    Hand up to `count` warm containers of the application (of the image of
+    the context digest, if given) over to the app. Returns their id and
+    port.
+    """
+    image = None
+    if digest:
+        try:
+            image = cli.inspect_image('{}/{}:{}'.format(
+                conf.get('user'), conf.get('repo'), digest)).get('Id')
+        except APIError:
+            return []
+    claimed = []
+    for container in warm_pool.take(app_label(conf), count, image):
+        if container.get('paused'):
+            try:
+                pause_container(cli, container['Id'], pause=False)
+            except Exception:
+                retire_warm_container(cli, container)
+                continue
+        claimed.append({'id': container['Id'], 'port': container['port']})
+    container_index.invalidate()
+    return claimed
+
+
 def get_containers(cli, conf):
     """
     Get all the active containers for a certain user/repo application.
     """
-    user = conf.get('user')
-    repo = conf.get('repo')
+    return container_index.get(cli, conf.get('user'), conf.get('repo'))
 
-    containers = []
-    for cont in cli.containers():
-        # The full application name.
-        name = cont.get('Names')[0]
-        # The containers name: e.g /git_apache_4567 (With /)).
-        clean_name = name[1:len(name) - 5]
-        if '{}_{}'.format(user, repo) == clean_name:
-            containers.append(cont)
-    return containers
+
+def fetch_manifest(server_url, conf):
+    """
+    Get the manifest (path -> content digest) of the code pushed for the
+    user/repo application.
+    """
+    with span('fetch_manifest', app_label(conf)):
+        response = requests.get(
+            '{}/manifest'.format(server_url),
+            params={'user': conf.get('user'), 'repo': conf.get('repo')},
+            timeout=SERVER_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
 
 
-def create_image(cli, conf):
+def fetch_code(ssh, conf, paths):
+    """
+    Stream some files of the application from the server as a gzipped
+    tar, without writing anything to disk on the server.
     """
-    Create an image for the application.
+    remote_path = conf.get('remote_path')
+    stdin, stdout, stderr = ssh.exec_command(
+        'tar -C {} -cz --null -T -'.format(
+            pipes.quote('{}/code'.format(remote_path))))
+    stdin.write('\0'.join(paths))
+    stdin.channel.shutdown_write()
+    return stdout
+
+
+def iter_chunks(fileobj):
+    """
+    Read a file-like object in CHUNK_SIZE pieces (and close it at the end).
+    """
+    try:
+        for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), ''):
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+def create_image(cli, conf, context=None, encoding=None, log=None):
+    """
+    Create an image for the application. The build context is either the
+    'local_path' directory or an iterable of tar chunks. The output of the
+    build is also handed to log() line by line.
     """
     local_path = conf.get('local_path')
     tag = "{}/{}".format(conf.get('user'), conf.get('repo'))
 
     # Build docker image
-    image = cli.build(path=local_path, tag=tag)
-    for instruction in image:
-        print instruction
+    with span('build', app_label(conf)):
+        if context is None:
+            image = cli.build(path=local_path, tag=tag)
+        else:
+            image = cli.build(fileobj=context, custom_context=True,
+                              encoding=encoding, tag=tag)
+        for instruction in image:
+            logger.debug('%s', instruction)
+            if log:
+                for line in build_output(instruction).splitlines():
+                    log(line)
+            error = build_error(instruction)
+            if error:
+                raise Exception(error)
     return image
 
 
+def build_error(instruction):
+    """
+    The error reported by a build instruction (if any).
+    """
+    try:
+        return json.loads(instruction).get('error')
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def build_output(instruction):
+    """
+    The text printed by a build instruction.
+    """
+    try:
+        message = json.loads(instruction)
+    except (TypeError, ValueError):
+        return str(instruction)
+    if not isinstance(message, dict):
+        return str(instruction)
+    return (message.get('stream') or message.get('status') or
+            message.get('error') or '')
+
+
+def job_logger(redis_cli, job):
+    """
+    A log() that appends the lines to the log of the deploy job (if any),
+    so the client that pushed the code can follow the build.
+    """
+    def log(line):
+        if not job:
+            return
+        try:
+            redis_cli.rpush(JOB_LOG_KEY.format(job), line)
+        except Exception, e:
+            logger.warning('The job log could not be written: %s', e)
+    return log
+
+
+def context_digest(manifest):
+    """
+    Digest that identifies a build context (its manifest).
+    """
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+
+def image_exists(cli, image):
+    try:
+        cli.inspect_image(image)
+    except APIError:
+        return False
+    return True
+
+
+def pull_image(cli, registry, tag, digest):
+    """
+    Try to pull the image of a context digest from the registry (and tag it
+    as a local image). Returns whether it was there.
+    """
+    remote = '{}/{}'.format(registry, tag)
+    try:
+        with span('pull_image', tag):
+            for line in cli.pull(remote, tag=digest, stream=True,
+                                 insecure_registry=REGISTRY_INSECURE):
+                if build_error(line):
+                    return False
+    except Exception:
+        # No registry, or no image for that digest.
+        return False
+    if not image_exists(cli, '{}:{}'.format(remote, digest)):
+        return False
+    cli.tag('{}:{}'.format(remote, digest), tag, tag=digest, force=True)
+    return True
+
+
+def push_image(cli, registry, tag, digest):
+    """
+    Push the image of a context digest to the registry, so the rest of the
+    nodes can pull it instead of building it.
+    """
+    remote = '{}/{}'.format(registry, tag)
+    cli.tag('{}:{}'.format(tag, digest), remote, tag=digest, force=True)
+    with span('push_image', tag):
+        for line in cli.push(remote, tag=digest, stream=True,
+                             insecure_registry=REGISTRY_INSECURE):
+            error = build_error(line)
+            if error:
+                raise Exception(error)
+
+
+def find_image(cli, conf, digest, registry=None):
+    """
+    The image of the application for a context digest, pulled from the
+    registry (if any) when it is not in the node. None if there is none.
+    """
+    tag = "{}/{}".format(conf.get('user'), conf.get('repo'))
+    digest_tag = '{}:{}'.format(tag, digest)
+    if (image_exists(cli, digest_tag) or
+            (registry and pull_image(cli, registry, tag, digest))):
+        return digest_tag
+    return None
+
+
+def build_image_once(cli, conf, digest, build, registry=None):
+    """
+    Call build() only if there is no image of the application for that
+    context digest yet, neither locally nor in the registry (if any).
+    Builds of the same application are serialized, so concurrent deploys of
+    the same code wait for the first build instead of building it again.
+    Returns whether the image was built.
+    """
+    tag = "{}/{}".format(conf.get('user'), conf.get('repo'))
+    digest_tag = '{}:{}'.format(tag, digest)
+
+    with _build_locks_lock:
+        lock = _build_locks.setdefault(tag, threading.Lock())
+    with lock:
+        if (image_exists(cli, digest_tag) or
+                (registry and pull_image(cli, registry, tag, digest))):
+            # The containers are created from the "latest" image.
+            cli.tag(digest_tag, tag, tag='latest', force=True)
+            return False
+        build()
+        cli.tag(tag, tag, tag=digest, force=True)
+        if registry:
+            try:
+                push_image(cli, registry, tag, digest)
+            except Exception, e:
+                # The image is still usable in this node.
+                logger.warning('The image could not be pushed: %s', e)
+        return True
+
+
 def remove_image(cli, conf):
     """
     Remove the image for the user/repo application.
@@ -0,0 +1,103 @@
+import os
+import json
+import threading
+
+
+class WarmPool(object):
+    """
+    The warm containers of the node: already started (maybe paused)
+    containers of an application that are not routed yet, so scaling up
+    only needs to route them.
+
+    The pool is kept in a JSON file (user_repo -> list of {"Id", "port",
+    "image", "paused"}), written atomically on every change, so the warm
+    containers are still known after a restart.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._apps = None
+
+    def _load(self):
+        if self._apps is not None:
+            return
+        self._apps = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self._apps = json.load(f)
+
+    def _save(self):
+        aux_path = '{}.aux'.format(self.path)
+        with open(aux_path, 'w') as f:
+            json.dump(self._apps, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(aux_path, self.path)
+
+    def add(self, app, container):
+        with self._lock:
+            self._load()
+            self._apps.setdefault(app, []).append(container)
+            self._save()
+
+    def take(self, app, count, image=None):
+        """
+        Remove (and return) up to `count` warm containers of the app, only
+        of the given image id if there is one.
+        """
+        with self._lock:
+            self._load()
+            containers = self._apps.get(app, [])
+            taken = [container for container in containers
+                     if image is None or container.get('image') == image]
+            taken = taken[:count]
+            if taken:
+                self._apps[app] = [container for container in containers
+                                   if container not in taken]
+                if not self._apps[app]:
+                    del self._apps[app]
+                self._save()
+            return taken
+
+    def remove(self, app, ids):
+        """
+        Remove (and return) the warm containers of the app with those ids
+        that are still in the pool (not taken meanwhile).
+        """
+        with self._lock:
+            self._load()
+            containers = self._apps.get(app, [])
+            removed = [container for container in containers
+                       if container['Id'] in ids]
+            if removed:
+                containers = [container for container in containers
+                              if container not in removed]
+                if containers:
+                    self._apps[app] = containers
+                else:
+                    del self._apps[app]
+                self._save()
+            return removed
+
+    def containers(self, app=None):
+        """
+        The warm containers of an app (or of every app).
+        """
+        with self._lock:
+            self._load()
+            if app is not None:
+                return list(self._apps.get(app, []))
+            return [container for containers in self._apps.itervalues()
+                    for container in containers]
+
+    def apps(self):
+        with self._lock:
+            self._load()
+            return dict((app, len(containers))
+                        for app, containers in self._apps.iteritems())
+
+    def ids(self):
+        """
+        The ids of every warm container (left out of the container index).
+        """
+        return set(container['Id'] for container in self.containers())
@@ -15,5 +15,5 @@ docker rmi $(docker images -q --filter "dangling=true")
 # Kill node and server.
 sudo pkill python
 
-# Remove used ports file.
-rm USED_PORTS
+# Remove the used ports journal.
+rm PORTS_JOURNAL
@@ -2,3 +2,56 @@
 # e.g http://blabla.com
 # In the end, your urls will look like e.g. http://app1.blabla.com
 export DOOKIO_DOMAIN="localhost"
+# Seconds to wait for a node before reporting it as unreachable.
+export DOOKIO_NODE_TIMEOUT="30"
+# Replicas built/started at the same time during a deploy.
+export DOOKIO_DEPLOY_CONCURRENCY="5"
+# Seconds to wait for a node to build and start a replica. The node gives up
+# on it (and stops its container) DOOKIO_DEPLOY_DEADLINE_MARGIN seconds
+# earlier, so no container is left running without a route.
+export DOOKIO_DEPLOY_TIMEOUT="600"
+export DOOKIO_DEPLOY_DEADLINE_MARGIN="30"
+# "recreate" (the default) stops the old containers before building the new
+# ones, "rolling" keeps them serving until the new ones are healthy.
+export DOOKIO_DEPLOY_MODE="recreate"
+# Threads health checking the new containers of the rolling deploys.
+export DOOKIO_HEALTH_CHECK_WORKERS="20"
+# Where the receiver stores the pushed code (<root>/<user>/<repo>/code).
+export DOOKIO_CODE_ROOT="/home"
+# Registry used by the nodes for sharing images e.g 123.123.123.1:5001
+# export DOOKIO_REGISTRY=""
+# How new containers are placed: least_loaded, spread or binpack.
+export DOOKIO_SCHEDULER="spread"
+# Apps per page of /apps?page=N (every app is listed if no page is given).
+export DOOKIO_APPS_PER_PAGE="100"
+# Threads answering requests (deploys hold one until they are done).
+export DOOKIO_WORKERS="16"
+# Seconds given to the in-flight requests to finish on shutdown.
+export DOOKIO_SHUTDOWN_TIMEOUT="30"
+# Deploy jobs running at the same time (one at a time per app).
+export DOOKIO_JOB_WORKERS="10"
+# Seconds between two health checks of every routed container. Containers
+# failing DOOKIO_HEALTH_FALL checks in a row stop being routed until they
+# pass DOOKIO_HEALTH_RISE checks in a row.
+export DOOKIO_HEALTH_INTERVAL="2"
+export DOOKIO_HEALTH_FALL="2"
+export DOOKIO_HEALTH_RISE="2"
+# Seconds between two comparisons of the replicas every app should have
+# with the ones the nodes report (missing replicas are started again).
+export DOOKIO_RECONCILE_INTERVAL="10"
+# The apps with an autoscaling policy (see /autoscale) are scaled every
+# DOOKIO_AUTOSCALE_INTERVAL seconds with the requests Hipache logged in the
+# last DOOKIO_AUTOSCALE_WINDOW seconds, and left alone for a cooldown after
+# being scaled up (or down).
+export DOOKIO_ACCESS_LOG="/tmp/access.log"
+export DOOKIO_AUTOSCALE_INTERVAL="10"
+export DOOKIO_AUTOSCALE_WINDOW="60"
+export DOOKIO_AUTOSCALE_TOLERANCE="0.1"
+export DOOKIO_SCALE_UP_COOLDOWN="60"
+export DOOKIO_SCALE_DOWN_COOLDOWN="300"
+# Seconds between two reads of the access log for /stats, the relative
+# error of its latency percentiles and the seconds an app or backend is kept
+# in it after its last request.
+export DOOKIO_STATS_INTERVAL="10"
+export DOOKIO_SKETCH_ACCURACY="0.01"
+export DOOKIO_STATS_MAX_AGE="604800"
@@ -1,6 +1,29 @@
+import logging
+
+import redis
+
 from src.server import application
+from src.utils import start_cluster_monitor
+from src.routing import rebuild_app_index
+from src.jobs import fail_interrupted_jobs
+from src.health import start_health_monitor
+from src.reconciler import start_reconciler
+from src.autoscaler import start_autoscaler
+from src.analytics import start_stats_collector
+
+from shared.serving import serve
 
 
 if __name__ == '__main__':
-    from werkzeug.serving import run_simple
-    run_simple('0.0.0.0', 8000, application)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    redis_cli = redis.StrictRedis(host='localhost', port=6379, db=0)
+    rebuild_app_index(redis_cli)
+    fail_interrupted_jobs(redis_cli)
+    start_cluster_monitor()
+    start_health_monitor()
+    start_reconciler()
+    start_autoscaler()
+    start_stats_collector()
+    serve(application, '0.0.0.0', 8000)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules shared by the server and the node live in the repo root.
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '..'))
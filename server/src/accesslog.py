@@ -0,0 +1,111 @@
+import io
+import os
+import re
+
+# Where Hipache writes every request (see hipache/config.json).
+ACCESS_LOG = os.environ.get('DOOKIO_ACCESS_LOG', '/tmp/access.log')
+
+# <remote> - - [<date>] "<request>" <status> <bytes> "<referer>" "<agent>"
+# "<host>" <total time> <backend time> "<backend>", times in seconds. The
+# fields after the agent are left out by some versions, so they are
+# optional.
+LINE = re.compile(
+    r'^\S+ \S+ \S+ \[(?P<date>[^\]]*)\] "[^"]*" (?P<status>\d{3}) \S+ '
+    r'"[^"]*" "[^"]*"'
+    r'(?: "(?P<host>[^"]*)")?'
+    r'(?: (?P<total>[\d.]+))?'
+    r'(?: (?P<upstream>[\d.]+))?'
+    r'(?: "(?P<backend>[^"]*)")?')
+
+
+def parse_line(line):
+    """
+    The frontend (host without the port), date, status, total/upstream
+    time and backend (None if not logged) of a line of the access log. None
+    if the line can't be parsed or has no host.
+    """
+    match = LINE.match(line)
+    if match is None or not match.group('host'):
+        return None
+    total = match.group('total')
+    upstream = match.group('upstream')
+    return {
+        'frontend': match.group('host').split(':', 1)[0].lower(),
+        'date': match.group('date'),
+        'status': int(match.group('status')),
+        'total': float(total) if total else None,
+        'upstream': float(upstream) if upstream else None,
+        'backend': match.group('backend') or None
+    }
+
+
+class LogTailer(object):
+    """
+    Read the lines appended to a log since the last read, following it when
+    it is rotated (a new file in its path) or truncated.
+
+    The position is the (inode, offset) of the next line to read, so it can
+    be saved and the reads resumed later. Without a position, reads start at
+    the end of the log (and with (None, 0), at its start).
+    """
+    def __init__(self, path, position=None):
+        self.path = path
+        self.inode, self.offset = position or (None, None)
+        self._file = None
+        self._partial = ''
+
+    @property
+    def position(self):
+        return self.inode, self.offset
+
+    def _open(self, stat):
+        if self._file is not None:
+            self._file.close()
+        # Unlike open(), io.open() files see the data appended after EOF.
+        self._file = io.open(self.path, 'rb')
+        if self.offset is None:
+            # Nothing read yet: tail the log.
+            self.offset = stat.st_size
+        elif self.inode != stat.st_ino or stat.st_size < self.offset:
+            # Another file (or the same one truncated) since the position.
+            self.offset = 0
+        self.inode = stat.st_ino
+        self._file.seek(self.offset)
+        self._partial = ''
+
+    def _drain(self, max_bytes=-1):
+        data = self._file.read(max_bytes)
+        if not data:
+            return []
+        lines = (self._partial + data).split('\n')
+        # The last line is not complete until it ends in a new line.
+        self._partial = lines.pop()
+        self.offset += sum(len(line) + 1 for line in lines)
+        return lines
+
+    def read(self, max_bytes=16 * 1024 * 1024):
+        """
+        The complete lines appended since the last read (at most about
+        `max_bytes` of them).
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            # Rotated and not created again yet.
+            if self._file is None:
+                return []
+            return self._drain(max_bytes)
+        lines = []
+        if self._file is not None and self.inode != stat.st_ino:
+            # Rotated: finish the old file before following the new one.
+            lines.extend(self._drain())
+            self._open(stat)
+        elif self._file is None or stat.st_size < self.offset:
+            self._open(stat)
+        lines.extend(self._drain(max_bytes))
+        return lines
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,301 @@
+import os
+import json
+import math
+import time
+import calendar
+import logging
+import threading
+import email.utils
+import redis
+
+from src.accesslog import ACCESS_LOG, LogTailer, parse_line
+from src.metrics import span
+
+logger = logging.getLogger(__name__)
+
+# The access stats of every app and backend (JSON), with the position of the
+# access log they were read up to.
+ACCESS_STATS_KEY = 'dookio:access_stats'
+
+# Seconds between two reads of the access log.
+STATS_INTERVAL = float(os.environ.get('DOOKIO_STATS_INTERVAL', 10))
+# Seconds the stats of an app or backend are kept after its last request,
+# so the ones removed don't pile up.
+STATS_MAX_AGE = float(os.environ.get('DOOKIO_STATS_MAX_AGE', 7 * 24 * 60 * 60))
+# Relative error of the latency percentiles (0.01 is 1%).
+SKETCH_ACCURACY = float(os.environ.get('DOOKIO_SKETCH_ACCURACY', 0.01))
+# Latencies under this many seconds are counted as 0.
+MIN_LATENCY = 1e-6
+
+QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+
+class LatencySketch(object):
+    """
+    Latencies in logarithmic buckets: every bucket holds the values within
+    SKETCH_ACCURACY of its middle, so any quantile is that accurate and the
+    number of buckets only grows with the log of the range of the values
+    (about 1100 from 1us to 1h at 1%). Sketches of the same accuracy merge
+    by adding their buckets.
+    """
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        # bucket index -> count (values in (gamma^(i-1), gamma^i])
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value < MIN_LATENCY:
+            self.zeros += count
+        else:
+            index = int(math.ceil(math.log(value) / self._log_gamma))
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        The value under which a `q` fraction of the values are (None if
+        there are none).
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {'accuracy': self.accuracy, 'zeros': self.zeros,
+                'buckets': self.buckets}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['accuracy'])
+        for index, count in data['buckets'].iteritems():
+            sketch.buckets[int(index)] = count
+        sketch.zeros = data['zeros']
+        sketch.count = sketch.zeros + sum(sketch.buckets.itervalues())
+        return sketch
+
+
+class Traffic(object):
+    """
+    Requests, server errors, latencies and first/last request time of an
+    app or a backend.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.first = None
+        self.last = None
+        self.latency = LatencySketch()
+
+    def add(self, request, when):
+        self.requests += 1
+        if request['status'] >= 500:
+            self.errors += 1
+        if when is not None:
+            self.first = min(self.first or when, when)
+            self.last = max(self.last, when)
+        latency = request['upstream']
+        if latency is None:
+            latency = request['total']
+        if latency is not None:
+            self.latency.add(latency)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        firsts = [first for first in (self.first, other.first) if first]
+        self.first = min(firsts) if firsts else None
+        self.last = max(self.last, other.last)
+        self.latency.merge(other.latency)
+
+    def summary(self):
+        """
+        Requests, throughput (requests per second between the first and the
+        last one), 5xx rate and latency percentiles (in seconds).
+        """
+        elapsed = (self.last - self.first) if self.first else 0
+        summary = {
+            'requests': self.requests,
+            'rps': self.requests / float(max(elapsed, 1)),
+            'error_rate': self.errors / float(max(self.requests, 1))
+        }
+        for name, q in QUANTILES:
+            summary[name] = self.latency.quantile(q)
+        return summary
+
+    def to_dict(self):
+        return {'requests': self.requests, 'errors': self.errors,
+                'first': self.first, 'last': self.last,
+                'latency': self.latency.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        traffic = cls()
+        traffic.requests = data['requests']
+        traffic.errors = data['errors']
+        traffic.first = data['first']
+        traffic.last = data['last']
+        traffic.latency = LatencySketch.from_dict(data['latency'])
+        return traffic
+
+
+def parse_date(value, _cache={}):
+    """
+    The timestamp of a date of the access log (RFC 1123 or common log
+    format). The dates of a second in a row are the same string, so the
+    last one is cached.
+    """
+    if value in _cache:
+        return _cache[value]
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is not None:
+        when = email.utils.mktime_tz(parsed)
+    else:
+        try:
+            when = calendar.timegm(time.strptime(
+                value.split(' ')[0], '%d/%b/%Y:%H:%M:%S'))
+        except ValueError:
+            when = None
+    _cache.clear()
+    _cache[value] = when
+    return when
+
+
+class AccessStats(object):
+    """
+    The traffic of every app (frontend) and backend in the access log, read
+    incrementally from `position` (see LogTailer). Memory only grows with
+    the number of apps and backends, not with the requests.
+    """
+    def __init__(self, position=(None, 0)):
+        self.position = position
+        self.apps = {}
+        self.backends = {}
+
+    def add(self, request):
+        when = parse_date(request['date'])
+        if request['frontend'] not in self.apps:
+            self.apps[request['frontend']] = Traffic()
+        self.apps[request['frontend']].add(request, when)
+        if request['backend']:
+            if request['backend'] not in self.backends:
+                self.backends[request['backend']] = Traffic()
+            self.backends[request['backend']].add(request, when)
+
+    def update(self, tailer):
+        """
+        Count the requests read by the tailer of the log (following the
+        position of the stats). Returns how many lines were read.
+        """
+        lines = tailer.read()
+        for line in lines:
+            request = parse_line(line)
+            if request is not None:
+                self.add(request)
+        self.position = tailer.position
+        return len(lines)
+
+    def prune(self, before):
+        """
+        Forget the apps and backends without requests since `before` (or
+        without a known date). Returns how many were forgotten.
+        """
+        pruned = 0
+        for traffics in (self.apps, self.backends):
+            for key, traffic in traffics.items():
+                if traffic.last is None or traffic.last < before:
+                    del traffics[key]
+                    pruned += 1
+        return pruned
+
+    def merge(self, other):
+        for mine, theirs in ((self.apps, other.apps),
+                             (self.backends, other.backends)):
+            for key, traffic in theirs.iteritems():
+                mine.setdefault(key, Traffic()).merge(traffic)
+
+    def report(self):
+        return {
+            'apps': dict((app, traffic.summary())
+                         for app, traffic in self.apps.iteritems()),
+            'backends': dict((backend, traffic.summary())
+                             for backend, traffic in
+                             self.backends.iteritems())
+        }
+
+    def to_dict(self):
+        return {
+            'position': list(self.position),
+            'apps': dict((app, traffic.to_dict())
+                         for app, traffic in self.apps.iteritems()),
+            'backends': dict((backend, traffic.to_dict())
+                             for backend, traffic in
+                             self.backends.iteritems())
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(tuple(data['position']))
+        stats.apps = dict((app, Traffic.from_dict(traffic))
+                          for app, traffic in data['apps'].iteritems())
+        stats.backends = dict((backend, Traffic.from_dict(traffic))
+                              for backend, traffic in
+                              data['backends'].iteritems())
+        return stats
+
+
+def load_stats(redis_cli):
+    data = redis_cli.get(ACCESS_STATS_KEY)
+    if data:
+        return AccessStats.from_dict(json.loads(data))
+    return AccessStats()
+
+
+def save_stats(redis_cli, stats):
+    redis_cli.set(ACCESS_STATS_KEY, json.dumps(stats.to_dict()))
+
+
+def start_stats_collector(path=ACCESS_LOG):
+    """
+    Keep the access stats in Redis up to date from a background thread,
+    resuming from where the last one stopped reading.
+    """
+    redis_cli = redis.StrictRedis(host='localhost', port=6379, db=0)
+
+    def collect():
+        stats = tailer = None
+        while True:
+            try:
+                if stats is None:
+                    stats = load_stats(redis_cli)
+                    tailer = LogTailer(path, stats.position)
+                with span('access_stats'):
+                    read = stats.update(tailer)
+                    pruned = stats.prune(time.time() - STATS_MAX_AGE)
+                    if read or pruned:
+                        save_stats(redis_cli, stats)
+            except Exception:
+                logger.exception('The access stats could not be updated')
+            time.sleep(STATS_INTERVAL)
+
+    thread = threading.Thread(target=collect)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,245 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+import collections
+import redis
+import requests
+
+from src.accesslog import ACCESS_LOG, LogTailer, parse_line
+from src.reconciler import all_desired
+from src.metrics import span, app_label
+
+logger = logging.getLogger(__name__)
+
+# Hash of <user>/<repo> -> autoscaling policy of the application (JSON):
+# its address, the min/max replicas, the requests per second a replica
+# should take and optionally the upstream latency it should keep.
+AUTOSCALE_KEY = 'dookio:autoscale'
+
+# Seconds between two reads of the access log (and scaling decisions).
+AUTOSCALE_INTERVAL = float(os.environ.get('DOOKIO_AUTOSCALE_INTERVAL', 10))
+# Seconds of traffic the request rate and latency are averaged over.
+AUTOSCALE_WINDOW = float(os.environ.get('DOOKIO_AUTOSCALE_WINDOW', 60))
+# How far (as a fraction) the load can be from the target before scaling,
+# so an app doesn't flap around it.
+AUTOSCALE_TOLERANCE = float(
+    os.environ.get('DOOKIO_AUTOSCALE_TOLERANCE', 0.1))
+# Seconds an app is left alone after being scaled up (or down).
+SCALE_UP_COOLDOWN = float(os.environ.get('DOOKIO_SCALE_UP_COOLDOWN', 60))
+SCALE_DOWN_COOLDOWN = float(
+    os.environ.get('DOOKIO_SCALE_DOWN_COOLDOWN', 300))
+# The server whose /scale is called.
+AUTOSCALE_SERVER = os.environ.get('DOOKIO_AUTOSCALE_SERVER',
+                                  'http://localhost:8000')
+
+
+def set_policy(redis_cli, conf, minimum, maximum, rps, latency=None):
+    """
+    Scale the application between `minimum` and `maximum` replicas, so
+    every replica takes about `rps` requests per second (and, if given,
+    answers in about `latency` seconds).
+    """
+    redis_cli.hset(AUTOSCALE_KEY, app_label(conf), json.dumps({
+        'user': conf.get('user'),
+        'repo': conf.get('repo'),
+        'application_address': conf.get('application_address'),
+        'min': minimum,
+        'max': maximum,
+        'rps': rps,
+        'latency': latency
+    }))
+
+
+def remove_policy(redis_cli, conf):
+    return redis_cli.hdel(AUTOSCALE_KEY, app_label(conf))
+
+
+def all_policies(redis_cli):
+    return [json.loads(policy)
+            for policy in redis_cli.hgetall(AUTOSCALE_KEY).itervalues()]
+
+
+def desired_replicas(replicas, rate, latency, policy):
+    """
+    The replicas the app needs for `rate` requests per second answered in
+    `latency` seconds (None if unknown), within the min/max of the policy.
+    Loads within AUTOSCALE_TOLERANCE of the target keep the replicas.
+    """
+    load = rate / (max(replicas, 1) * float(policy['rps']))
+    if policy.get('latency') and latency is not None:
+        load = max(load, latency / float(policy['latency']))
+    desired = replicas
+    if abs(load - 1) > AUTOSCALE_TOLERANCE:
+        desired = int(math.ceil(max(replicas, 1) * load))
+    return min(max(desired, policy['min']), policy['max'])
+
+
+class SlidingWindow(object):
+    """
+    The requests (and their upstream time) seen in the last `span` seconds,
+    in one bucket per read of the log.
+    """
+    def __init__(self, span):
+        self.span = span
+        self._buckets = collections.deque()
+
+    def add(self, now, hits, upstream, timed):
+        self._buckets.append((now, hits, upstream, timed))
+
+    def _expire(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.span:
+            self._buckets.popleft()
+
+    def rate(self, now, elapsed):
+        """
+        Requests per second (over the span, or the `elapsed` seconds of it
+        if it didn't fill up yet).
+        """
+        self._expire(now)
+        hits = sum(bucket[1] for bucket in self._buckets)
+        return hits / max(min(self.span, elapsed), 1.0)
+
+    def latency(self, now):
+        """
+        Mean upstream time of the requests (None if none was timed).
+        """
+        self._expire(now)
+        timed = sum(bucket[3] for bucket in self._buckets)
+        if not timed:
+            return None
+        return sum(bucket[2] for bucket in self._buckets) / timed
+
+
+class Autoscaler(object):
+    """
+    Tail the access log of Hipache, keep the request rate and upstream
+    latency of every frontend over a sliding window and scale the apps
+    with a policy (through /scale) when their load leaves the target.
+    """
+    def __init__(self, redis_cli, path=ACCESS_LOG, window=AUTOSCALE_WINDOW):
+        self.redis_cli = redis_cli
+        self.tailer = LogTailer(path)
+        self.window = window
+        self.started = time.time()
+        # frontend -> SlidingWindow
+        self._windows = {}
+        # address -> time of the last scale asked for
+        self._scaled = {}
+
+    def collect(self, now):
+        """
+        Add the requests logged since the last read to the windows of their
+        frontends. Returns how many lines were read.
+        """
+        counts = {}
+        lines = self.tailer.read()
+        for line in lines:
+            request = parse_line(line)
+            if request is None:
+                continue
+            count = counts.setdefault(request['frontend'], [0, 0.0, 0])
+            count[0] += 1
+            if request['upstream'] is not None:
+                count[1] += request['upstream']
+                count[2] += 1
+        for frontend, (hits, upstream, timed) in counts.iteritems():
+            if frontend not in self._windows:
+                self._windows[frontend] = SlidingWindow(self.window)
+            self._windows[frontend].add(now, hits, upstream, timed)
+        return len(lines)
+
+    def cooling_down(self, state, desired, now):
+        """
+        Was the app deployed or scaled (by anyone) too recently to scale it
+        towards `desired` replicas?
+        """
+        last = max(state['updated'],
+                   self._scaled.get(state['application_address'], 0))
+        if desired > state['replicas']:
+            return now - last < SCALE_UP_COOLDOWN
+        return now - last < SCALE_DOWN_COOLDOWN
+
+    def decide(self, now):
+        """
+        The (policy, replicas, desired replicas) of the apps to scale.
+        """
+        states = dict((state['application_address'], state)
+                      for state in all_desired(self.redis_cli))
+        decisions = []
+        for policy in all_policies(self.redis_cli):
+            address = policy['application_address']
+            if address not in states:
+                # Not deployed (or stopped).
+                continue
+            rate, latency = 0, None
+            if address in self._windows:
+                rate = self._windows[address].rate(now, now - self.started)
+                latency = self._windows[address].latency(now)
+            replicas = states[address]['replicas']
+            try:
+                desired = desired_replicas(replicas, rate, latency, policy)
+            except Exception:
+                # A broken policy doesn't keep the other apps from scaling.
+                logger.exception('The autoscaling policy of %s is invalid',
+                                 address)
+                continue
+            if desired != replicas and not self.cooling_down(
+                    states[address], desired, now):
+                decisions.append((policy, replicas, desired))
+        return decisions
+
+    def scale(self, policy, replicas):
+        """
+        Ask the server to scale the app (the job is queued, not waited for).
+        """
+        response = requests.get(
+            '{}/scale'.format(AUTOSCALE_SERVER),
+            params={'user': policy['user'], 'repo': policy['repo'],
+                    'multiplicator': replicas, 'async': 1},
+            timeout=AUTOSCALE_INTERVAL)
+        return response.status_code == 202
+
+    def tick(self):
+        """
+        Read the log and scale the apps that need it. Returns the (address,
+        replicas) of the apps scaled.
+        """
+        now = time.time()
+        scaled = []
+        with span('autoscale'):
+            self.collect(now)
+            for policy, replicas, desired in self.decide(now):
+                address = policy['application_address']
+                if self.scale(policy, desired):
+                    logger.info('Scaling %s from %s to %s replicas',
+                                address, replicas, desired)
+                    self._scaled[address] = now
+                    scaled.append((address, desired))
+        # Frontends without traffic nor policy are not kept forever.
+        for frontend, window in self._windows.items():
+            if window.rate(now, now - self.started) == 0:
+                del self._windows[frontend]
+        return scaled
+
+    def run(self):
+        while True:
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('The apps could not be autoscaled')
+            time.sleep(AUTOSCALE_INTERVAL)
+
+
+def start_autoscaler():
+    """
+    Autoscale the apps with a policy from a background thread.
+    """
+    autoscaler = Autoscaler(
+        redis.StrictRedis(host='localhost', port=6379, db=0))
+    thread = threading.Thread(target=autoscaler.run)
+    thread.daemon = True
+    thread.start()
+    return autoscaler
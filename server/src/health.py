@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+import threading
+import redis
+import requests
+
+from multiprocessing.pool import ThreadPool
+
+from src.routing import (APPS_KEY,
+                         NAMES_KEY,
+                         evicted_key,
+                         evict_backend,
+                         readmit_backend,
+                         forget_backends)
+from src.metrics import span
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two rounds of health checks of the routed backends.
+HEALTH_INTERVAL = float(os.environ.get('DOOKIO_HEALTH_INTERVAL', 2))
+# Seconds a backend has to answer a health check.
+PROBE_TIMEOUT = float(os.environ.get('DOOKIO_HEALTH_PROBE_TIMEOUT', 1))
+# Consecutive failed checks before a backend is taken out of the routing,
+# and consecutive successful ones before it is routed again.
+HEALTH_FALL = int(os.environ.get('DOOKIO_HEALTH_FALL', 2))
+HEALTH_RISE = int(os.environ.get('DOOKIO_HEALTH_RISE', 2))
+# Seconds an evicted backend keeps being checked before giving up on it.
+EVICTED_TTL = float(os.environ.get('DOOKIO_EVICTED_TTL', 3600))
+# Backends checked at the same time.
+HEALTH_WORKERS = int(os.environ.get('DOOKIO_HEALTH_WORKERS', 50))
+
+
+def app_conf(address, name=None):
+    """
+    The conf of an application from its address and its "<user>/<repo>"
+    name, as recorded by the routing (None if it was routed before names
+    were recorded).
+    """
+    user, repo = name.split('/', 1) if name else (None, None)
+    return {
+        'application_address': address,
+        'user': user,
+        'repo': repo
+    }
+
+
+def probe(backend):
+    """
+    Does a "node:port" backend answer HTTP requests without a server error?
+    """
+    try:
+        response = requests.get(backend, timeout=PROBE_TIMEOUT,
+                                allow_redirects=False)
+    except requests.exceptions.RequestException:
+        return False
+    return response.status_code < 500
+
+
+class HealthMonitor(object):
+    """
+    Probe every routed backend concurrently, take out of the routing the
+    ones failing HEALTH_FALL checks in a row and route them again after
+    HEALTH_RISE successful checks.
+    """
+    def __init__(self, redis_cli, workers=HEALTH_WORKERS):
+        self.redis_cli = redis_cli
+        self._pool = ThreadPool(workers)
+        # (address, backend) -> consecutive successful (> 0) or failed (< 0)
+        # checks.
+        self._streaks = {}
+
+    def targets(self):
+        """
+        The (app conf, backend, evicted at) of the backends of every app
+        (evicted at is None for the routed ones), in one round trip.
+        """
+        keys = self.redis_cli.zrange(APPS_KEY, 0, -1)
+        if not keys:
+            return []
+        addresses = [key[key.find(':') + 1:] for key in keys]
+        pipe = self.redis_cli.pipeline()
+        pipe.hmget(NAMES_KEY, keys)
+        for key, address in zip(keys, addresses):
+            pipe.lrange(key, 1, -1)
+            pipe.hgetall(evicted_key({'application_address': address}))
+        results = pipe.execute()
+        targets = []
+        for address, name, routed, evicted in zip(
+                addresses, results[0], results[1::2], results[2::2]):
+            conf = app_conf(address, name)
+            targets.extend((conf, backend, None) for backend in routed)
+            targets.extend((conf, backend, float(evicted_at))
+                           for backend, evicted_at in evicted.iteritems())
+        return targets
+
+    def check(self):
+        """
+        A round of health checks. Returns the (address, backend) evicted
+        and readmitted.
+        """
+        with span('health_checks'):
+            targets = self.targets()
+            backends = sorted(set(backend for _, backend, _ in targets))
+            healthy = dict(zip(backends, self._pool.map(probe, backends)))
+
+        now = time.time()
+        streaks = {}
+        evicted = []
+        readmitted = []
+        for conf, backend, evicted_at in targets:
+            address = conf['application_address']
+            streak = self._streaks.get((address, backend), 0)
+            if healthy[backend]:
+                streak = max(streak, 0) + 1
+            else:
+                streak = min(streak, 0) - 1
+            if evicted_at is None and streak <= -HEALTH_FALL:
+                if evict_backend(self.redis_cli, conf, backend) is not None:
+                    logger.warning('Evicted %s from %s', backend, address)
+                    evicted.append((address, backend))
+                    streak = 0
+            elif evicted_at is not None and streak >= HEALTH_RISE:
+                if readmit_backend(self.redis_cli, conf, backend) is not None:
+                    logger.info('Readmitted %s in %s', backend, address)
+                    readmitted.append((address, backend))
+                    streak = 0
+            elif evicted_at is not None and now - evicted_at > EVICTED_TTL:
+                forget_backends(self.redis_cli, conf, [backend])
+                continue
+            streaks[(address, backend)] = streak
+        self._streaks = streaks
+        return evicted, readmitted
+
+    def run(self):
+        while True:
+            start = time.time()
+            try:
+                self.check()
+            except Exception:
+                logger.exception('The backends could not be health checked')
+            time.sleep(max(HEALTH_INTERVAL - (time.time() - start), 0))
+
+
+def start_health_monitor():
+    """
+    Health check the routed backends from a background thread.
+    """
+    monitor = HealthMonitor(
+        redis.StrictRedis(host='localhost', port=6379, db=0))
+    thread = threading.Thread(target=monitor.run)
+    thread.daemon = True
+    thread.start()
+    return monitor
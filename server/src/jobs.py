@@ -0,0 +1,205 @@
+import os
+import time
+import uuid
+import threading
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from werkzeug.wrappers import Response
+
+from shared.keys import JOB_LOG_KEY
+
+# Deploys running at the same time (each one waits for its nodes).
+JOB_WORKERS = int(os.environ.get('DOOKIO_JOB_WORKERS', 10))
+# Seconds the status and log of a finished job are kept.
+JOB_TTL = int(os.environ.get('DOOKIO_JOB_TTL', 24 * 60 * 60))
+
+# Hash with the status of a job, and its output (one line per item, the
+# nodes append the output of their builds).
+JOB_KEY = 'dookio:job:{}'
+# Set of the jobs queued or running.
+ACTIVE_JOBS_KEY = 'dookio:jobs:active'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+FINISHED = (SUCCEEDED, FAILED)
+
+
+def create_job(redis_cli, conf, action):
+    """
+    Register a new (queued) job for the application.
+    """
+    job_id = uuid.uuid4().hex
+    pipe = redis_cli.pipeline()
+    pipe.hmset(JOB_KEY.format(job_id), {
+        'id': job_id,
+        'user': conf.get('user'),
+        'repo': conf.get('repo'),
+        'action': action,
+        'multiplicator': conf.get('multiplicator'),
+        'status': QUEUED,
+        'created': time.time()
+    })
+    pipe.sadd(ACTIVE_JOBS_KEY, job_id)
+    pipe.execute()
+    return job_id
+
+
+def get_job(redis_cli, job_id):
+    """
+    The status of a job (None if there is no such job).
+    """
+    return redis_cli.hgetall(JOB_KEY.format(job_id)) or None
+
+
+def start_job(redis_cli, job_id):
+    redis_cli.hmset(JOB_KEY.format(job_id), {
+        'status': RUNNING,
+        'started': time.time()
+    })
+
+
+def finish_job(redis_cli, job_id, status_code, result):
+    """
+    Store the outcome of the job, which is kept for JOB_TTL seconds.
+    """
+    pipe = redis_cli.pipeline()
+    pipe.hmset(JOB_KEY.format(job_id), {
+        'status': SUCCEEDED if status_code == 200 else FAILED,
+        'status_code': status_code,
+        'result': result,
+        'finished': time.time()
+    })
+    if result:
+        pipe.rpush(JOB_LOG_KEY.format(job_id), *result.splitlines())
+    pipe.expire(JOB_KEY.format(job_id), JOB_TTL)
+    pipe.expire(JOB_LOG_KEY.format(job_id), JOB_TTL)
+    pipe.srem(ACTIVE_JOBS_KEY, job_id)
+    pipe.execute()
+
+
+def fail_interrupted_jobs(redis_cli):
+    """
+    Mark as failed the jobs that were queued or running when the server
+    stopped (the queue lives in the server process, so they will never
+    run), so nobody waits for them forever. Returns how many.
+    """
+    messages = {
+        QUEUED: 'The deploy was still queued when the server restarted. '
+                'Please try again.\n',
+        RUNNING: 'The deploy was interrupted by a restart of the server. '
+                 'Please try again.\n'
+    }
+    failed = 0
+    for job_id in redis_cli.smembers(ACTIVE_JOBS_KEY):
+        status = redis_cli.hget(JOB_KEY.format(job_id), 'status')
+        if status not in messages:
+            # Finished (or expired) but left in the set.
+            redis_cli.srem(ACTIVE_JOBS_KEY, job_id)
+            continue
+        finish_job(redis_cli, job_id, 500, messages[status])
+        failed += 1
+    return failed
+
+
+def job_log(redis_cli, job_id, line):
+    """
+    Append a line to the output of the job (if any).
+    """
+    if job_id:
+        redis_cli.rpush(JOB_LOG_KEY.format(job_id), line)
+
+
+def read_job_log(redis_cli, job_id, offset=0):
+    return redis_cli.lrange(JOB_LOG_KEY.format(job_id), offset, -1)
+
+
+class Job(object):
+    """
+    A deploy job queued in this process: `run` returns the Response of
+    the deploy.
+    """
+    def __init__(self, job_id, app, run):
+        self.id = job_id
+        self.app = app
+        self.run = run
+        self.response = None
+        self._done = threading.Event()
+
+    def finish(self, response):
+        self.response = response
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the response of the deploy (None on timeout).
+        """
+        self._done.wait(timeout)
+        return self.response
+
+
+class JobQueue(object):
+    """
+    Runs the deploy jobs in a pool of `workers` threads. The jobs of the
+    same application run one after the other, in the order they were
+    submitted, while the jobs of different applications run concurrently.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pool = None
+        # app -> jobs waiting for the running job of the app to finish.
+        self._waiting = {}
+
+    def submit(self, redis_cli, job):
+        with self._lock:
+            if job.app in self._waiting:
+                self._waiting[job.app].append((redis_cli, job))
+                return job
+            self._waiting[job.app] = deque()
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        self._pool.apply_async(self._run, (redis_cli, job))
+        return job
+
+    def pending(self, app):
+        """
+        Number of jobs of the application waiting for their turn.
+        """
+        with self._lock:
+            return len(self._waiting.get(app, ()))
+
+    def busy(self, app):
+        """
+        Is a job of the application running (or waiting)?
+        """
+        with self._lock:
+            return app in self._waiting
+
+    def _run(self, redis_cli, job):
+        try:
+            start_job(redis_cli, job.id)
+            response = job.run()
+            finish_job(redis_cli, job.id, response.status_code,
+                       response.get_data())
+        except Exception, e:
+            response = Response('The deploy failed: {}\n'.format(e),
+                                status=500)
+            try:
+                finish_job(redis_cli, job.id, 500, response.get_data())
+            except Exception:
+                pass
+        job.finish(response)
+
+        with self._lock:
+            waiting = self._waiting[job.app]
+            if not waiting:
+                del self._waiting[job.app]
+                return
+            next_job = waiting.popleft()
+        self._pool.apply_async(self._run, next_job)
+
+
+job_queue = JobQueue(JOB_WORKERS)
@@ -0,0 +1,91 @@
+import os
+import stat
+import errno
+import hashlib
+import threading
+
+# Where the receiver extracts the pushed code: <root>/<user>/<repo>/code
+# (and counts the pushes: <root>/<user>/<repo>/push).
+CODE_ROOT = os.environ.get('DOOKIO_CODE_ROOT', '/home')
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+# One lock per repo, so concurrent requests build its manifest only once.
+_build_locks = {}
+
+
+def file_digest(path):
+    """
+    SHA1 of the content of a file.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(root):
+    """
+    Map every file under root (relative path) to its content digest and
+    mode. Symlinks are kept as links, and directories (even the empty ones)
+    with their mode.
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames + dirnames:
+            full_path = os.path.join(dirpath, name)
+            path = os.path.relpath(full_path, root)
+            if os.path.islink(full_path):
+                manifest[path] = {'link': os.readlink(full_path)}
+            elif os.path.isfile(full_path):
+                manifest[path] = {
+                    'sha1': file_digest(full_path),
+                    'mode': stat.S_IMODE(os.stat(full_path).st_mode)
+                }
+            elif os.path.isdir(full_path):
+                manifest[path] = {
+                    'dir': True,
+                    'mode': stat.S_IMODE(os.stat(full_path).st_mode)
+                }
+    return manifest
+
+
+def push_count(repo_root):
+    """
+    How many times the code of the repo has been pushed (None if the
+    receiver didn't count them).
+    """
+    try:
+        with open(os.path.join(repo_root, 'push')) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def get_manifest(conf):
+    """
+    Get the manifest of the code pushed for the user/repo application.
+    The receiver counts the pushes once the code is extracted, so the
+    manifest is only rebuilt after a new push (always, if they are not
+    counted).
+    """
+    repo_root = os.path.join(CODE_ROOT, conf.get('user'), conf.get('repo'))
+    root = os.path.join(repo_root, 'code')
+    if not os.path.isdir(root):
+        raise OSError(errno.ENOENT, 'There is no code', root)
+
+    with _manifests_lock:
+        lock = _build_locks.setdefault(root, threading.Lock())
+    with lock:
+        # Read before walking the code: a push landing meanwhile bumps it.
+        version = push_count(repo_root)
+        with _manifests_lock:
+            cached = _manifests.get(root)
+        if version is not None and cached and cached[0] == version:
+            return cached[1]
+
+        manifest = build_manifest(root)
+        with _manifests_lock:
+            _manifests[root] = (version, manifest)
+        return manifest
@@ -0,0 +1,31 @@
+import time
+
+from contextlib import contextmanager
+
+from shared.metrics import Histogram
+
+
+stage_seconds = Histogram(
+    'dookio_server_stage_seconds',
+    'Seconds spent in each stage of the deploys.',
+    ('stage', 'app', 'node'))
+
+
+def app_label(conf):
+    return '{}/{}'.format(conf.get('user'), conf.get('repo'))
+
+
+@contextmanager
+def span(stage, app='', node=''):
+    """
+    Time the block as a stage of the deploys (even if it fails).
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.time() - start, stage, app, node)
+
+
+def expose():
+    return stage_seconds.expose()
@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import logging
+import threading
+import redis
+
+from werkzeug.wrappers import Response
+
+from src.utils import (contact_nodes,
+                       claim_warm_replicas,
+                       deploy_replicas,
+                       check_backends_health,
+                       stop_backends,
+                       drain_backends,
+                       get_app_backends,
+                       get_evicted_backends,
+                       parse_backend)
+from src.routing import (EVICTED_KEY,
+                         frontend_key,
+                         add_backends,
+                         remove_backends,
+                         forget_backends)
+from src.registry import live_nodes, get_resources
+from src.metrics import span, app_label
+from src.jobs import Job, job_queue, create_job, job_log
+
+logger = logging.getLogger(__name__)
+
+# Hash of <user>/<repo> -> desired state of the application (JSON): its
+# address, the number of replicas and the image (context digest) they run.
+DESIRED_KEY = 'dookio:desired'
+
+# Seconds between two sweeps comparing the desired state of every app with
+# what the nodes report.
+RECONCILE_INTERVAL = float(os.environ.get('DOOKIO_RECONCILE_INTERVAL', 10))
+# Seconds an app is left alone after its desired state changes, so the
+# heartbeats of the nodes catch up with the deploy (and the old containers
+# are drained).
+RECONCILE_GRACE = float(os.environ.get('DOOKIO_RECONCILE_GRACE', 30))
+
+
+def set_desired(redis_cli, conf, replicas, digest=None):
+    """
+    Declare how many replicas of the application should be running (and
+    of which image).
+    """
+    redis_cli.hset(DESIRED_KEY, app_label(conf), json.dumps({
+        'user': conf.get('user'),
+        'repo': conf.get('repo'),
+        'application_address': conf.get('application_address'),
+        'replicas': replicas,
+        'digest': digest,
+        'updated': time.time()
+    }))
+
+
+def get_desired(redis_cli, conf):
+    state = redis_cli.hget(DESIRED_KEY, app_label(conf))
+    if state:
+        return json.loads(state)
+    return None
+
+
+def remove_desired(redis_cli, conf):
+    """
+    Stop reconciling the application (e.g. it was stopped on purpose).
+    """
+    return redis_cli.hdel(DESIRED_KEY, app_label(conf))
+
+
+def all_desired(redis_cli):
+    return [json.loads(state)
+            for state in redis_cli.hgetall(DESIRED_KEY).itervalues()]
+
+
+def deployed_digest(deployed):
+    """
+    The image run by the replicas of a deploy (None if none came up).
+    """
+    for node, response in deployed:
+        if response[1] == 200:
+            return response[0].get('digest')
+    return None
+
+
+def image_digest(image):
+    """
+    The context digest of the image a container runs ("<user>/<repo>:
+    <digest>"), None when it was created from the "latest" image (or an
+    image id) and there is no telling.
+    """
+    name, _, tag = (image or '').rpartition(':')
+    if not name or '/' in tag or tag == 'latest':
+        return None
+    return tag
+
+
+def outdated_backends(images, digest):
+    """
+    The backends (of a `images` dict backend -> image) that run another
+    image than the `digest` one.
+    """
+    if not digest:
+        return []
+    return [backend for backend, image in images.iteritems()
+            if image_digest(image) not in (None, digest)]
+
+
+def plan(replicas, actual, routed, evicted, outdated=()):
+    """
+    What to do to go from the `actual` (node, port) containers of an app
+    to `replicas` routed ones of the desired image. Returns the number of
+    replicas to start (evicted and `outdated` containers don't count) and
+    the backends to unroute (their container is gone), to route (running
+    but not routed), to stop (extra replicas: evicted ones first, then the
+    unrouted ones, then the last routed ones) and to replace (running
+    another image, stopped once their replacements are up).
+    """
+    current = [backend for backend in actual if backend not in outdated]
+    live = [backend for backend in current if backend not in evicted]
+    unroute = [backend for backend in routed if backend not in actual]
+    route = [backend for backend in live if backend not in routed]
+    replace = [backend for backend in actual if backend in outdated]
+    stop = []
+    excess = len(current) - replicas
+    if excess > 0:
+        candidates = ([backend for backend in current if backend in evicted] +
+                      route +
+                      [backend for backend in reversed(routed)
+                       if backend in current])
+        stop = candidates[:excess]
+        route = [backend for backend in route if backend not in stop]
+    return max(replicas - len(live), 0), unroute, route, stop, replace
+
+
+def reported_backends(reports, conf):
+    """
+    The (node, port) containers of the application according to the last
+    heartbeats of the nodes, the image they run (backend -> image) and the
+    nodes that don't report them.
+    """
+    app = '{}_{}'.format(conf.get('user'), conf.get('repo'))
+    backends = []
+    images = {}
+    unknown = set()
+    for node, report in reports.iteritems():
+        if 'ports' not in report:
+            unknown.add(node)
+            continue
+        backends.extend((node, port) for port in report['ports'].get(app, []))
+        for port, image in report.get('images', {}).get(app, {}).iteritems():
+            images[(node, int(port))] = image
+    return backends, images, unknown
+
+
+def reconcile(redis_cli, conf, replicas, digest=None):
+    """
+    Bring the application to `replicas` routed containers (of the `digest`
+    image), with the containers asked to the nodes right now: only the
+    missing ones (and the ones running another image) are started and only
+    the extra ones drained and stopped.
+    Returns the backends started, stopped and unrouted, and the (content,
+    status) of the replicas that could not be started.
+    """
+    def log(line):
+        job_log(redis_cli, conf.get('job'), line)
+
+    actual = []
+    images = {}
+    unknown = set()
+    for node, response in contact_nodes(dict(conf, action='get')).iteritems():
+        if response[1] != 200:
+            unknown.add(node)
+            continue
+        for container in response[0]:
+            for port in container.get('Ports')[:1]:
+                backend = (node, port.get('PublicPort'))
+                actual.append(backend)
+                images[backend] = container.get('Image')
+    routed = get_app_backends(redis_cli, conf)
+    evicted = get_evicted_backends(redis_cli, conf)
+    # The backends of the nodes that didn't answer are left alone.
+    actual.extend(backend for backend in routed + evicted
+                  if backend[0] in unknown)
+
+    start, unroute, route, stop, replace = plan(
+        replicas, actual, routed, evicted, outdated_backends(images, digest))
+    gone = [backend for backend in evicted if backend not in actual]
+    if gone:
+        forget_backends(redis_cli, conf,
+                        ['{}:{}'.format(node, port) for node, port in gone])
+    if unroute:
+        log('Unrouting {} backends without container'.format(len(unroute)))
+        remove_backends(redis_cli, conf, unroute)
+    if stop:
+        log('Stopping {} extra replicas'.format(len(stop)))
+        remove_backends(redis_cli, conf, stop)
+        drain_backends(stop, conf)
+
+    started = []
+    failed = []
+    if start:
+        # Warm containers only need to be routed.
+        started = claim_warm_replicas(conf, start, digest)
+        if started:
+            log('Claimed {} warm containers'.format(len(started)))
+    if start > len(started):
+        log('Starting {} missing replicas'.format(start - len(started)))
+        deployed = deploy_replicas(dict(
+            conf, multiplicator=start - len(started), digest=digest))
+        started.extend((node, int(response[0].get('port')))
+                       for node, response in deployed if response[1] == 200)
+        failed = [response for node, response in deployed
+                  if response[1] != 200]
+    if route or started:
+        log('Health checking {} containers'.format(len(route + started)))
+        healthy = check_backends_health(route + started)
+        unhealthy = [backend for backend in route + started
+                     if backend not in healthy]
+        if unhealthy:
+            stop_backends(unhealthy, conf)
+            failed.extend([('The container {}:{} did not pass the health '
+                            'check\n'.format(node, port), 503)
+                           for node, port in unhealthy])
+        if healthy:
+            add_backends(redis_cli, conf, healthy)
+        started = [backend for backend in started if backend in healthy]
+    if replace:
+        if failed:
+            # Better the old image than no replica at all.
+            log('Keeping {} replicas of another image until theirs '
+                'start'.format(len(replace)))
+        else:
+            log('Replacing {} replicas of another image'.format(
+                len(replace)))
+            remove_backends(redis_cli, conf, replace)
+            drain_backends(replace, conf)
+            stop = stop + replace
+    return started, stop, unroute, failed
+
+
+def reconcile_app(redis_cli, conf):
+    """
+    Make the containers of the application match its desired state. Run as
+    a job of the app, so it never overlaps with one of its deploys.
+    """
+    state = get_desired(redis_cli, conf)
+    if state is None:
+        return Response('{} has no desired state.\n'.format(app_label(conf)))
+    conf = dict(conf, resources=get_resources(redis_cli, conf))
+    started, stopped, unrouted, failed = reconcile(
+        redis_cli, conf, state['replicas'], state.get('digest'))
+    return Response(
+        '{}: {} started, {} stopped, {} unrouted, {} failed\n'.format(
+            app_label(conf), len(started), len(stopped), len(unrouted),
+            len(failed)),
+        status=503 if failed else 200)
+
+
+class Reconciler(object):
+    """
+    Sweep the desired state of every application against the heartbeats
+    of the nodes (a few round trips for the whole cluster) and queue a
+    reconcile job for the apps that diverged.
+    """
+    def __init__(self, redis_cli, queue=job_queue):
+        self.redis_cli = redis_cli
+        self.queue = queue
+
+    def diverged(self):
+        """
+        The desired state of the apps whose containers or routing don't
+        match it.
+        """
+        reports = live_nodes(self.redis_cli)
+        if not reports:
+            # Without heartbeats there is nothing to compare with.
+            return []
+        now = time.time()
+        states = [state for state in all_desired(self.redis_cli)
+                  if now - state['updated'] >= RECONCILE_GRACE and
+                  not self.queue.busy(state['application_address'])]
+        if not states:
+            return []
+        pipe = self.redis_cli.pipeline()
+        for state in states:
+            pipe.lrange(frontend_key(state), 1, -1)
+            pipe.hkeys(EVICTED_KEY.format(state['application_address']))
+        results = pipe.execute()
+
+        diverged = []
+        for state, routed, evicted in zip(states, results[::2],
+                                          results[1::2]):
+            actual, images, unknown = reported_backends(reports, state)
+            routed = [parse_backend(backend) for backend in routed]
+            evicted = [parse_backend(backend) for backend in evicted]
+            # The backends of the nodes that don't report their containers
+            # are taken for granted.
+            actual.extend(backend for backend in routed + evicted
+                          if backend[0] in unknown)
+            if any(plan(state['replicas'], actual, routed, evicted,
+                        outdated_backends(images, state.get('digest')))):
+                diverged.append(state)
+        return diverged
+
+    def sweep(self):
+        """
+        Queue a reconcile job for every app that diverged. Returns their
+        job ids.
+        """
+        jobs = []
+        for state in self.diverged():
+            conf = dict((key, state[key]) for key in
+                        ('user', 'repo', 'application_address'))
+            job_id = create_job(self.redis_cli, conf, 'reconcile')
+            job_conf = dict(conf, job=job_id)
+
+            def run(job_conf=job_conf):
+                with span('reconcile', app_label(job_conf)):
+                    return reconcile_app(self.redis_cli, job_conf)
+
+            self.queue.submit(self.redis_cli, Job(
+                job_id, conf['application_address'], run))
+            jobs.append(job_id)
+        return jobs
+
+    def run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('The apps could not be reconciled')
+            time.sleep(RECONCILE_INTERVAL)
+
+
+def start_reconciler():
+    """
+    Reconcile the apps with their desired state from a background thread.
+    """
+    reconciler = Reconciler(
+        redis.StrictRedis(host='localhost', port=6379, db=0))
+    thread = threading.Thread(target=reconciler.run)
+    thread.daemon = True
+    thread.start()
+    return reconciler
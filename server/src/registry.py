@@ -0,0 +1,98 @@
+import json
+import time
+
+from shared.keys import (NODES_KEY,
+                         NODE_KEY,
+                         WARM_POOL_KEY,
+                         RESOURCES_KEY,
+                         get_resources)
+
+MEMORY_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def live_nodes(redis_cli):
+    """
+    The nodes whose last heartbeat hasn't expired, with their capacity
+    report. Expired nodes are dropped from the registry.
+    """
+    now = time.time()
+    pipe = redis_cli.pipeline()
+    pipe.zremrangebyscore(NODES_KEY, '-inf', now)
+    pipe.zrangebyscore(NODES_KEY, now, '+inf')
+    nodes = pipe.execute()[1]
+    if not nodes:
+        return {}
+    reports = redis_cli.mget([NODE_KEY.format(node) for node in nodes])
+    return dict((node, json.loads(report))
+                for node, report in zip(nodes, reports) if report)
+
+
+def node_report(redis_cli, node):
+    """
+    The capacity report of the last heartbeat of a node (None if it
+    expired).
+    """
+    report = redis_cli.get(NODE_KEY.format(node))
+    if report:
+        return json.loads(report)
+    return None
+
+
+def set_warm_pool_size(redis_cli, conf, size):
+    """
+    Ask every node to keep `size` warm containers of the application
+    (started but not routed, so scaling up only needs to route them).
+    """
+    app = '{}/{}'.format(conf.get('user'), conf.get('repo'))
+    if size > 0:
+        return redis_cli.hset(WARM_POOL_KEY, app, size)
+    return redis_cli.hdel(WARM_POOL_KEY, app)
+
+
+def parse_memory(value):
+    """
+    Bytes of a memory size e.g 536870912, 512m or 1g (0 or '' for no
+    limit). Raises ValueError if it isn't one.
+    """
+    value = value.strip().lower()
+    if not value:
+        return 0
+    if value[-1] in MEMORY_UNITS:
+        memory = int(float(value[:-1]) * MEMORY_UNITS[value[-1]])
+    else:
+        memory = int(value)
+    if memory < 0:
+        raise ValueError('The memory limit can not be negative.')
+    return memory
+
+
+def parse_cpu_shares(value):
+    """
+    CPU shares (1024 per CPU, 0 or '' for no limit). Raises ValueError if
+    they aren't.
+    """
+    if not value.strip():
+        return 0
+    cpu_shares = int(value)
+    if cpu_shares < 0:
+        raise ValueError('The CPU shares can not be negative.')
+    return cpu_shares
+
+
+def set_resources(redis_cli, conf, memory=None, cpu_shares=None):
+    """
+    Limit the memory (bytes) and CPU shares of every container of the
+    application from its next deploy on. The limits not given (None) are
+    kept and the ones given as 0 are removed. Without limits the
+    containers can use all of the node.
+    """
+    app = '{}/{}'.format(conf.get('user'), conf.get('repo'))
+    profile = get_resources(redis_cli, conf)
+    for resource, value in (('memory', memory), ('cpu_shares', cpu_shares)):
+        if value:
+            profile[resource] = value
+        elif value is not None:
+            profile.pop(resource, None)
+    if profile:
+        return redis_cli.hset(RESOURCES_KEY, app, json.dumps(profile))
+    return redis_cli.hdel(RESOURCES_KEY, app)
@@ -0,0 +1,228 @@
+import time
+
+from redis.client import Script
+
+from src.metrics import span, app_label
+
+# Every change to the hipache routing of an application is a single Lua
+# script, so it costs one round trip and hipache never sees a half-built
+# "frontend:<address>" list. The first element of the list is the app
+# identifier and the rest are its "node:port" backends.
+#
+# The scripts also keep the app index up to date, so listing the apps
+# doesn't need to scan the whole keyspace.
+
+# Sorted set of the "frontend:<address>" keys (all scored 0, so they are
+# sorted by name and can be paginated).
+APPS_KEY = 'dookio:apps'
+# Hash of "frontend:<address>" -> number of backends.
+REPLICAS_KEY = 'dookio:apps:replicas'
+# Hash of "frontend:<address>" -> <user>/<repo> (addresses can't be split
+# back into them: the repo may have dots).
+NAMES_KEY = 'dookio:apps:names'
+# Hash of the backends of an app taken out of the routing by the health
+# monitor -> when they were evicted. Every change made by a deploy drops
+# them, so a stale backend is never readmitted.
+EVICTED_KEY = 'dookio:evicted:{}'
+
+# Appended to the scripts that change the backends of KEYS[1].
+UPDATE_INDEX = """
+local replicas = math.max(redis.call('LLEN', KEYS[1]) - 1, 0)
+redis.call('ZADD', KEYS[2], 0, KEYS[1])
+redis.call('HSET', KEYS[3], KEYS[1], replicas)
+return replicas
+"""
+
+ADD_BACKENDS = Script(None, """
+redis.call('HSET', KEYS[5], KEYS[1], ARGV[1])
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('RPUSH', KEYS[1], ARGV[2])
+end
+for i = 3, #ARGV do
+    redis.call('LREM', KEYS[1], 0, ARGV[i])
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+    redis.call('HDEL', KEYS[4], ARGV[i])
+end
+""" + UPDATE_INDEX)
+
+REMOVE_BACKENDS = Script(None, """
+for i = 1, #ARGV do
+    redis.call('LREM', KEYS[1], 0, ARGV[i])
+    redis.call('HDEL', KEYS[4], ARGV[i])
+end
+""" + UPDATE_INDEX)
+
+SWAP_BACKENDS = Script(None, """
+redis.call('HSET', KEYS[5], KEYS[1], ARGV[1])
+redis.call('DEL', KEYS[1], KEYS[4])
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+""" + UPDATE_INDEX)
+
+REMOVE_APP = Script(None, """
+redis.call('ZREM', KEYS[2], KEYS[1])
+redis.call('HDEL', KEYS[3], KEYS[1])
+redis.call('HDEL', KEYS[5], KEYS[1])
+redis.call('DEL', KEYS[4])
+return redis.call('DEL', KEYS[1])
+""")
+
+# The last backend of an app is never evicted: if every backend fails the
+# problem is more likely on the monitor side, and hipache answers an error
+# anyway. Returns nil if the backend was not evicted.
+EVICT_BACKEND = Script(None, """
+if redis.call('LLEN', KEYS[1]) <= 2 then
+    return false
+end
+if redis.call('LREM', KEYS[1], 0, ARGV[1]) == 0 then
+    return false
+end
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[2])
+""" + UPDATE_INDEX)
+
+# Only backends that are still evicted are readmitted (a deploy may have
+# replaced them in the meantime). Returns nil if it was not readmitted.
+READMIT_BACKEND = Script(None, """
+if redis.call('HDEL', KEYS[4], ARGV[1]) == 0 then
+    return false
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+""" + UPDATE_INDEX)
+
+# Returns the number of apps followed by the name and replicas of the ones
+# in the ARGV[1]..ARGV[2] range.
+LIST_APPS = Script(None, """
+local apps = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[2])
+local result = {redis.call('ZCARD', KEYS[1])}
+if #apps > 0 then
+    local replicas = redis.call('HMGET', KEYS[2], unpack(apps))
+    for i = 1, #apps do
+        table.insert(result, apps[i])
+        table.insert(result, replicas[i] or 0)
+    end
+end
+return result
+""")
+
+
+def frontend_key(conf):
+    return 'frontend:{}'.format(conf.get('application_address'))
+
+
+def evicted_key(conf):
+    return EVICTED_KEY.format(conf.get('application_address'))
+
+
+def _keys(conf):
+    return [frontend_key(conf), APPS_KEY, REPLICAS_KEY, evicted_key(conf),
+            NAMES_KEY]
+
+
+def _backend_names(backends):
+    return ['{}:{}'.format(node, port) for node, port in backends]
+
+
+def _run(script, redis_cli, keys, args, app=''):
+    if not script.sha:
+        script.sha = redis_cli.script_load(script.script)
+    with span('routing', app):
+        return script(keys=keys, args=args, client=redis_cli)
+
+
+def add_backends(redis_cli, conf, backends):
+    """
+    Route several (node, port) backends, creating the application entry if
+    needed. Returns the number of backends of the application.
+    """
+    return _run(ADD_BACKENDS, redis_cli, _keys(conf),
+                [app_label(conf), conf.get('repo')] +
+                _backend_names(backends),
+                app_label(conf))
+
+
+def remove_backends(redis_cli, conf, backends):
+    """
+    Stop routing several (node, port) backends. Returns the number of
+    backends left.
+    """
+    return _run(REMOVE_BACKENDS, redis_cli, _keys(conf),
+                _backend_names(backends), app_label(conf))
+
+
+def swap_backends(redis_cli, conf, backends):
+    """
+    Atomically replace all the backends of the application.
+    """
+    return _run(SWAP_BACKENDS, redis_cli, _keys(conf),
+                [app_label(conf), conf.get('repo')] +
+                _backend_names(backends),
+                app_label(conf))
+
+
+def evict_backend(redis_cli, conf, backend):
+    """
+    Stop routing a failing "node:port" backend until it is readmitted.
+    Returns the number of backends left, or None if it was not evicted.
+    """
+    return _run(EVICT_BACKEND, redis_cli, _keys(conf), [backend, time.time()],
+                app_label(conf))
+
+
+def readmit_backend(redis_cli, conf, backend):
+    """
+    Route again an evicted "node:port" backend. Returns the number of
+    backends, or None if it was not evicted anymore.
+    """
+    return _run(READMIT_BACKEND, redis_cli, _keys(conf), [backend],
+                app_label(conf))
+
+
+def forget_backends(redis_cli, conf, backends):
+    """
+    Give up on evicted "node:port" backends (they won't be readmitted).
+    """
+    return redis_cli.hdel(evicted_key(conf), *backends)
+
+
+def remove_app(redis_cli, conf):
+    """
+    Stop routing the application at all.
+    """
+    return _run(REMOVE_APP, redis_cli, _keys(conf), [], app_label(conf))
+
+
+def list_apps(redis_cli, offset=0, limit=None):
+    """
+    A page of the routed applications from the app index, in a single
+    round trip. Returns the total number of apps and a list of
+    (address, replicas).
+    """
+    stop = -1 if limit is None else offset + limit - 1
+    result = _run(LIST_APPS, redis_cli, [APPS_KEY, REPLICAS_KEY],
+                  [offset, stop])
+    apps = [(key[key.find(':') + 1:], int(replicas))
+            for key, replicas in zip(result[1::2], result[2::2])]
+    return result[0], apps
+
+
+def rebuild_app_index(redis_cli):
+    """
+    Index the applications routed before the app index existed (or
+    outside of dookio), and drop the ones that are not routed anymore.
+    Safe to run at any time. Returns the number of apps indexed.
+    """
+    keys = list(redis_cli.scan_iter(match='frontend:*'))
+    stale = set(redis_cli.zrange(APPS_KEY, 0, -1)) - set(keys)
+    pipe = redis_cli.pipeline()
+    for key in keys:
+        pipe.llen(key)
+    lengths = pipe.execute() if keys else []
+    pipe = redis_cli.pipeline()
+    for key, length in zip(keys, lengths):
+        pipe.zadd(APPS_KEY, 0, key)
+        pipe.hset(REPLICAS_KEY, key, max(length - 1, 0))
+    if stale:
+        pipe.zrem(APPS_KEY, *stale)
+        pipe.hdel(REPLICAS_KEY, *stale)
+        pipe.hdel(NAMES_KEY, *stale)
+    pipe.execute()
+    return len(keys)
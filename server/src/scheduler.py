@@ -0,0 +1,134 @@
+import os
+import threading
+
+# Nodes over this utilization are not considered by the binpack strategy.
+BINPACK_THRESHOLD = float(os.environ.get('DOOKIO_BINPACK_THRESHOLD', 0.8))
+
+
+# What the limits of the containers reserve in a node.
+RESOURCES = ('memory', 'cpu_shares')
+
+
+def utilization(report):
+    """
+    How busy a node is (0 idle, 1 saturated): the worst of its CPU load,
+    its memory usage and the share of its memory and CPU reserved by the
+    limits of its containers.
+    """
+    cpu = report.get('load', 0) / float(report.get('cpus') or 1)
+    memory = 0
+    if report.get('memory_total'):
+        memory = 1 - report.get('memory_free', 0) / float(
+            report.get('memory_total'))
+    reserved = [report.get('{}_allocated'.format(resource), 0) / float(
+        report['{}_allocatable'.format(resource)])
+        for resource in RESOURCES
+        if report.get('{}_allocatable'.format(resource))]
+    return max([cpu, memory] + reserved)
+
+
+def fits(report, resources):
+    """
+    Is there room in the node for a container with these limits (nodes
+    that don't report their allocations are assumed to have it)?
+    """
+    for resource in RESOURCES:
+        requested = (resources or {}).get(resource) or 0
+        allocatable = report.get('{}_allocatable'.format(resource))
+        if requested and allocatable is not None and (
+                report.get('{}_allocated'.format(resource), 0) +
+                requested > allocatable):
+            return False
+    return True
+
+
+def least_loaded(reports, app):
+    """
+    The node with the lowest utilization (and fewest containers).
+    """
+    return min(reports, key=lambda node: (
+        utilization(reports[node]), reports[node].get('containers', 0)))
+
+
+def spread(reports, app):
+    """
+    The node running fewer replicas of the application (anti-affinity),
+    breaking ties by utilization.
+    """
+    return min(reports, key=lambda node: (
+        reports[node].get('apps', {}).get(app, 0),
+        utilization(reports[node])))
+
+
+def binpack(reports, app):
+    """
+    The fullest node that is still under BINPACK_THRESHOLD, so the rest of
+    the nodes stay free for big applications.
+    """
+    candidates = dict((node, report) for node, report in reports.iteritems()
+                      if utilization(report) < BINPACK_THRESHOLD)
+    if not candidates:
+        return least_loaded(reports, app)
+    return max(candidates, key=lambda node: (
+        candidates[node].get('containers', 0),
+        utilization(candidates[node])))
+
+
+STRATEGIES = {
+    'least_loaded': least_loaded,
+    'spread': spread,
+    'binpack': binpack,
+}
+
+
+class ClusterState(object):
+    """
+    In-memory view of the nodes fed by their periodic capacity reports.
+    Placements are counted right away, so the replicas of a deploy don't
+    all land in the node that looked best in the last report.
+    """
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self._reports = {}
+
+    def update(self, node, report):
+        with self._lock:
+            self._reports[node] = report
+
+    def remove(self, node):
+        with self._lock:
+            self._reports.pop(node, None)
+
+    def nodes(self):
+        with self._lock:
+            return sorted(self._reports)
+
+    def reports(self):
+        with self._lock:
+            return dict((node, dict(report))
+                        for node, report in self._reports.iteritems())
+
+    def place(self, app, resources=None):
+        """
+        Pick a node for a new replica of the application, with room for
+        its `resources` limits (None if no node can take it).
+        """
+        with self._lock:
+            reports = dict(
+                (node, report) for node, report in self._reports.iteritems()
+                if report.get('free_ports', 1) > 0 and
+                fits(report, resources))
+            if not reports:
+                return None
+            node = STRATEGIES[self.strategy](reports, app)
+            report = self._reports[node]
+            report['containers'] = report.get('containers', 0) + 1
+            report['free_ports'] = report.get('free_ports', 1) - 1
+            apps = report.setdefault('apps', {})
+            apps[app] = apps.get(app, 0) + 1
+            for resource in RESOURCES:
+                if (resources or {}).get(resource):
+                    key = '{}_allocated'.format(resource)
+                    report[key] = report.get(key, 0) + resources[resource]
+            return node
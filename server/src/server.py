@@ -1,18 +1,275 @@
 import os
+import time
 import redis
-import requests
 import json
 
 from werkzeug.wrappers import Request, Response
 
-from src.utils import (fetch_apps,
-                       contact_nodes,
+from src.utils import (contact_nodes,
                        was_applied,
+                       stopped_everywhere,
                        exist_application,
-                       add_app_to_webserver_routing,
-                       remove_app_from_webserver_routing,
-                       add_container_to_webserver_routing,
-                       pick_up_node)
+                       deploy_replicas,
+                       get_app_backends,
+                       get_evicted_backends,
+                       check_backends_health,
+                       stop_backends,
+                       drain_backends)
+from src.routing import (add_backends,
+                         swap_backends,
+                         remove_app,
+                         list_apps)
+from src.manifest import get_manifest
+from src.registry import (set_warm_pool_size,
+                          set_resources,
+                          get_resources,
+                          parse_memory,
+                          parse_cpu_shares)
+from src.autoscaler import set_policy, remove_policy
+from src.analytics import load_stats
+from src.reconciler import (reconcile,
+                            get_desired,
+                            set_desired,
+                            remove_desired,
+                            deployed_digest)
+from src.metrics import span, app_label, expose
+from src.jobs import (Job,
+                      job_queue,
+                      create_job,
+                      get_job,
+                      job_log,
+                      read_job_log,
+                      FINISHED)
+
+# Default page size of /apps when a page is asked for.
+APPS_PER_PAGE = int(os.environ.get('DOOKIO_APPS_PER_PAGE', 100))
+# Seconds between reads of the log of a job that is being followed.
+LOG_POLL_INTERVAL = float(os.environ.get('DOOKIO_LOG_POLL_INTERVAL', 0.5))
+
+
+def recreate_deploy(redis_cli, conf):
+    """
+    Stop every container of the application and start brand new ones.
+    The application is unavailable until the new containers are built.
+    """
+    # Stop all existing containers
+    job_log(redis_cli, conf.get('job'), 'Stopping the running containers')
+    conf['action'] = 'stop'
+    contact_nodes(conf)
+    conf['action'] = None
+    remove_app(redis_cli, conf)
+
+    # Launch all the replicas concurrently and route the ones that
+    # came up in one go. Failed replicas are simply left out.
+    job_log(redis_cli, conf.get('job'), 'Deploying {} replicas'.format(
+        conf.get('multiplicator')))
+    deployed = deploy_replicas(conf)
+    backends = [(node, int(response[0].get('port')))
+                for node, response in deployed if response[1] == 200]
+    failed = [response for node, response in deployed
+              if response[1] != 200]
+    if failed and not backends:
+        content, status_code = failed[0]
+        return Response(content, status=status_code)
+
+    # Set up hipache webserver for the specified branch
+    add_backends(redis_cli, conf, backends)
+    # The replicas that failed are started by the reconciler later on.
+    set_desired(redis_cli, conf, conf.get('multiplicator'),
+                deployed_digest(deployed))
+    return deployed_response(deployed, failed, conf)
+
+
+def rolling_deploy(redis_cli, conf):
+    """
+    Start and health check the new containers while the old ones keep
+    serving, swap the routing in one transaction and only then drain and
+    stop the old containers (the ones evicted by the health monitor too,
+    as the swap forgets them).
+    """
+    old_backends = (get_app_backends(redis_cli, conf) +
+                    get_evicted_backends(redis_cli, conf))
+
+    job_log(redis_cli, conf.get('job'),
+            'Deploying {} replicas next to the running ones'.format(
+                conf.get('multiplicator')))
+    deployed = deploy_replicas(conf)
+    backends = [(node, int(response[0].get('port')))
+                for node, response in deployed if response[1] == 200]
+    failed = [response for node, response in deployed
+              if response[1] != 200]
+
+    job_log(redis_cli, conf.get('job'),
+            'Health checking {} containers'.format(len(backends)))
+    healthy = check_backends_health(backends)
+    unhealthy = [backend for backend in backends if backend not in healthy]
+    if unhealthy:
+        # Roll back only the containers that never came up.
+        stop_backends(unhealthy, conf)
+        failed.extend([('The container {}:{} did not pass the health '
+                        'check\n'.format(node, port), 503)
+                       for node, port in unhealthy])
+    if failed and not healthy:
+        # The old containers are still routed, so nothing is down.
+        content, status_code = failed[0]
+        return Response(content, status=status_code)
+
+    swap_backends(redis_cli, conf, healthy)
+    drain_backends(old_backends, conf)
+    set_desired(redis_cli, conf, conf.get('multiplicator'),
+                deployed_digest(deployed))
+    return deployed_response(deployed, failed, conf)
+
+
+def scale_app(redis_cli, conf):
+    """
+    Start only the replicas missing to reach `multiplicator` (or drain and
+    stop only the extra ones) and update the routing incrementally. The
+    rest of the containers keep serving.
+    """
+    replicas = conf.get('multiplicator')
+    digest = (get_desired(redis_cli, conf) or {}).get('digest')
+    set_desired(redis_cli, conf, replicas, digest)
+    job_log(redis_cli, conf.get('job'),
+            'Scaling to {} replicas'.format(replicas))
+    started, stopped, unrouted, failed = reconcile(
+        redis_cli, conf, replicas, digest)
+    if failed and not started:
+        content, status_code = failed[0]
+        return Response(content, status=status_code)
+
+    warning = ''
+    if failed:
+        warning = '{} of {} replicas could not be deployed.\n'.format(
+            len(failed), len(failed) + len(started))
+    return Response(
+        '{}App successfully scaled to {} replicas ({} started, {} stopped)! '
+        'Go to http://{}\n'.format(warning, replicas, len(started),
+                                   len(stopped),
+                                   conf.get('application_address')))
+
+
+def deployed_response(deployed, failed, conf):
+    """
+    Let the client know where the application lives (and if some of the
+    replicas could not be deployed).
+    """
+    warning = ''
+    if failed:
+        warning = '{} of {} replicas could not be deployed.\n'.format(
+            len(failed), len(deployed))
+    return Response(
+        '{}App successfully deployed! Go to http://{}\n'.format(
+            warning, conf.get('application_address')))
+
+
+def submit_deploy(redis_cli, conf, action, mode, wait=True):
+    """
+    Queue the deploy as a job (the deploys of an application run one at a
+    time). Unless told not to wait, the response of the deploy is returned
+    once it is done; otherwise the id of the job is returned right away.
+    Scales only start or stop the difference with the running replicas.
+    """
+    if action == 'scale':
+        deploy = scale_app
+    elif mode == 'rolling':
+        deploy = rolling_deploy
+    else:
+        deploy = recreate_deploy
+    job_id = create_job(redis_cli, conf, action)
+    # The replicas are placed (and limited) with the resources of the app.
+    job_conf = dict(conf, job=job_id,
+                    resources=get_resources(redis_cli, conf))
+
+    def run():
+        with span(action, app_label(conf)):
+            return deploy(redis_cli, job_conf)
+
+    job = job_queue.submit(redis_cli, Job(
+        job_id, conf.get('application_address'), run))
+    if wait:
+        return job.wait()
+    return Response(json.dumps({
+        'id': job_id,
+        'status': '/jobs?id={}'.format(job_id),
+        'logs': '/jobs/logs?id={}'.format(job_id)
+    }), status=202, mimetype='application/json')
+
+
+def follow_job_log(redis_cli, job_id, offset=0):
+    """
+    Yield the lines of the job log as they are written, until the job is
+    finished.
+    """
+    while True:
+        # Read the status first, so no line written before the job
+        # finished is missed.
+        job = get_job(redis_cli, job_id) or {}
+        lines = read_job_log(redis_cli, job_id, offset)
+        for line in lines:
+            yield line + '\n'
+        offset += len(lines)
+        if job.get('status') in FINISHED or not job:
+            return
+        time.sleep(LOG_POLL_INTERVAL)
+
+
+def jobs_response(redis_cli, request):
+    """
+    The status (/jobs) or the output (/jobs/logs) of a job. The output is
+    streamed until the job is finished, unless follow=0.
+    """
+    job_id = request.args.get('id', '')
+    job = get_job(redis_cli, job_id)
+    if job is None:
+        return Response('There is no job {}\n'.format(job_id), status=404)
+    if request.path == '/jobs':
+        return Response(json.dumps(job), mimetype='application/json')
+
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return Response('"offset" must be an integer.\n', status=400)
+    if offset < 0:
+        return Response('"offset" must be 0 or more.\n', status=400)
+    if request.args.get('follow', '1') == '0':
+        return Response(
+            [line + '\n' for line in read_job_log(redis_cli, job_id, offset)],
+            mimetype='text/plain')
+    return Response(follow_job_log(redis_cli, job_id, offset),
+                    mimetype='text/plain', direct_passthrough=True)
+
+
+def apps_response(redis_cli, request):
+    """
+    List the deployed applications from the app index. Every app is listed
+    unless a "page" is asked for ("per_page" apps each, 1-based).
+    """
+    try:
+        page = int(request.args.get('page', 0))
+        per_page = int(request.args.get('per_page', APPS_PER_PAGE))
+    except ValueError:
+        return Response('"page" and "per_page" must be integers.\n',
+                        status=400)
+    if page < 0 or per_page < 1:
+        return Response('"page" must be 0 (every app) or more, and '
+                        '"per_page" 1 or more.\n', status=400)
+    if page > 0:
+        total, apps = list_apps(redis_cli, (page - 1) * per_page, per_page)
+    else:
+        total, apps = list_apps(redis_cli)
+
+    if request.args.get('format') == 'json':
+        return Response(json.dumps({
+            'total': total,
+            'page': page,
+            'per_page': per_page if page > 0 else total,
+            'apps': [{'address': address, 'replicas': replicas}
+                     for address, replicas in apps]
+        }), mimetype='application/json')
+    return Response(
+        [('--> {} (replicated in {} containers)\n'.format(
+            address, replicas)) for address, replicas in apps])
 
 
 @Request.application
@@ -28,14 +285,25 @@ def application(request):
     (user & repo params).
     """
     DOMAIN = os.environ.get('DOOKIO_DOMAIN', 'localhost')
+    # Either 'recreate' (stop everything, then start) or 'rolling'.
+    DEPLOY_MODE = os.environ.get('DOOKIO_DEPLOY_MODE', 'recreate')
     redis_cli = redis.StrictRedis(host='localhost', port=6379, db=0)
 
     # Dookio-cli: apps command
     if request.path == '/apps':
-        apps = fetch_apps(redis_cli)
-        return Response(
-            [('--> {} (replicated in {} containers)\n'.format(
-                app[app.find(":") + 1:], len(apps[app]))) for app in apps])
+        return apps_response(redis_cli, request)
+
+    if request.path == '/metrics':
+        return Response(expose(), mimetype='text/plain; version=0.0.4')
+
+    # Throughput, 5xx rate and latency percentiles of every app and backend
+    if request.path == '/stats':
+        return Response(json.dumps(load_stats(redis_cli).report()),
+                        mimetype='application/json')
+
+    # Status and output of the deploy jobs
+    if request.path in ('/jobs', '/jobs/logs'):
+        return jobs_response(redis_cli, request)
 
     # Pick up the proper params
     conf = {
@@ -52,27 +320,99 @@ def application(request):
             'There was a problem. Please be sure you are '
             'providing both "user", "repo"\n')
 
+    # Nodes: content manifest of the pushed code
+    if request.path == '/manifest':
+        try:
+            with span('manifest', app_label(conf)):
+                manifest = get_manifest(conf)
+        except OSError:
+            return Response('There is no code for {}/{}\n'.format(
+                conf.get('user'), conf.get('repo')), status=404)
+        return Response(json.dumps(manifest), mimetype='application/json')
+
+    # Warm containers kept by every node, claimed when scaling up
+    if request.path == '/warm':
+        try:
+            size = int(request.args.get('size', 0))
+            if size < 0:
+                raise ValueError()
+        except ValueError:
+            return Response('"size" must be a number of containers.\n',
+                            status=400)
+        set_warm_pool_size(redis_cli, conf, size)
+        return Response('Every node will keep {} warm containers of {}/{}\n'
+                        .format(size, conf.get('user'), conf.get('repo')))
+
+    # Scale the app with its traffic (turned off if no rps is given)
+    if request.path == '/autoscale':
+        if 'rps' not in request.args:
+            remove_policy(redis_cli, conf)
+            return Response('{}/{} is not autoscaled anymore\n'.format(
+                conf.get('user'), conf.get('repo')))
+        try:
+            minimum = int(request.args.get('min', 1))
+            maximum = int(request.args.get('max', minimum))
+            rps = float(request.args['rps'])
+            latency = request.args.get('latency')
+            latency = float(latency) if latency else None
+            if (minimum < 0 or maximum < minimum or rps <= 0 or
+                    (latency is not None and latency <= 0)):
+                raise ValueError()
+        except ValueError:
+            return Response(
+                'Invalid policy: "min" and "max" must be replicas (0 <= min '
+                '<= max), "rps" and "latency" positive numbers\n',
+                status=400)
+        set_policy(redis_cli, conf, minimum, maximum, rps, latency)
+        return Response('{}/{} will be scaled between {} and {} replicas\n'
+                        .format(conf.get('user'), conf.get('repo'), minimum,
+                                maximum))
+
+    # Resource limits of the containers, applied from the next deploy (or
+    # scale) on. They can also be given along with a deploy.
+    # An empty (or 0) memory/cpu_shares removes that limit.
+    if request.path in ('/', '/scale', '/resources') and (
+            'memory' in request.args or 'cpu_shares' in request.args):
+        memory = request.args.get('memory')
+        cpu_shares = request.args.get('cpu_shares')
+        try:
+            memory = parse_memory(memory) if memory is not None else None
+            cpu_shares = (parse_cpu_shares(cpu_shares)
+                          if cpu_shares is not None else None)
+        except ValueError:
+            return Response(
+                'Invalid resources: "memory" must be a size such as 512m '
+                'and "cpu_shares" a number of shares such as 512\n',
+                status=400)
+        set_resources(redis_cli, conf, memory, cpu_shares)
+    if request.path == '/resources':
+        return Response(json.dumps(get_resources(redis_cli, conf)),
+                        mimetype='application/json')
+
     # Dookio-cli: containers command
     action = conf.get('action')
     if request.path == '/containers':
         response_nodes = contact_nodes(conf)
-        if action == 'stop':
-            if was_applied(response_nodes):
-                remove_app_from_webserver_routing(redis_cli, conf)
+        if action in ('stop', 'remove'):
+            # Nothing of the app is left to route, reconcile or scale.
+            if (was_applied(response_nodes) or
+                    stopped_everywhere(response_nodes)):
+                remove_app(redis_cli, conf)
+                remove_desired(redis_cli, conf)
+                set_warm_pool_size(redis_cli, conf, 0)
+                remove_policy(redis_cli, conf)
         elif action == 'start':
-            if (was_applied(response_nodes) and
-                    not exist_application(redis_cli, conf)):
-                add_app_to_webserver_routing(redis_cli, conf)
+            backends = []
             for node_ip, response in response_nodes.iteritems():
                 # We only want to iterate over the valid responses.
                 status_code = response[1]
-                body = response[0][0]
                 if status_code == 200:
-                    port = body.get('Ports')[0].get('PublicPort')
-                    add_container_to_webserver_routing(redis_cli,
-                                                       node_ip,
-                                                       port,
-                                                       conf)
+                    backends.extend(
+                        (node_ip, container.get('Ports')[0].get('PublicPort'))
+                        for container in response[0])
+            if backends:
+                add_backends(redis_cli, conf, backends)
+                set_desired(redis_cli, conf, len(backends))
         resp = [{
             'node': node_ip,
             'containers': content[0]
@@ -86,33 +426,10 @@ def application(request):
                 'The app can not scale unless is running!\n')
 
     if request.path == '/scale' or request.path == '/':
-        user = conf.get('user')
-        repo = conf.get('repo')
-        # Stop all existing containers
-        conf['action'] = 'stop'
-        contact_nodes(conf)
-        conf['action'] = None
-        remove_app_from_webserver_routing(redis_cli, conf)
-        for i in range(conf.get('multiplicator')):
-            node = pick_up_node()
-            response = requests.get('{}:5000'.format(node),
-                                    params={'user': user, 'repo': repo})
-
-            if response.status_code == 200:
-                # Set up hipache webserver for the specified branch
-                container = json.loads(response.content)
-                if not exist_application(redis_cli, conf):
-                    add_app_to_webserver_routing(redis_cli, conf)
-                add_container_to_webserver_routing(redis_cli,
-                                                   node,
-                                                   container.get('port'),
-                                                   conf)
-            else:
-                return Response(response.content, status=response.status_code)
-
-        return Response(
-            'App successfully deployed! Go to http://{}\n'.format(
-                conf.get('application_address')))
+        return submit_deploy(
+            redis_cli, conf, 'scale' if request.path == '/scale' else 'deploy',
+            request.args.get('mode', DEPLOY_MODE),
+            wait=request.args.get('async') != '1')
     else:
         return Response(
             'Something went wrong! Are you using the proper parameters?. \n')
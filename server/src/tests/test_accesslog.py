@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.accesslog import LogTailer, parse_line
+
+LINE = ('10.0.0.1 - - [Tue, 18 Oct 2016 10:00:00 GMT] "GET / HTTP/1.1" '
+        '200 512 "-" "curl/7.35.0" "apache.git.example.com:80" 0.051 0.049')
+
+
+class ParseLineTestSuite(unittest.TestCase):
+    def test_parse_line(self):
+        assert parse_line(LINE) == {'frontend': 'apache.git.example.com',
+                                    'date': 'Tue, 18 Oct 2016 10:00:00 GMT',
+                                    'status': 200, 'total': 0.051,
+                                    'upstream': 0.049, 'backend': None}
+        request = parse_line(LINE + ' "http://0.0.0.0:4567"')
+        assert request['backend'] == 'http://0.0.0.0:4567'
+
+    def test_lines_without_times_or_host(self):
+        request = parse_line(LINE.rsplit(' ', 2)[0])
+        assert request['frontend'] == 'apache.git.example.com'
+        assert request['total'] is request['upstream'] is None
+        assert parse_line(LINE.rsplit(' ', 3)[0]) is None
+        assert parse_line('garbage') is None
+
+
+class LogTailerTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'access.log')
+        self.write('old\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data, mode='a'):
+        with open(self.path, mode) as f:
+            f.write(data)
+
+    def test_reads_start_at_the_end_and_wait_for_whole_lines(self):
+        tailer = LogTailer(self.path)
+        assert tailer.read() == []
+
+        self.write('a\nb')
+        assert tailer.read() == ['a']
+        self.write('\n')
+        assert tailer.read() == ['b']
+        assert tailer.position[1] == len('old\na\nb\n')
+
+    def test_reads_resume_from_a_position(self):
+        tailer = LogTailer(self.path)
+        tailer.read()
+        self.write('a\n')
+
+        assert LogTailer(self.path, tailer.position).read() == ['a']
+        assert LogTailer(self.path, (None, 0)).read() == ['old', 'a']
+
+    def test_rotated_log_is_finished_then_followed(self):
+        tailer = LogTailer(self.path)
+        tailer.read()
+        self.write('a\n')
+        os.rename(self.path, self.path + '.1')
+        self.write('b\n')
+
+        assert tailer.read() == ['a', 'b']
+        assert tailer.position[1] == 2
+
+    def test_rotated_log_is_finished_before_the_new_one_exists(self):
+        tailer = LogTailer(self.path)
+        tailer.read()
+        self.write('a\n')
+        os.rename(self.path, self.path + '.1')
+
+        assert tailer.read() == ['a']
+        self.write('b\n')
+        assert tailer.read() == ['b']
+
+    def test_truncated_log_is_read_from_the_start(self):
+        tailer = LogTailer(self.path)
+        tailer.read()
+        self.write('a\n', mode='w')
+
+        assert tailer.read() == ['a']
@@ -0,0 +1,123 @@
+import json
+import random
+import unittest
+from mock import Mock
+
+from src.analytics import (AccessStats,
+                           LatencySketch,
+                           load_stats,
+                           save_stats,
+                           parse_date,
+                           ACCESS_STATS_KEY)
+
+LINE = ('10.0.0.1 - - [Tue, 18 Oct 2016 10:00:{:02d} GMT] "GET / HTTP/1.1" '
+        '{} 512 "-" "curl/7.35.0" "{}" 0.1 {} "{}"')
+NODE = 'http://0.0.0.0:4567'
+
+
+class LatencySketchTestSuite(unittest.TestCase):
+    def test_quantiles_are_within_the_accuracy(self):
+        values = [random.expovariate(10) for _ in range(10000)]
+        sketch = LatencySketch(0.01)
+        for value in values:
+            sketch.add(value)
+
+        values.sort()
+        for q in (0.5, 0.95, 0.99):
+            expected = values[int(q * (len(values) - 1))]
+            assert abs(sketch.quantile(q) - expected) <= expected * 0.011
+        assert LatencySketch().quantile(0.5) is None
+
+    def test_merged_sketches_are_the_sketch_of_both(self):
+        first, second, both = LatencySketch(), LatencySketch(), LatencySketch()
+        for value in range(1, 100):
+            (first if value % 2 else second).add(value / 1000.0)
+            both.add(value / 1000.0)
+        both.add(0)
+        second.add(0)
+
+        first.merge(second)
+        assert first.count == both.count == 100
+        assert first.buckets == both.buckets
+        assert first.quantile(0.99) == both.quantile(0.99)
+
+    def test_sketches_round_trip_through_json(self):
+        sketch = LatencySketch()
+        sketch.add(0.05, count=3)
+        copy = LatencySketch.from_dict(json.loads(json.dumps(
+            sketch.to_dict())))
+
+        assert copy.count == 3
+        assert copy.quantile(0.5) == sketch.quantile(0.5)
+
+
+class AccessStatsTestSuite(unittest.TestCase):
+    def tailer(self, lines, position=(1, 100)):
+        return Mock(**{'read.return_value': lines, 'position': position})
+
+    def test_parse_date(self):
+        assert parse_date('Tue, 18 Oct 2016 10:00:00 GMT') == 1476784800
+        assert parse_date('18/Oct/2016:10:00:00 +0000') == 1476784800
+        assert parse_date('yesterday') is None
+
+    def test_traffic_of_apps_and_backends(self):
+        stats = AccessStats()
+        lines = [LINE.format(second, 200, 'apache.git.example.com', 0.05,
+                             NODE) for second in range(10)]
+        lines.append(LINE.format(10, 502, 'apache.git.example.com', 0.5,
+                                 NODE))
+        lines.append('garbage')
+
+        assert stats.update(self.tailer(lines)) == 12
+        assert stats.position == (1, 100)
+        report = stats.report()
+        app = report['apps']['apache.git.example.com']
+        assert app['requests'] == 11
+        assert app['rps'] == 1.1
+        assert abs(app['error_rate'] - 1 / 11.0) < 1e-9
+        assert abs(app['p50'] - 0.05) < 0.05 * 0.01
+        assert abs(app['p99'] - 0.05) < 0.05 * 0.01
+        slowest = stats.apps['apache.git.example.com'].latency.quantile(1)
+        assert abs(slowest - 0.5) < 0.5 * 0.01
+        assert report['backends'][NODE]['requests'] == 11
+
+    def test_stats_resume_from_redis(self):
+        redis_cli = Mock()
+        stats = AccessStats()
+        stats.update(self.tailer([LINE.format(
+            0, 200, 'apache.git.example.com', 0.05, NODE)]))
+        save_stats(redis_cli, stats)
+
+        key, data = redis_cli.set.call_args[0]
+        assert key == ACCESS_STATS_KEY
+        redis_cli.get.return_value = data
+        loaded = load_stats(redis_cli)
+        assert loaded.position == (1, 100)
+        assert loaded.report() == stats.report()
+
+        redis_cli.get.return_value = None
+        assert load_stats(redis_cli).position == (None, 0)
+
+    def test_merge(self):
+        first, second = AccessStats(), AccessStats()
+        first.update(self.tailer([LINE.format(
+            0, 200, 'apache.git.example.com', 0.05, NODE)]))
+        second.update(self.tailer([LINE.format(
+            9, 500, 'apache.git.example.com', 0.05, NODE)]))
+
+        first.merge(second)
+        app = first.report()['apps']['apache.git.example.com']
+        assert app['requests'] == 2
+        assert app['error_rate'] == 0.5
+
+    def test_apps_and_backends_without_recent_requests_are_pruned(self):
+        stats = AccessStats()
+        stats.update(self.tailer([
+            LINE.format(0, 200, 'old.git.example.com', 0.05, NODE),
+            LINE.format(30, 200, 'apache.git.example.com', 0.05,
+                        'http://0.0.0.1:4567')]))
+
+        assert stats.prune(parse_date('Tue, 18 Oct 2016 10:00:10 GMT')) == 2
+        assert stats.apps.keys() == ['apache.git.example.com']
+        assert stats.backends.keys() == ['http://0.0.0.1:4567']
+        assert stats.prune(0) == 0
@@ -0,0 +1,135 @@
+import json
+import time
+import unittest
+from mock import Mock, patch
+
+from src.autoscaler import (Autoscaler,
+                            SlidingWindow,
+                            desired_replicas,
+                            set_policy,
+                            AUTOSCALE_KEY)
+
+ADDRESS = 'apache.git.example.com'
+LINE = ('10.0.0.1 - - [Tue, 18 Oct 2016 10:00:00 GMT] "GET / HTTP/1.1" '
+        '200 512 "-" "curl/7.35.0" "{}" 0.051 {}')
+
+
+@patch('src.autoscaler.AUTOSCALE_TOLERANCE', 0.1)
+class DesiredReplicasTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.policy = {'min': 1, 'max': 5, 'rps': 10, 'latency': None}
+
+    def test_replicas_follow_the_request_rate(self):
+        assert desired_replicas(2, 40, None, self.policy) == 4
+        assert desired_replicas(4, 10, None, self.policy) == 1
+
+    def test_loads_close_to_the_target_keep_the_replicas(self):
+        assert desired_replicas(2, 21, None, self.policy) == 2
+        assert desired_replicas(2, 19, None, self.policy) == 2
+
+    def test_replicas_stay_within_the_policy(self):
+        assert desired_replicas(2, 1000, None, self.policy) == 5
+        assert desired_replicas(2, 0, None, self.policy) == 1
+
+    def test_slow_backends_scale_up(self):
+        self.policy['latency'] = 0.1
+        assert desired_replicas(2, 20, 0.2, self.policy) == 4
+        assert desired_replicas(2, 20, None, self.policy) == 2
+
+
+class SlidingWindowTestSuite(unittest.TestCase):
+    def test_old_buckets_leave_the_window(self):
+        window = SlidingWindow(60)
+        window.add(100, 600, 6.0, 600)
+        window.add(130, 600, 18.0, 600)
+
+        assert window.rate(150, 1000) == 20
+        assert window.latency(150) == 0.02
+        assert window.rate(170, 1000) == 10
+        assert window.latency(170) == 0.03
+
+    def test_rate_of_a_window_that_did_not_fill_up(self):
+        window = SlidingWindow(60)
+        window.add(100, 300, 0, 0)
+
+        assert window.rate(100, 10) == 30
+        assert window.latency(100) is None
+
+
+@patch('src.autoscaler.SCALE_UP_COOLDOWN', 60)
+@patch('src.autoscaler.SCALE_DOWN_COOLDOWN', 300)
+class AutoscalerTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.conf = {'user': 'git', 'repo': 'apache',
+                     'application_address': ADDRESS}
+        self.policy = dict(self.conf, min=1, max=5, rps=10, latency=None)
+        self.redis_cli = Mock()
+        self.redis_cli.hgetall.side_effect = lambda key: {
+            AUTOSCALE_KEY: {'git/apache': json.dumps(self.policy)},
+            'dookio:desired': {'git/apache': json.dumps(dict(
+                self.conf, replicas=2, updated=time.time() - 3600))}
+        }[key]
+        self.autoscaler = Autoscaler(self.redis_cli, path='/dev/null')
+        self.autoscaler.started -= 3600
+        self.autoscaler.tailer = Mock()
+
+    def test_set_policy(self):
+        set_policy(self.redis_cli, self.conf, 1, 5, 10)
+
+        key, app, policy = self.redis_cli.hset.call_args[0]
+        assert (key, app) == (AUTOSCALE_KEY, 'git/apache')
+        assert json.loads(policy) == self.policy
+
+    def test_requests_are_counted_per_frontend(self):
+        self.autoscaler.tailer.read.return_value = [
+            LINE.format(ADDRESS, 0.1), LINE.format(ADDRESS, 0.3),
+            LINE.format('nginx.git.example.com', 0.1), 'garbage']
+
+        assert self.autoscaler.collect(1000) == 4
+        window = self.autoscaler._windows[ADDRESS]
+        assert window.rate(1000, 60) == 2 / 60.0
+        assert abs(window.latency(1000) - 0.2) < 1e-9
+
+    def test_busy_apps_are_scaled_through_the_server(self):
+        self.autoscaler.tailer.read.return_value = [
+            LINE.format(ADDRESS, 0.1)] * 2400
+
+        with patch('src.autoscaler.requests.get') as get:
+            get.return_value = Mock(status_code=202)
+            assert self.autoscaler.tick() == [(ADDRESS, 4)]
+            assert get.call_args[1]['params']['multiplicator'] == 4
+
+            # Cooling down until the scale is done (and some more).
+            assert self.autoscaler.tick() == []
+
+    def test_idle_apps_are_scaled_down_after_the_cooldown(self):
+        self.autoscaler.tailer.read.return_value = []
+        now = time.time()
+
+        assert self.autoscaler.decide(now) == [(self.policy, 2, 1)]
+        self.autoscaler._scaled[ADDRESS] = now - 100
+        assert self.autoscaler.decide(now) == []
+
+    def test_a_broken_policy_does_not_stop_the_other_apps(self):
+        broken = dict(self.policy, application_address='nginx.git.example.com',
+                      repo='nginx', rps=0)
+        self.redis_cli.hgetall.side_effect = lambda key: {
+            AUTOSCALE_KEY: {'git/nginx': json.dumps(broken),
+                            'git/apache': json.dumps(self.policy)},
+            'dookio:desired': dict(
+                (app, json.dumps(dict(policy, replicas=2,
+                                      updated=time.time() - 3600)))
+                for app, policy in (('git/nginx', broken),
+                                    ('git/apache', self.policy)))
+        }[key]
+        self.autoscaler.tailer.read.return_value = []
+
+        decisions = self.autoscaler.decide(time.time())
+        assert [policy['repo'] for policy, _, _ in decisions] == ['apache']
+
+    def test_apps_without_desired_state_are_not_scaled(self):
+        self.redis_cli.hgetall.side_effect = lambda key: {
+            AUTOSCALE_KEY: {'git/apache': json.dumps(self.policy)}
+        }.get(key, {})
+
+        assert self.autoscaler.decide(time.time()) == []
@@ -0,0 +1,89 @@
+import unittest
+import requests
+from mock import Mock, patch
+
+from src.health import HealthMonitor, app_conf, probe
+
+GOOD = 'http://0.0.0.0:4567'
+BAD = 'http://0.0.0.0:4568'
+ADDRESS = 'apache.git.example.com'
+NAME = 'git/apache'
+CONF = {'application_address': ADDRESS, 'user': 'git', 'repo': 'apache'}
+
+
+class HealthTestSuite(unittest.TestCase):
+    def test_app_conf(self):
+        assert app_conf(ADDRESS, NAME) == CONF
+        # The repo is not read from the address, which may be ambiguous.
+        assert app_conf('my.site.git.example.com', 'git/my.site') == {
+            'application_address': 'my.site.git.example.com',
+            'user': 'git', 'repo': 'my.site'}
+        assert app_conf(ADDRESS) == {'application_address': ADDRESS,
+                                     'user': None, 'repo': None}
+
+    @patch('src.health.requests.get')
+    def test_probe(self, get):
+        get.return_value = Mock(status_code=404)
+        assert probe(GOOD)
+        get.return_value = Mock(status_code=502)
+        assert not probe(GOOD)
+        get.side_effect = requests.exceptions.ConnectionError()
+        assert not probe(GOOD)
+
+
+@patch('src.health.HEALTH_FALL', 2)
+@patch('src.health.HEALTH_RISE', 2)
+@patch('src.health.probe', lambda backend: backend == GOOD)
+class HealthMonitorTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.redis_cli = Mock()
+        self.redis_cli.zrange.return_value = ['frontend:' + ADDRESS]
+        self.monitor = HealthMonitor(self.redis_cli, workers=2)
+
+    def route(self, routed, evicted):
+        self.redis_cli.pipeline.return_value.execute.return_value = [
+            [NAME], routed, evicted]
+
+    def test_targets_are_read_in_one_round_trip(self):
+        self.route([GOOD], {BAD: '100'})
+
+        assert self.monitor.targets() == [(CONF, GOOD, None),
+                                          (CONF, BAD, 100.0)]
+        pipe = self.redis_cli.pipeline.return_value
+        pipe.hmget.assert_called_once_with('dookio:apps:names',
+                                           ['frontend:' + ADDRESS])
+        pipe.lrange.assert_called_once_with('frontend:' + ADDRESS, 1, -1)
+        pipe.hgetall.assert_called_once_with('dookio:evicted:' + ADDRESS)
+
+    @patch('src.health.evict_backend')
+    def test_failing_backend_is_evicted_after_the_threshold(self, evict):
+        self.route([GOOD, BAD], {})
+
+        assert self.monitor.check() == ([], [])
+        assert not evict.called
+        assert self.monitor.check() == ([(ADDRESS, BAD)], [])
+        evict.assert_called_once_with(self.redis_cli, CONF, BAD)
+
+    @patch('src.health.evict_backend', return_value=None)
+    def test_last_backend_is_not_reported_as_evicted(self, evict):
+        self.route([BAD], {})
+
+        self.monitor.check()
+        assert self.monitor.check() == ([], [])
+        assert evict.called
+
+    @patch('src.health.readmit_backend')
+    def test_recovered_backend_is_readmitted(self, readmit):
+        self.route([], {GOOD: str(10 ** 10)})
+
+        assert self.monitor.check() == ([], [])
+        assert self.monitor.check() == ([], [(ADDRESS, GOOD)])
+        readmit.assert_called_once_with(self.redis_cli, CONF, GOOD)
+
+    @patch('src.health.EVICTED_TTL', 60)
+    @patch('src.health.forget_backends')
+    def test_backends_evicted_for_too_long_are_forgotten(self, forget):
+        self.route([GOOD], {BAD: '100'})
+
+        self.monitor.check()
+        forget.assert_called_once_with(self.redis_cli, CONF, [BAD])
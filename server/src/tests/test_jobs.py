@@ -0,0 +1,104 @@
+import threading
+import unittest
+from mock import Mock, patch
+from werkzeug.wrappers import Response
+
+from src.jobs import (Job,
+                      JobQueue,
+                      create_job,
+                      finish_job,
+                      fail_interrupted_jobs,
+                      ACTIVE_JOBS_KEY)
+
+
+class JobsTestSuite(unittest.TestCase):
+    def test_create_job_is_queued(self):
+        redis_cli = Mock()
+        pipe = redis_cli.pipeline.return_value
+        job_id = create_job(redis_cli, {'user': 'git', 'repo': 'apache'},
+                            'deploy')
+
+        key, job = pipe.hmset.call_args[0]
+        assert key == 'dookio:job:{}'.format(job_id)
+        assert job['status'] == 'queued'
+        assert job['action'] == 'deploy'
+        pipe.sadd.assert_called_once_with(ACTIVE_JOBS_KEY, job_id)
+
+    @patch('src.jobs.JOB_TTL', 60)
+    def test_finish_job_stores_the_result_and_expires(self):
+        redis_cli = Mock()
+        pipe = redis_cli.pipeline.return_value
+        finish_job(redis_cli, 'abc', 400, 'Node unreachable\n')
+
+        job = pipe.hmset.call_args[0][1]
+        assert job['status'] == 'failed'
+        assert job['status_code'] == 400
+        pipe.rpush.assert_called_once_with(
+            'dookio:job:abc:log', 'Node unreachable')
+        pipe.expire.assert_any_call('dookio:job:abc', 60)
+        pipe.srem.assert_called_once_with(ACTIVE_JOBS_KEY, 'abc')
+
+    def test_fail_interrupted_jobs(self):
+        redis_cli = Mock()
+        redis_cli.smembers.return_value = set(['abc'])
+        redis_cli.hget.return_value = 'running'
+
+        assert fail_interrupted_jobs(redis_cli) == 1
+        pipe = redis_cli.pipeline.return_value
+        assert pipe.hmset.call_args[0][1]['status'] == 'failed'
+
+    def test_fail_the_jobs_queued_when_the_server_stopped(self):
+        redis_cli = Mock()
+        redis_cli.smembers.return_value = set(['abc', 'def', 'ghi'])
+        redis_cli.hget.side_effect = lambda key, field: {
+            'dookio:job:abc': 'queued',
+            'dookio:job:def': 'succeeded'}.get(key)
+
+        assert fail_interrupted_jobs(redis_cli) == 1
+        pipe = redis_cli.pipeline.return_value
+        job = pipe.hmset.call_args[0][1]
+        assert job['status'] == 'failed'
+        assert 'still queued' in job['result']
+        # The finished and expired ones are only dropped from the set.
+        redis_cli.srem.assert_any_call(ACTIVE_JOBS_KEY, 'def')
+        redis_cli.srem.assert_any_call(ACTIVE_JOBS_KEY, 'ghi')
+
+
+class JobQueueTestSuite(unittest.TestCase):
+    def test_jobs_of_the_same_app_run_one_at_a_time(self):
+        queue = JobQueue(4)
+        release = threading.Event()
+        running = []
+
+        def run(name):
+            def deploy():
+                running.append(name)
+                release.wait(2)
+                return Response(name)
+            return deploy
+
+        first = queue.submit(Mock(), Job('1', 'app', run('first')))
+        second = queue.submit(Mock(), Job('2', 'app', run('second')))
+        other = queue.submit(Mock(), Job('3', 'other',
+                                         lambda: Response('other')))
+
+        assert other.wait(2).get_data() == 'other'
+        assert 'second' not in running
+        assert queue.pending('app') == 1
+        release.set()
+        assert first.wait(2).get_data() == 'first'
+        assert second.wait(2).get_data() == 'second'
+        assert running.index('first') < running.index('second')
+
+    def test_a_failing_job_does_not_block_the_app(self):
+        queue = JobQueue(1)
+
+        def fail():
+            raise Exception('Boom')
+
+        failed = queue.submit(Mock(), Job('1', 'app', fail))
+        ok = queue.submit(Mock(), Job('2', 'app', lambda: Response('ok')))
+
+        assert failed.wait(2).status_code == 500
+        assert 'Boom' in failed.response.get_data()
+        assert ok.wait(2).get_data() == 'ok'
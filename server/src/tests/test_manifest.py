@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+import hashlib
+import threading
+from mock import patch
+
+from src.manifest import build_manifest, get_manifest
+
+
+class ManifestTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.code = os.path.join(self.root, 'git', 'apache', 'code')
+        os.makedirs(os.path.join(self.code, 'conf'))
+        with open(os.path.join(self.code, 'Dockerfile'), 'w') as f:
+            f.write('FROM ubuntu\n')
+        with open(os.path.join(self.code, 'conf', 'apache.conf'), 'w') as f:
+            f.write('Listen 80\n')
+        os.symlink('Dockerfile', os.path.join(self.code, 'link'))
+        os.makedirs(os.path.join(self.code, 'logs'))
+        self.push()
+
+    def push(self):
+        path = os.path.join(self.root, 'git', 'apache', 'push')
+        pushes = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                pushes = int(f.read())
+        with open(path, 'w') as f:
+            f.write('{}\n'.format(pushes + 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_build_manifest(self):
+        manifest = build_manifest(self.code)
+
+        assert sorted(manifest) == [
+            'Dockerfile', 'conf', 'conf/apache.conf', 'link', 'logs']
+        assert manifest['Dockerfile']['sha1'] == hashlib.sha1(
+            'FROM ubuntu\n').hexdigest()
+        assert manifest['link'] == {'link': 'Dockerfile'}
+        assert manifest['logs']['dir']
+
+    @patch('src.manifest.build_manifest')
+    def test_get_manifest_is_cached_until_the_next_push(
+            self, mock_build_manifest):
+        conf = {'user': 'git', 'repo': 'apache'}
+        with patch('src.manifest.CODE_ROOT', self.root):
+            get_manifest(conf)
+            # Changed in place (same directory) but not pushed yet.
+            os.remove(os.path.join(self.code, 'link'))
+            get_manifest(conf)
+            assert mock_build_manifest.call_count == 1
+
+            self.push()
+            get_manifest(conf)
+            assert mock_build_manifest.call_count == 2
+
+    @patch('src.manifest.build_manifest')
+    def test_get_manifest_is_not_cached_without_a_push_count(
+            self, mock_build_manifest):
+        conf = {'user': 'git', 'repo': 'apache'}
+        os.remove(os.path.join(self.root, 'git', 'apache', 'push'))
+        with patch('src.manifest.CODE_ROOT', self.root):
+            get_manifest(conf)
+            get_manifest(conf)
+            assert mock_build_manifest.call_count == 2
+
+    def test_concurrent_requests_build_the_manifest_once(self):
+        conf = {'user': 'git', 'repo': 'apache'}
+        started = threading.Event()
+        release = threading.Event()
+        builds = []
+
+        def slow_build(root):
+            builds.append(root)
+            started.set()
+            release.wait(5)
+            return {}
+
+        with patch('src.manifest.CODE_ROOT', self.root):
+            with patch('src.manifest.build_manifest', slow_build):
+                self.push()
+                first = threading.Thread(target=get_manifest, args=(conf,))
+                first.start()
+                started.wait(5)
+                second = threading.Thread(target=get_manifest, args=(conf,))
+                second.start()
+                release.set()
+                first.join()
+                second.join()
+
+        assert len(builds) == 1
+
+    def test_get_manifest_when_there_is_no_code(self):
+        conf = {'user': 'git', 'repo': 'unknown'}
+        with patch('src.manifest.CODE_ROOT', self.root):
+            self.assertRaises(OSError, get_manifest, conf)
@@ -0,0 +1,299 @@
+import json
+import time
+import unittest
+from mock import Mock, patch
+
+from src.reconciler import (Reconciler,
+                            plan,
+                            image_digest,
+                            outdated_backends,
+                            reconcile_app,
+                            reported_backends,
+                            set_desired,
+                            deployed_digest,
+                            DESIRED_KEY)
+
+NODE = 'http://0.0.0.0'
+OTHER = 'http://123.123.123.123'
+
+
+class PlanTestSuite(unittest.TestCase):
+    def test_nothing_to_do(self):
+        backends = [(NODE, 4567), (OTHER, 4567)]
+
+        assert plan(2, backends, backends, []) == (0, [], [], [], [])
+
+    def test_missing_replicas_are_started_and_dead_ones_unrouted(self):
+        start, unroute, route, stop, replace = plan(
+            3, [(NODE, 4567)], [(NODE, 4567), (OTHER, 4567)], [])
+
+        assert start == 2
+        assert unroute == [(OTHER, 4567)]
+        assert route == stop == []
+
+    def test_running_containers_are_routed_again(self):
+        assert plan(2, [(NODE, 4567), (NODE, 4568)], [(NODE, 4567)], []) == (
+            0, [], [(NODE, 4568)], [], [])
+
+    def test_extra_replicas_are_stopped_evicted_ones_first(self):
+        actual = [(NODE, 4567), (NODE, 4568), (OTHER, 4567)]
+        start, unroute, route, stop, replace = plan(
+            1, actual, [(NODE, 4567), (OTHER, 4567)], [(NODE, 4568)])
+
+        assert start == 0
+        assert stop == [(NODE, 4568), (OTHER, 4567)]
+
+    def test_evicted_replicas_are_replaced(self):
+        start, unroute, route, stop, replace = plan(
+            2, [(NODE, 4567), (OTHER, 4567)], [(NODE, 4567)], [(OTHER, 4567)])
+
+        assert start == 1
+        assert stop == []
+
+    def test_replicas_of_another_image_are_replaced(self):
+        backends = [(NODE, 4567), (OTHER, 4567)]
+        start, unroute, route, stop, replace = plan(
+            2, backends, backends, [], [(OTHER, 4567)])
+
+        assert start == 1
+        assert route == stop == []
+        assert replace == [(OTHER, 4567)]
+
+    def test_outdated_backends(self):
+        images = {(NODE, 4567): 'git/apache:abc',
+                  (NODE, 4568): 'git/apache:def',
+                  (OTHER, 4567): 'git/apache'}
+
+        assert outdated_backends(images, 'abc') == [(NODE, 4568)]
+        assert outdated_backends(images, None) == []
+        assert image_digest('git/apache:latest') is None
+        assert image_digest('localhost:5000/git/apache') is None
+
+
+class ReconcilerTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.conf = {
+            'user': 'git',
+            'repo': 'apache',
+            'application_address': 'apache.git.example.com'
+        }
+        self.state = dict(self.conf, replicas=2, digest='abc',
+                          updated=time.time() - 3600)
+
+    def test_set_desired(self):
+        redis_cli = Mock()
+        set_desired(redis_cli, self.conf, 2, 'abc')
+
+        key, app, state = redis_cli.hset.call_args[0]
+        assert (key, app) == (DESIRED_KEY, 'git/apache')
+        assert json.loads(state)['replicas'] == 2
+        assert json.loads(state)['digest'] == 'abc'
+
+    def test_deployed_digest(self):
+        assert deployed_digest([(NODE, ('Node unreachable', 503)),
+                                (OTHER, ({'digest': 'abc'}, 200))]) == 'abc'
+        assert deployed_digest([]) is None
+
+    def test_reported_backends(self):
+        reports = {NODE: {'ports': {'git_apache': [4567, 4568]},
+                          'images': {'git_apache': {'4567': 'git/apache:a'}}},
+                   OTHER: {'ports': {'git_nginx': [4567]}}}
+
+        assert reported_backends(reports, self.conf) == (
+            [(NODE, 4567), (NODE, 4568)], {(NODE, 4567): 'git/apache:a'},
+            set())
+        assert reported_backends({NODE: {'cpus': 1}}, self.conf) == (
+            [], {}, set([NODE]))
+
+    @patch('src.reconciler.live_nodes')
+    def test_apps_that_diverged(self, mock_live_nodes):
+        redis_cli = Mock()
+        redis_cli.hgetall.return_value = {'git/apache': json.dumps(
+            self.state)}
+        redis_cli.pipeline.return_value.execute.return_value = [
+            ['{}:4567'.format(NODE)], []]
+        mock_live_nodes.return_value = {
+            NODE: {'ports': {'git_apache': [4567]}}}
+        reconciler = Reconciler(redis_cli, queue=Mock(**{
+            'busy.return_value': False}))
+
+        assert reconciler.diverged() == [self.state]
+
+        mock_live_nodes.return_value = {
+            NODE: {'ports': {'git_apache': [4567]}},
+            OTHER: {'ports': {'git_apache': [4567]}}}
+        redis_cli.pipeline.return_value.execute.return_value = [
+            ['{}:4567'.format(NODE), '{}:4567'.format(OTHER)], []]
+        assert reconciler.diverged() == []
+
+        mock_live_nodes.return_value = {
+            NODE: {'ports': {'git_apache': [4567]},
+                   'images': {'git_apache': {'4567': 'git/apache:old'}}},
+            OTHER: {'ports': {'git_apache': [4567]}}}
+        assert reconciler.diverged() == [self.state]
+
+    @patch('src.reconciler.live_nodes')
+    def test_nodes_without_a_report_of_their_containers_are_skipped(
+            self, mock_live_nodes):
+        redis_cli = Mock()
+        redis_cli.hgetall.return_value = {'git/apache': json.dumps(
+            self.state)}
+        redis_cli.pipeline.return_value.execute.return_value = [
+            ['{}:4567'.format(NODE), '{}:4567'.format(OTHER)], []]
+        mock_live_nodes.return_value = {
+            NODE: {'ports': {'git_apache': []}},
+            OTHER: {'cpus': 1}}
+        reconciler = Reconciler(redis_cli, queue=Mock(**{
+            'busy.return_value': False}))
+
+        # The container of NODE is gone, OTHER's is taken for granted.
+        assert reconciler.diverged() == [self.state]
+
+        mock_live_nodes.return_value = {
+            NODE: {'ports': {'git_apache': [4567]}},
+            OTHER: {'cpus': 1}}
+        assert reconciler.diverged() == []
+
+    @patch('src.reconciler.live_nodes')
+    def test_recently_deployed_and_busy_apps_are_left_alone(
+            self, mock_live_nodes):
+        redis_cli = Mock()
+        mock_live_nodes.return_value = {NODE: {'ports': {}}}
+        queue = Mock(**{'busy.return_value': True})
+        redis_cli.hgetall.return_value = {'git/apache': json.dumps(
+            self.state)}
+
+        assert Reconciler(redis_cli, queue).diverged() == []
+
+        queue.busy.return_value = False
+        redis_cli.hgetall.return_value = {'git/apache': json.dumps(
+            dict(self.state, updated=time.time()))}
+        assert Reconciler(redis_cli, queue).diverged() == []
+
+    @patch('src.reconciler.create_job', Mock(return_value='abc'))
+    def test_sweep_queues_a_job_per_diverged_app(self):
+        queue = Mock()
+        reconciler = Reconciler(Mock(), queue)
+        with patch.object(reconciler, 'diverged',
+                          return_value=[self.state]):
+            assert reconciler.sweep() == ['abc']
+
+        job = queue.submit.call_args[0][1]
+        assert job.app == 'apache.git.example.com'
+
+    @patch('src.reconciler.get_resources', Mock(return_value={}))
+    @patch('src.reconciler.contact_nodes')
+    @patch('src.reconciler.get_app_backends')
+    @patch('src.reconciler.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.reconciler.deploy_replicas')
+    @patch('src.reconciler.check_backends_health')
+    @patch('src.reconciler.remove_backends')
+    @patch('src.reconciler.add_backends')
+    def test_reconcile_app_restores_the_missing_replicas(
+            self, mock_add_backends, mock_remove_backends,
+            mock_check_backends_health, mock_deploy_replicas,
+            mock_get_app_backends, mock_contact_nodes):
+        redis_cli = Mock()
+        redis_cli.hget.return_value = json.dumps(self.state)
+        mock_contact_nodes.return_value = {
+            NODE: ([{'Ports': [{'PublicPort': 4567}]}], 200),
+            OTHER: ([], 200)}
+        mock_get_app_backends.return_value = [(NODE, 4567), (OTHER, 4567)]
+        mock_deploy_replicas.return_value = [(OTHER, ({'port': '4568'}, 200))]
+        mock_check_backends_health.side_effect = lambda backends: backends
+
+        response = reconcile_app(redis_cli, self.conf)
+
+        assert response.status_code == 200
+        conf = dict(self.conf, resources={})
+        mock_remove_backends.assert_called_once_with(
+            redis_cli, conf, [(OTHER, 4567)])
+        mock_deploy_replicas.assert_called_once_with(
+            dict(conf, multiplicator=1, digest='abc'))
+        mock_add_backends.assert_called_once_with(
+            redis_cli, conf, [(OTHER, 4568)])
+
+    @patch('src.reconciler.get_resources', Mock(return_value={}))
+    @patch('src.reconciler.contact_nodes')
+    @patch('src.reconciler.get_app_backends')
+    @patch('src.reconciler.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.reconciler.claim_warm_replicas')
+    @patch('src.reconciler.deploy_replicas')
+    @patch('src.reconciler.check_backends_health')
+    @patch('src.reconciler.add_backends')
+    def test_warm_containers_are_claimed_before_starting_new_ones(
+            self, mock_add_backends, mock_check_backends_health,
+            mock_deploy_replicas, mock_claim_warm_replicas,
+            mock_get_app_backends, mock_contact_nodes):
+        redis_cli = Mock()
+        redis_cli.hget.return_value = json.dumps(self.state)
+        mock_contact_nodes.return_value = {NODE: ([], 200)}
+        mock_get_app_backends.return_value = []
+        mock_claim_warm_replicas.return_value = [(NODE, 4567), (OTHER, 4567)]
+        mock_check_backends_health.side_effect = lambda backends: backends
+
+        response = reconcile_app(redis_cli, self.conf)
+
+        assert response.status_code == 200
+        conf = dict(self.conf, resources={})
+        mock_claim_warm_replicas.assert_called_once_with(conf, 2, 'abc')
+        assert not mock_deploy_replicas.called
+        mock_add_backends.assert_called_once_with(
+            redis_cli, conf, [(NODE, 4567), (OTHER, 4567)])
+
+    @patch('src.reconciler.get_resources', Mock(return_value={}))
+    @patch('src.reconciler.contact_nodes')
+    @patch('src.reconciler.get_app_backends')
+    @patch('src.reconciler.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.reconciler.deploy_replicas')
+    @patch('src.reconciler.remove_backends')
+    def test_backends_of_unreachable_nodes_are_left_alone(
+            self, mock_remove_backends, mock_deploy_replicas,
+            mock_get_app_backends, mock_contact_nodes):
+        redis_cli = Mock()
+        redis_cli.hget.return_value = json.dumps(self.state)
+        mock_contact_nodes.return_value = {
+            NODE: ([{'Ports': [{'PublicPort': 4567}]}], 200),
+            OTHER: ('Node unreachable', 503)}
+        mock_get_app_backends.return_value = [(NODE, 4567), (OTHER, 4567)]
+
+        reconcile_app(redis_cli, self.conf)
+
+        assert not mock_remove_backends.called
+        assert not mock_deploy_replicas.called
+
+    @patch('src.reconciler.get_resources', Mock(return_value={}))
+    @patch('src.reconciler.contact_nodes')
+    @patch('src.reconciler.get_app_backends')
+    @patch('src.reconciler.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.reconciler.deploy_replicas')
+    @patch('src.reconciler.check_backends_health')
+    @patch('src.reconciler.add_backends')
+    @patch('src.reconciler.remove_backends')
+    @patch('src.reconciler.drain_backends')
+    def test_replicas_of_another_image_are_replaced_once_theirs_start(
+            self, mock_drain_backends, mock_remove_backends,
+            mock_add_backends, mock_check_backends_health,
+            mock_deploy_replicas, mock_get_app_backends, mock_contact_nodes):
+        redis_cli = Mock()
+        redis_cli.hget.return_value = json.dumps(self.state)
+        mock_contact_nodes.return_value = {
+            NODE: ([{'Ports': [{'PublicPort': 4567}],
+                     'Image': 'git/apache:abc'}], 200),
+            OTHER: ([{'Ports': [{'PublicPort': 4567}],
+                      'Image': 'git/apache:old'}], 200)}
+        mock_get_app_backends.return_value = [(NODE, 4567), (OTHER, 4567)]
+        mock_deploy_replicas.return_value = [(OTHER, ({'port': '4568'}, 200))]
+        mock_check_backends_health.side_effect = lambda backends: backends
+
+        response = reconcile_app(redis_cli, self.conf)
+
+        assert response.status_code == 200
+        conf = dict(self.conf, resources={})
+        mock_deploy_replicas.assert_called_once_with(
+            dict(conf, multiplicator=1, digest='abc'))
+        mock_add_backends.assert_called_once_with(
+            redis_cli, conf, [(OTHER, 4568)])
+        mock_remove_backends.assert_called_once_with(
+            redis_cli, conf, [(OTHER, 4567)])
+        mock_drain_backends.assert_called_once_with([(OTHER, 4567)], conf)
@@ -0,0 +1,100 @@
+import json
+import unittest
+from mock import Mock
+
+from src.registry import (live_nodes,
+                          node_report,
+                          set_warm_pool_size,
+                          set_resources,
+                          get_resources,
+                          parse_memory,
+                          parse_cpu_shares)
+
+
+class NodeRegistryTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.redis_cli = Mock()
+        self.pipe = self.redis_cli.pipeline.return_value
+        self.report = {'cpus': 2, 'load': 0.5}
+
+    def test_live_nodes_with_their_reports(self):
+        self.pipe.execute.return_value = [1, ['http://0.0.0.0',
+                                              'http://123.123.123.123']]
+        self.redis_cli.mget.return_value = [json.dumps(self.report), None]
+
+        nodes = live_nodes(self.redis_cli)
+
+        assert nodes == {'http://0.0.0.0': self.report}
+        assert self.pipe.zremrangebyscore.called
+        self.redis_cli.mget.assert_called_once_with([
+            'dookio:node:http://0.0.0.0',
+            'dookio:node:http://123.123.123.123'])
+
+    def test_live_nodes_when_there_are_none(self):
+        self.pipe.execute.return_value = [0, []]
+
+        assert live_nodes(self.redis_cli) == {}
+        assert not self.redis_cli.mget.called
+
+    def test_node_report(self):
+        self.redis_cli.get.return_value = json.dumps(self.report)
+        assert node_report(self.redis_cli, 'http://0.0.0.0') == self.report
+
+        self.redis_cli.get.return_value = None
+        assert node_report(self.redis_cli, 'http://0.0.0.0') is None
+
+    def test_set_warm_pool_size(self):
+        conf = {'user': 'git', 'repo': 'apache'}
+        set_warm_pool_size(self.redis_cli, conf, 2)
+        set_warm_pool_size(self.redis_cli, conf, 0)
+
+        self.redis_cli.hset.assert_called_once_with(
+            'dookio:warm_pool', 'git/apache', 2)
+        self.redis_cli.hdel.assert_called_once_with(
+            'dookio:warm_pool', 'git/apache')
+
+    def test_parse_memory(self):
+        assert parse_memory('512m') == 512 * 1024 ** 2
+        assert parse_memory('1.5G') == 3 * 1024 ** 3 / 2
+        assert parse_memory('1024') == 1024
+        assert parse_memory('') == 0
+        self.assertRaises(ValueError, parse_memory, 'lots')
+        self.assertRaises(ValueError, parse_memory, '-1g')
+
+    def test_parse_cpu_shares(self):
+        assert parse_cpu_shares('512') == 512
+        assert parse_cpu_shares('') == 0
+        self.assertRaises(ValueError, parse_cpu_shares, 'x')
+        self.assertRaises(ValueError, parse_cpu_shares, '-2')
+
+    def test_resources_of_an_app(self):
+        conf = {'user': 'git', 'repo': 'apache'}
+        self.redis_cli.hget.return_value = None
+        set_resources(self.redis_cli, conf, memory=512, cpu_shares=None)
+
+        key, app, profile = self.redis_cli.hset.call_args[0]
+        assert (key, app) == ('dookio:resources', 'git/apache')
+        assert json.loads(profile) == {'memory': 512}
+
+        self.redis_cli.hget.return_value = profile
+        assert get_resources(self.redis_cli, conf) == {'memory': 512}
+        self.redis_cli.hget.return_value = None
+        assert get_resources(self.redis_cli, conf) == {}
+
+    def test_resources_not_given_are_kept(self):
+        conf = {'user': 'git', 'repo': 'apache'}
+        self.redis_cli.hget.return_value = json.dumps({'memory': 512})
+        set_resources(self.redis_cli, conf, cpu_shares=256)
+
+        profile = self.redis_cli.hset.call_args[0][2]
+        assert json.loads(profile) == {'memory': 512, 'cpu_shares': 256}
+
+    def test_resources_are_only_removed_when_cleared(self):
+        conf = {'user': 'git', 'repo': 'apache'}
+        self.redis_cli.hget.return_value = json.dumps({'memory': 512})
+        set_resources(self.redis_cli, conf)
+        assert not self.redis_cli.hdel.called
+
+        set_resources(self.redis_cli, conf, memory=0)
+        self.redis_cli.hdel.assert_called_once_with(
+            'dookio:resources', 'git/apache')
@@ -0,0 +1,135 @@
+import unittest
+from mock import Mock, patch
+
+from src.routing import (frontend_key,
+                         add_backends,
+                         remove_backends,
+                         swap_backends,
+                         remove_app,
+                         evict_backend,
+                         readmit_backend,
+                         forget_backends,
+                         list_apps,
+                         rebuild_app_index,
+                         APPS_KEY,
+                         REPLICAS_KEY,
+                         NAMES_KEY,
+                         ADD_BACKENDS,
+                         SWAP_BACKENDS,
+                         REMOVE_APP,
+                         EVICT_BACKEND,
+                         READMIT_BACKEND)
+
+
+class RoutingTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.conf = {
+            'user': 'git',
+            'repo': 'apache',
+            'application_address': 'apache.git.example.com'
+        }
+        self.backends = [('http://0.0.0.0', 4567),
+                         ('http://123.123.123.123', 4568)]
+        self.key = 'frontend:apache.git.example.com'
+        self.evicted = 'dookio:evicted:apache.git.example.com'
+
+    def test_frontend_key(self):
+        assert frontend_key(self.conf) == self.key
+
+    def test_add_backends_is_a_single_script_call(self):
+        redis_cli = Mock()
+        add_backends(redis_cli, self.conf, self.backends)
+
+        redis_cli.evalsha.assert_called_once_with(
+            ADD_BACKENDS.sha, 5, self.key, APPS_KEY, REPLICAS_KEY,
+            self.evicted, NAMES_KEY, 'git/apache', 'apache',
+            'http://0.0.0.0:4567', 'http://123.123.123.123:4568')
+
+    def test_remove_backends_is_a_single_script_call(self):
+        redis_cli = Mock()
+        remove_backends(redis_cli, self.conf, self.backends[:1])
+
+        assert redis_cli.evalsha.call_count == 1
+        assert redis_cli.evalsha.call_args[0][1:] == (
+            5, self.key, APPS_KEY, REPLICAS_KEY,
+            self.evicted, NAMES_KEY, 'http://0.0.0.0:4567')
+
+    def test_swap_backends_replaces_the_list_atomically(self):
+        redis_cli = Mock()
+        swap_backends(redis_cli, self.conf, self.backends[1:])
+
+        redis_cli.evalsha.assert_called_once_with(
+            SWAP_BACKENDS.sha, 5, self.key, APPS_KEY, REPLICAS_KEY,
+            self.evicted, NAMES_KEY, 'git/apache', 'apache',
+            'http://123.123.123.123:4568')
+        assert not redis_cli.delete.called
+        assert not redis_cli.rpush.called
+
+    def test_remove_app_drops_it_from_the_index(self):
+        redis_cli = Mock()
+        remove_app(redis_cli, self.conf)
+
+        redis_cli.evalsha.assert_called_once_with(
+            REMOVE_APP.sha, 5, self.key, APPS_KEY, REPLICAS_KEY,
+            self.evicted, NAMES_KEY)
+
+    def test_evict_backend(self):
+        redis_cli = Mock()
+        with patch('src.routing.time.time', return_value=100.0):
+            evict_backend(redis_cli, self.conf, 'http://0.0.0.0:4567')
+
+        redis_cli.evalsha.assert_called_once_with(
+            EVICT_BACKEND.sha, 5, self.key, APPS_KEY, REPLICAS_KEY,
+            self.evicted, NAMES_KEY, 'http://0.0.0.0:4567', 100.0)
+
+    def test_readmit_backend(self):
+        redis_cli = Mock()
+        readmit_backend(redis_cli, self.conf, 'http://0.0.0.0:4567')
+
+        redis_cli.evalsha.assert_called_once_with(
+            READMIT_BACKEND.sha, 5, self.key, APPS_KEY, REPLICAS_KEY,
+            self.evicted, NAMES_KEY, 'http://0.0.0.0:4567')
+
+    def test_forget_backends(self):
+        redis_cli = Mock()
+        forget_backends(redis_cli, self.conf, ['http://0.0.0.0:4567'])
+
+        redis_cli.hdel.assert_called_once_with(
+            self.evicted, 'http://0.0.0.0:4567')
+
+    def test_list_apps_pages_the_index_in_one_call(self):
+        redis_cli = Mock()
+        redis_cli.evalsha.return_value = [
+            3, self.key, '2', 'frontend:nginx.git.example.com', 0]
+        total, apps = list_apps(redis_cli, 10, 5)
+
+        assert total == 3
+        assert apps == [('apache.git.example.com', 2),
+                        ('nginx.git.example.com', 0)]
+        assert redis_cli.evalsha.call_count == 1
+        assert redis_cli.evalsha.call_args[0][-2:] == (10, 14)
+        assert not redis_cli.scan_iter.called
+
+    def test_rebuild_app_index(self):
+        redis_cli = Mock()
+        redis_cli.scan_iter.return_value = [self.key]
+        redis_cli.zrange.return_value = [self.key]
+        pipe = redis_cli.pipeline.return_value
+        pipe.execute.return_value = [3]
+
+        assert rebuild_app_index(redis_cli) == 1
+        redis_cli.scan_iter.assert_called_once_with(match='frontend:*')
+        pipe.zadd.assert_called_once_with(APPS_KEY, 0, self.key)
+        pipe.hset.assert_called_once_with(REPLICAS_KEY, self.key, 2)
+        assert not pipe.zrem.called
+
+    def test_rebuild_app_index_drops_the_apps_not_routed_anymore(self):
+        redis_cli = Mock()
+        redis_cli.scan_iter.return_value = []
+        redis_cli.zrange.return_value = [self.key]
+        pipe = redis_cli.pipeline.return_value
+
+        assert rebuild_app_index(redis_cli) == 0
+        pipe.zrem.assert_called_once_with(APPS_KEY, self.key)
+        pipe.hdel.assert_any_call(REPLICAS_KEY, self.key)
+        pipe.hdel.assert_any_call(NAMES_KEY, self.key)
@@ -0,0 +1,85 @@
+import unittest
+
+from src.scheduler import (ClusterState,
+                           utilization,
+                           fits,
+                           least_loaded,
+                           spread,
+                           binpack)
+
+
+class SchedulerTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.reports = {
+            'http://idle': {'cpus': 4, 'load': 0.4, 'containers': 1,
+                            'free_ports': 100, 'apps': {'git_apache': 1}},
+            'http://busy': {'cpus': 2, 'load': 1.5, 'containers': 6,
+                            'free_ports': 100, 'apps': {}},
+        }
+
+    def test_utilization_is_the_worst_of_cpu_and_memory(self):
+        assert utilization({'cpus': 2, 'load': 1}) == 0.5
+        assert utilization({'cpus': 2, 'load': 1, 'memory_total': 100,
+                            'memory_free': 10}) == 0.9
+
+    def test_reserved_resources_count_as_utilization(self):
+        assert utilization({'cpus': 2, 'load': 0,
+                            'memory_allocatable': 100,
+                            'memory_allocated': 75}) == 0.75
+
+    def test_fits(self):
+        report = {'memory_allocatable': 100, 'memory_allocated': 75,
+                  'cpu_shares_allocatable': 1024}
+
+        assert fits(report, {'memory': 25, 'cpu_shares': 1024})
+        assert not fits(report, {'memory': 26})
+        assert fits(report, None)
+        assert fits({}, {'memory': 1000})
+
+    def test_least_loaded(self):
+        assert least_loaded(self.reports, 'git_apache') == 'http://idle'
+
+    def test_spread_avoids_nodes_running_the_app(self):
+        assert spread(self.reports, 'git_apache') == 'http://busy'
+        assert spread(self.reports, 'git_other') == 'http://idle'
+
+    def test_binpack_fills_the_fullest_node_under_the_threshold(self):
+        assert binpack(self.reports, 'git_apache') == 'http://busy'
+        self.reports['http://busy']['load'] = 2
+        assert binpack(self.reports, 'git_apache') == 'http://idle'
+
+    def test_placements_are_counted_until_the_next_report(self):
+        state = ClusterState('spread')
+        for node, report in self.reports.iteritems():
+            state.update(node, report)
+
+        placed = [state.place('git_other') for i in range(4)]
+
+        assert sorted(placed) == ['http://busy', 'http://busy',
+                                  'http://idle', 'http://idle']
+
+    def test_nodes_without_free_ports_are_skipped(self):
+        state = ClusterState('least_loaded')
+        self.reports['http://idle']['free_ports'] = 0
+        for node, report in self.reports.iteritems():
+            state.update(node, report)
+
+        assert state.place('git_apache') == 'http://busy'
+        state.remove('http://busy')
+        assert state.place('git_apache') is None
+
+    def test_nodes_without_room_for_the_limits_are_skipped(self):
+        state = ClusterState('least_loaded')
+        self.reports['http://idle'].update(memory_allocatable=100,
+                                           memory_allocated=0)
+        self.reports['http://busy'].update(memory_allocatable=100,
+                                           memory_allocated=50)
+        for node, report in self.reports.iteritems():
+            state.update(node, report)
+
+        placed = [state.place('git_apache', {'memory': 40})
+                  for i in range(4)]
+
+        assert sorted(placed) == [None, 'http://busy', 'http://idle',
+                                  'http://idle']
+        assert state.reports()['http://idle']['memory_allocated'] == 80
@@ -1,6 +1,6 @@
 import unittest
 import json
-from mock import patch
+from mock import patch, Mock, ANY
 from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
 
@@ -18,26 +18,64 @@ class ServerApplicationTestSuite(unittest.TestCase):
                 conf.get('repo'), conf.get('user'), 'localhost')
         }
 
+    def expected_job_conf(self, conf):
+        return dict(self.expected_conf(conf), job=ANY, resources={})
+
     def setUp(self):
         self.nodes = ['http://0.0.0.0', 'http://123.123.123.123']
         self.c = Client(application, BaseResponse)
+        get_resources = patch('src.server.get_resources',
+                              Mock(return_value={}))
+        get_resources.start()
+        self.addCleanup(get_resources.stop)
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
+    @patch('src.server.list_apps')
     def test_application_returns_deployed_applications_when_there_is_one(
-            self, mock_redis):
-        mock_redis.StrictRedis.return_value.scan_iter.return_value = [
-            'frontend:apache.git.example.com']
+            self, mock_list_apps, mock_redis):
+        mock_list_apps.return_value = (1, [('apache.git.example.com', 2)])
         response = self.c.get('/apps')
 
         assert response.status_code == 200
-        assert 'apache.git.example.com' in response.data
+        assert 'apache.git.example.com (replicated in 2' in response.data
+        mock_list_apps.assert_called_once_with(mock_redis.StrictRedis())
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.list_apps')
+    def test_application_returns_a_page_of_applications_as_json(
+            self, mock_list_apps, mock_redis):
+        mock_list_apps.return_value = (3, [('apache.git.example.com', 2)])
+        response = self.c.get('/apps?page=2&per_page=1&format=json')
+
+        assert response.status_code == 200
+        assert json.loads(response.data) == {
+            'total': 3,
+            'page': 2,
+            'per_page': 1,
+            'apps': [{'address': 'apache.git.example.com', 'replicas': 2}]
+        }
+        mock_list_apps.assert_called_once_with(mock_redis.StrictRedis(), 1, 1)
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
+    @patch('src.server.list_apps')
+    def test_application_rejects_invalid_pages_of_applications(
+            self, mock_list_apps, mock_redis):
+        for query in ('page=two', 'page=1&per_page=0', 'page=1&per_page=-5',
+                      'page=-1', 'per_page=1.5'):
+            response = self.c.get('/apps?{}'.format(query))
+
+            assert response.status_code == 400
+        assert not mock_list_apps.called
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.list_apps')
     def test_application_returns_deployed_applications_when_there_is_none(
-            self, mock_redis):
-        mock_redis.StrictRedis.return_value.scan_iter.return_value = []
+            self, mock_list_apps, mock_redis):
+        mock_list_apps.return_value = (0, [])
         response = self.c.get('/apps')
 
         assert response.status_code == 200
@@ -65,7 +103,7 @@ class ServerApplicationTestSuite(unittest.TestCase):
     @patch('src.server.redis')
     @patch('src.server.contact_nodes')
     @patch('src.server.was_applied')
-    @patch('src.server.remove_app_from_webserver_routing')
+    @patch('src.server.remove_app')
     def test_when_the_stop_action_for_containers_is_provided(
             self, mock_remove_app, mock_was_applied,
             mock_contact_nodes, mock_redis):
@@ -103,14 +141,10 @@ class ServerApplicationTestSuite(unittest.TestCase):
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
-    @patch('src.server.exist_application')
     @patch('src.server.contact_nodes')
-    @patch('src.server.was_applied')
-    @patch('src.server.add_app_to_webserver_routing')
-    @patch('src.server.add_container_to_webserver_routing')
-    def test_start_action_for_containers_and_app_exists(
-            self, mock_add_container, mock_add_app, mock_was_applied,
-            mock_contact_nodes, mock_exist_application, mock_redis):
+    @patch('src.server.add_backends')
+    def test_start_action_for_containers_routes_them_in_one_call(
+            self, mock_add_backends, mock_contact_nodes, mock_redis):
         port = 4567
         conf = {
             'action': 'start',
@@ -129,8 +163,6 @@ class ServerApplicationTestSuite(unittest.TestCase):
             for node, content in content[0].iteritems()}
 
         mock_contact_nodes.return_value = response_nodes
-        mock_was_applied.return_value = True
-        mock_exist_application.return_value = True
         response = self.c.get('/containers?action={}&user={}&repo={}'.format(
             conf.get('action'), conf.get('user'), conf.get('repo')))
 
@@ -141,60 +173,30 @@ class ServerApplicationTestSuite(unittest.TestCase):
 
         assert response.status_code == 200
         assert json.loads(response.data) == expected_resp
-        assert mock_add_container.call_count == 2
-        assert not mock_add_app.called
-        mock_was_applied.assert_called_once_with(response_nodes)
-        mock_exist_application.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
+        mock_add_backends.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_conf(conf),
+            [(node, port) for node in response_nodes])
         mock_contact_nodes.assert_called_once_with(self.expected_conf(conf))
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
-    @patch('src.server.exist_application')
     @patch('src.server.contact_nodes')
-    @patch('src.server.was_applied')
-    @patch('src.server.add_app_to_webserver_routing')
-    @patch('src.server.add_container_to_webserver_routing')
-    def test_start_action_for_containers_app_does_not_exist(
-            self, mock_add_container, mock_add_app, mock_was_applied,
-            mock_contact_nodes, mock_exist_application, mock_redis):
-        port = 4567
+    @patch('src.server.add_backends')
+    def test_start_action_for_containers_when_every_node_fails(
+            self, mock_add_backends, mock_contact_nodes, mock_redis):
         conf = {
             'action': 'start',
             'user': 'git',
             'repo': 'apache',
         }
 
-        content = ({
-            node: [{
-                'node': node,
-                'Ports': [{'PublicPort': port}]}, ]
-            for node in self.nodes}, )
-
-        response_nodes = {
-            node: (content, 200)
-            for node, content in content[0].iteritems()}
-
-        mock_contact_nodes.return_value = response_nodes
-        mock_was_applied.return_value = True
-        mock_exist_application.return_value = False
+        mock_contact_nodes.return_value = {
+            node: ('Node unreachable', 503) for node in self.nodes}
         response = self.c.get('/containers?action={}&user={}&repo={}'.format(
             conf.get('action'), conf.get('user'), conf.get('repo')))
 
-        expected_resp = [{
-            'node': node_ip,
-            'containers': body[0]
-        } for node_ip, body in response_nodes.iteritems()]
-
         assert response.status_code == 200
-        assert json.loads(response.data) == expected_resp
-        assert mock_add_container.call_count == 2
-        mock_add_app.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
-        mock_was_applied.assert_called_once_with(response_nodes)
-        mock_exist_application.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
-        mock_contact_nodes.assert_called_once_with(self.expected_conf(conf))
+        assert not mock_add_backends.called
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
@@ -218,17 +220,15 @@ class ServerApplicationTestSuite(unittest.TestCase):
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
-    @patch('src.server.requests')
     @patch('src.server.contact_nodes')
-    @patch('src.server.remove_app_from_webserver_routing')
-    @patch('src.server.pick_up_node')
+    @patch('src.server.remove_app')
+    @patch('src.server.deploy_replicas')
     @patch('src.server.exist_application')
-    @patch('src.server.add_app_to_webserver_routing')
-    @patch('src.server.add_container_to_webserver_routing')
-    def test_normal_app_push_if_app_does_not_exist(
-            self, mock_add_container, mock_add_app, mock_exist_application,
-            mock_pick_up_node, mock_remove_app, mock_contact_nodes,
-            mock_requests, mock_redis):
+    @patch('src.server.add_backends')
+    def test_normal_app_push_routes_the_replicas_in_one_call(
+            self, mock_add_backends, mock_exist_application,
+            mock_deploy_replicas, mock_remove_app, mock_contact_nodes,
+            mock_redis):
         conf = {
             'user': 'git',
             'repo': 'apache'
@@ -237,173 +237,565 @@ class ServerApplicationTestSuite(unittest.TestCase):
         node = self.nodes[0]
         port = 4567
         mock_exist_application.return_value = False
-        mock_requests.get.return_value.status_code = 200
-        mock_requests.get.return_value.content = json.dumps({'port': port})
-        mock_pick_up_node.return_value = node
+        # The nodes answer the port as a string.
+        mock_deploy_replicas.return_value = [
+            (node, ({'port': str(port)}, 200))]
         response = self.c.get('/?user={}&repo={}'.format(
             conf.get('user'), conf.get('repo')))
 
         assert response.status_code == 200
-        assert self.expected_conf(conf).get(
+        assert self.expected_job_conf(conf).get(
             'application_address') in response.data
-        mock_contact_nodes.assert_called_once_with(self.expected_conf(conf))
+        mock_contact_nodes.assert_called_once_with(
+            self.expected_job_conf(conf))
         mock_remove_app.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
-        mock_pick_up_node.assert_called_once_with()
-        mock_exist_application.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
-        mock_add_app.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
-        mock_add_container.assert_called_once_with(
-            mock_redis.StrictRedis(), node, port, self.expected_conf(conf))
+            mock_redis.StrictRedis(), self.expected_job_conf(conf))
+        mock_deploy_replicas.assert_called_once_with(
+            self.expected_job_conf(conf))
+        assert not mock_exist_application.called
+        mock_add_backends.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_job_conf(conf),
+            [(node, port)])
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
-    @patch('src.server.requests')
     @patch('src.server.contact_nodes')
-    @patch('src.server.remove_app_from_webserver_routing')
-    @patch('src.server.pick_up_node')
-    @patch('src.server.exist_application')
-    @patch('src.server.add_app_to_webserver_routing')
-    @patch('src.server.add_container_to_webserver_routing')
-    def test_normal_app_push_if_app_does_exist(
-            self, mock_add_container, mock_add_app, mock_exist_application,
-            mock_pick_up_node, mock_remove_app, mock_contact_nodes,
-            mock_requests, mock_redis):
+    @patch('src.server.remove_app')
+    @patch('src.server.deploy_replicas')
+    @patch('src.server.add_backends')
+    @patch('src.server.set_desired')
+    def test_app_push_declares_the_desired_replicas(
+            self, mock_set_desired, mock_add_backends, mock_deploy_replicas,
+            mock_remove_app, mock_contact_nodes, mock_redis):
+        conf = {
+            'user': 'git',
+            'repo': 'apache',
+            'multiplicator': '3'
+        }
+
+        mock_deploy_replicas.return_value = [
+            (self.nodes[0], ('Node unreachable', 503)),
+            (self.nodes[1], ({'port': 4567, 'digest': 'abc'}, 200))]
+        response = self.c.get('/?user={}&repo={}&multiplicator={}'.format(
+            conf.get('user'), conf.get('repo'), conf.get('multiplicator')))
+
+        assert response.status_code == 200
+        mock_set_desired.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_job_conf(conf), 3, 'abc')
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.set_warm_pool_size')
+    def test_warm_pool_size_of_an_app(self, mock_set_warm_pool_size,
+                                      mock_redis):
         conf = {
             'user': 'git',
             'repo': 'apache'
         }
 
-        node = self.nodes[0]
-        port = 4567
-        mock_exist_application.return_value = True
-        mock_requests.get.return_value.status_code = 200
-        mock_requests.get.return_value.content = json.dumps({'port': port})
-        mock_pick_up_node.return_value = node
-        response = self.c.get('/?user={}&repo={}'.format(
-            conf.get('user'), conf.get('repo')))
+        response = self.c.get('/warm?user=git&repo=apache&size=2')
 
         assert response.status_code == 200
-        assert self.expected_conf(conf).get(
-            'application_address') in response.data
-        mock_contact_nodes.assert_called_once_with(self.expected_conf(conf))
-        mock_remove_app.assert_called_once_with(
+        assert '2 warm containers' in response.data
+        mock_set_warm_pool_size.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_conf(conf), 2)
+
+        for size in ('x', '-1'):
+            response = self.c.get(
+                '/warm?user=git&repo=apache&size={}'.format(size))
+            assert response.status_code == 400
+        assert mock_set_warm_pool_size.call_count == 1
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.set_resources')
+    def test_resources_of_an_app(self, mock_set_resources, mock_redis):
+        from src.server import get_resources
+        get_resources.return_value = {'memory': 536870912}
+        conf = {
+            'user': 'git',
+            'repo': 'apache'
+        }
+
+        response = self.c.get(
+            '/resources?user=git&repo=apache&memory=512m&cpu_shares=512')
+
+        assert json.loads(response.data) == {'memory': 536870912}
+        mock_set_resources.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_conf(conf), 536870912,
+            512)
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.set_resources')
+    def test_invalid_resources_are_a_bad_request(self, mock_set_resources,
+                                                 mock_redis):
+        for query in ('memory=abc', 'cpu_shares=x', 'memory=1g&cpu_shares=-1'):
+            response = self.c.get(
+                '/resources?user=git&repo=apache&{}'.format(query))
+
+            assert response.status_code == 400
+        assert not mock_set_resources.called
+
+    @patch('src.server.redis')
+    @patch('src.server.load_stats')
+    def test_stats(self, mock_load_stats, mock_redis):
+        mock_load_stats.return_value.report.return_value = {
+            'apps': {'apache.git.localhost': {'requests': 1}},
+            'backends': {}}
+
+        response = self.c.get('/stats')
+
+        assert json.loads(response.data)['apps'] == {
+            'apache.git.localhost': {'requests': 1}}
+        mock_load_stats.assert_called_once_with(mock_redis.StrictRedis())
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.set_policy')
+    @patch('src.server.remove_policy')
+    def test_autoscale_policy_of_an_app(self, mock_remove_policy,
+                                        mock_set_policy, mock_redis):
+        conf = {
+            'user': 'git',
+            'repo': 'apache'
+        }
+
+        response = self.c.get(
+            '/autoscale?user=git&repo=apache&min=2&max=8&rps=50')
+        assert 'between 2 and 8 replicas' in response.data
+        mock_set_policy.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_conf(conf), 2, 8, 50.0,
+            None)
+
+        self.c.get('/autoscale?user=git&repo=apache')
+        mock_remove_policy.assert_called_once_with(
             mock_redis.StrictRedis(), self.expected_conf(conf))
-        mock_pick_up_node.assert_called_once_with()
-        mock_exist_application.assert_called_once_with(
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.set_policy')
+    def test_invalid_autoscale_policies_are_rejected(self, mock_set_policy,
+                                                     mock_redis):
+        for query in ('rps=0', 'rps=-1', 'rps=ten', 'rps=10&min=-1',
+                      'rps=10&min=3&max=2', 'rps=10&max=x',
+                      'rps=10&latency=0'):
+            response = self.c.get(
+                '/autoscale?user=git&repo=apache&{}'.format(query))
+
+            assert response.status_code == 400
+        assert not mock_set_policy.called
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.contact_nodes')
+    @patch('src.server.was_applied')
+    @patch('src.server.remove_app')
+    @patch('src.server.remove_desired')
+    def test_stopped_apps_are_not_reconciled(
+            self, mock_remove_desired, mock_remove_app, mock_was_applied,
+            mock_contact_nodes, mock_redis):
+        conf = {
+            'action': 'stop',
+            'user': 'git',
+            'repo': 'apache',
+        }
+
+        mock_contact_nodes.return_value = {self.nodes[0]: ([], 200)}
+        mock_was_applied.return_value = True
+        self.c.get('/containers?action=stop&user=git&repo=apache')
+
+        mock_remove_desired.assert_called_once_with(
             mock_redis.StrictRedis(), self.expected_conf(conf))
-        assert not mock_add_app.called
-        mock_add_container.assert_called_once_with(
-            mock_redis.StrictRedis(), node, port, self.expected_conf(conf))
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
-    @patch('src.server.requests')
     @patch('src.server.contact_nodes')
-    @patch('src.server.remove_app_from_webserver_routing')
-    @patch('src.server.pick_up_node')
+    @patch('src.server.remove_app')
+    @patch('src.server.remove_desired')
+    @patch('src.server.set_warm_pool_size')
+    @patch('src.server.remove_policy')
+    def test_removed_apps_are_not_reconciled(
+            self, mock_remove_policy, mock_set_warm_pool_size,
+            mock_remove_desired, mock_remove_app, mock_contact_nodes,
+            mock_redis):
+        conf = {
+            'action': 'remove',
+            'user': 'git',
+            'repo': 'apache',
+        }
+        redis_cli = mock_redis.StrictRedis()
+
+        mock_contact_nodes.return_value = {self.nodes[0]: ([], 200)}
+        self.c.get('/containers?action=remove&user=git&repo=apache')
+
+        mock_remove_app.assert_called_once_with(
+            redis_cli, self.expected_conf(conf))
+        mock_remove_desired.assert_called_once_with(
+            redis_cli, self.expected_conf(conf))
+        mock_set_warm_pool_size.assert_called_once_with(
+            redis_cli, self.expected_conf(conf), 0)
+        mock_remove_policy.assert_called_once_with(
+            redis_cli, self.expected_conf(conf))
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.contact_nodes')
+    @patch('src.server.remove_app', Mock())
+    @patch('src.server.remove_desired')
+    def test_apps_stopped_in_every_node_are_not_reconciled(
+            self, mock_remove_desired, mock_contact_nodes, mock_redis):
+        # Nothing was running anywhere (e.g. every container died).
+        mock_contact_nodes.return_value = {
+            self.nodes[0]: ('git/apache is not running!', 400),
+            self.nodes[1]: ('git/apache is not running!', 400)}
+        self.c.get('/containers?action=stop&user=git&repo=apache')
+        assert mock_remove_desired.called
+
+        # But an unreachable node may still run it.
+        mock_remove_desired.reset_mock()
+        mock_contact_nodes.return_value = {
+            self.nodes[0]: ('git/apache is not running!', 400),
+            self.nodes[1]: ('Node unreachable', 503)}
+        self.c.get('/containers?action=stop&user=git&repo=apache')
+        assert not mock_remove_desired.called
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.contact_nodes')
+    @patch('src.server.remove_app')
+    @patch('src.server.deploy_replicas')
     @patch('src.server.exist_application')
-    @patch('src.server.add_app_to_webserver_routing')
-    @patch('src.server.add_container_to_webserver_routing')
+    @patch('src.server.add_backends')
     def test_normal_app_push_if_node_returns_400(
-            self, mock_add_container, mock_add_app, mock_exist_application,
-            mock_pick_up_node, mock_remove_app, mock_contact_nodes,
-            mock_requests, mock_redis):
+            self, mock_add_backends, mock_exist_application,
+            mock_deploy_replicas, mock_remove_app, mock_contact_nodes,
+            mock_redis):
         conf = {
             'user': 'git',
             'repo': 'apache'
         }
 
         node = self.nodes[0]
-        mock_requests.get.return_value.status_code = 400
-        mock_requests.get.return_value.content = 'Node unreachable'
-        mock_pick_up_node.return_value = node
+        mock_deploy_replicas.return_value = [
+            (node, ('Node unreachable', 400))]
         response = self.c.get('/?user={}&repo={}'.format(
             conf.get('user'), conf.get('repo')))
 
         assert response.status_code == 400
         assert 'Node unreachable' in response.data
-        mock_contact_nodes.assert_called_once_with(self.expected_conf(conf))
+        mock_contact_nodes.assert_called_once_with(
+            self.expected_job_conf(conf))
         mock_remove_app.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
-        mock_pick_up_node.assert_called_once_with()
+            mock_redis.StrictRedis(), self.expected_job_conf(conf))
         assert not mock_exist_application.called
-        assert not mock_add_app.called
-        assert not mock_add_container.called
+        assert not mock_add_backends.called
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
-    @patch('src.server.requests')
-    @patch('src.server.contact_nodes')
-    @patch('src.server.remove_app_from_webserver_routing')
-    @patch('src.server.pick_up_node')
+    @patch('src.server.get_desired', Mock(return_value=None))
+    @patch('src.server.set_desired', Mock())
+    @patch('src.server.remove_app')
     @patch('src.server.exist_application')
-    @patch('src.server.add_app_to_webserver_routing')
-    @patch('src.server.add_container_to_webserver_routing')
-    def test_scale_application_if_it_is_already_running(
-            self, mock_add_container, mock_add_app, mock_exist_application,
-            mock_pick_up_node, mock_remove_app, mock_contact_nodes,
-            mock_requests, mock_redis):
+    @patch('src.reconciler.contact_nodes')
+    @patch('src.reconciler.get_app_backends')
+    @patch('src.reconciler.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.reconciler.deploy_replicas')
+    @patch('src.reconciler.check_backends_health')
+    @patch('src.reconciler.add_backends')
+    def test_scale_up_only_starts_the_missing_replicas(
+            self, mock_add_backends, mock_health, mock_deploy_replicas,
+            mock_get_backends, mock_contact_nodes, mock_exist_application,
+            mock_remove_app, mock_redis):
         conf = {
             'user': 'git',
             'repo': 'apache',
-            'multiplicator': '2'
+            'multiplicator': '3'
         }
 
-        port = 4567
-        node = self.nodes[0]
-        mock_requests.get.return_value.status_code = 200
-        mock_requests.get.return_value.content = json.dumps({'port': port})
-        mock_pick_up_node.return_value = node
+        running = [{'Ports': [{'PublicPort': 4567}]}]
+        mock_contact_nodes.return_value = {
+            node: (running, 200) for node in self.nodes}
+        mock_get_backends.return_value = [
+            (node, 4567) for node in self.nodes]
+        mock_deploy_replicas.return_value = [
+            (self.nodes[0], ({'port': '4568'}, 200))]
+        mock_health.side_effect = lambda backends: backends
         response = self.c.get('/scale?multiplicator={}&user={}&repo={}'.format(
             conf.get('multiplicator'), conf.get('user'), conf.get('repo')))
 
         assert response.status_code == 200
-        assert self.expected_conf(conf).get(
-            'application_address') in response.data
-        mock_contact_nodes.assert_called_once_with(self.expected_conf(conf))
-        mock_remove_app.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
-        assert mock_pick_up_node.call_count == 2
-        assert mock_exist_application.call_count == 3
-        assert not mock_add_app.called
+        assert 'scaled to 3 replicas (1 started, 0 stopped)' in response.data
+        mock_contact_nodes.assert_called_once_with(
+            dict(self.expected_job_conf(conf), action='get'))
+        mock_deploy_replicas.assert_called_once_with(
+            dict(self.expected_job_conf(conf), multiplicator=1, digest=ANY))
+        mock_add_backends.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_job_conf(conf),
+            [(self.nodes[0], 4568)])
+        assert not mock_remove_app.called
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
-    @patch('src.server.requests')
-    @patch('src.server.contact_nodes')
-    @patch('src.server.remove_app_from_webserver_routing')
-    @patch('src.server.pick_up_node')
-    @patch('src.server.exist_application')
-    @patch('src.server.add_app_to_webserver_routing')
-    @patch('src.server.add_container_to_webserver_routing')
+    @patch('src.server.get_desired', Mock(return_value=None))
+    @patch('src.server.set_desired', Mock())
+    @patch('src.reconciler.contact_nodes')
+    @patch('src.reconciler.get_app_backends')
+    @patch('src.reconciler.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.reconciler.deploy_replicas')
+    @patch('src.reconciler.remove_backends')
+    @patch('src.reconciler.drain_backends')
+    def test_scale_down_only_drains_the_extra_replicas(
+            self, mock_drain, mock_remove_backends, mock_deploy_replicas,
+            mock_get_backends, mock_contact_nodes, mock_redis):
+        conf = {
+            'user': 'git',
+            'repo': 'apache',
+            'multiplicator': '1'
+        }
+
+        running = [{'Ports': [{'PublicPort': 4567}]}]
+        mock_contact_nodes.return_value = {
+            node: (running, 200) for node in self.nodes}
+        mock_get_backends.return_value = [
+            (node, 4567) for node in self.nodes]
+        response = self.c.get('/scale?multiplicator={}&user={}&repo={}'.format(
+            conf.get('multiplicator'), conf.get('user'), conf.get('repo')))
+
+        assert response.status_code == 200
+        assert 'scaled to 1 replicas (0 started, 1 stopped)' in response.data
+        assert not mock_deploy_replicas.called
+        mock_remove_backends.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_job_conf(conf),
+            [(self.nodes[1], 4567)])
+        mock_drain.assert_called_once_with(
+            [(self.nodes[1], 4567)], self.expected_job_conf(conf))
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.get_desired', Mock(return_value=None))
+    @patch('src.server.set_desired', Mock())
+    @patch('src.reconciler.contact_nodes')
+    @patch('src.reconciler.get_app_backends')
+    @patch('src.reconciler.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.reconciler.deploy_replicas')
+    @patch('src.reconciler.add_backends')
     def test_scale_application_when_a_node_returns_400(
-            self, mock_add_container, mock_add_app, mock_exist_application,
-            mock_pick_up_node, mock_remove_app, mock_contact_nodes,
-            mock_requests, mock_redis):
+            self, mock_add_backends, mock_deploy_replicas, mock_get_backends,
+            mock_contact_nodes, mock_redis):
         conf = {
             'user': 'git',
             'repo': 'apache',
             'multiplicator': '2'
         }
 
-        node = self.nodes[0]
-        mock_requests.get.return_value.status_code = 400
-        mock_requests.get.return_value.content = 'Node unreachable'
-        mock_pick_up_node.return_value = node
+        mock_contact_nodes.return_value = {
+            node: ([], 200) for node in self.nodes}
+        mock_get_backends.return_value = []
+        mock_deploy_replicas.return_value = [
+            (node, ('Node unreachable', 400)) for node in self.nodes]
         response = self.c.get('/scale?multiplicator={}&user={}&repo={}'.format(
             conf.get('multiplicator'), conf.get('user'), conf.get('repo')))
 
         assert response.status_code == 400
         assert 'Node unreachable' in response.data
-        mock_contact_nodes.assert_called_once_with(self.expected_conf(conf))
-        mock_remove_app.assert_called_once_with(
-            mock_redis.StrictRedis(), self.expected_conf(conf))
-        assert mock_pick_up_node.call_count == 1
-        assert mock_exist_application.call_count == 1
-        assert not mock_add_app.called
-        assert not mock_add_container.called
+        assert not mock_add_backends.called
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.get_desired', Mock(return_value=None))
+    @patch('src.server.set_desired', Mock())
+    @patch('src.reconciler.contact_nodes')
+    @patch('src.reconciler.get_app_backends')
+    @patch('src.reconciler.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.reconciler.deploy_replicas')
+    @patch('src.reconciler.check_backends_health')
+    @patch('src.reconciler.add_backends')
+    def test_scale_application_when_some_replicas_fail(
+            self, mock_add_backends, mock_health, mock_deploy_replicas,
+            mock_get_backends, mock_contact_nodes, mock_redis):
+        conf = {
+            'user': 'git',
+            'repo': 'apache',
+            'multiplicator': '2'
+        }
+
+        mock_contact_nodes.return_value = {
+            node: ([], 200) for node in self.nodes}
+        mock_get_backends.return_value = []
+        mock_deploy_replicas.return_value = [
+            (self.nodes[0], ({'port': 4567}, 200)),
+            (self.nodes[1], ('Node unreachable', 400))]
+        mock_health.side_effect = lambda backends: backends
+        response = self.c.get('/scale?multiplicator={}&user={}&repo={}'.format(
+            conf.get('multiplicator'), conf.get('user'), conf.get('repo')))
+
+        assert response.status_code == 200
+        assert '1 of 2 replicas could not be deployed' in response.data
+        assert 'success' in response.data
+        mock_add_backends.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_job_conf(conf),
+            [(self.nodes[0], 4567)])
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.contact_nodes')
+    @patch('src.server.get_app_backends')
+    @patch('src.server.get_evicted_backends')
+    @patch('src.server.deploy_replicas')
+    @patch('src.server.check_backends_health')
+    @patch('src.server.stop_backends')
+    @patch('src.server.swap_backends')
+    @patch('src.server.drain_backends')
+    def test_rolling_deploy_swaps_routing_before_stopping_old_containers(
+            self, mock_drain, mock_swap, mock_stop, mock_health,
+            mock_deploy_replicas, mock_get_evicted, mock_get_backends,
+            mock_contact_nodes, mock_redis):
+        conf = {
+            'user': 'git',
+            'repo': 'apache'
+        }
+
+        old_backends = [(self.nodes[0], 4567)]
+        evicted_backends = [(self.nodes[0], 4569)]
+        new_backends = [(self.nodes[1], 4568)]
+        mock_get_backends.return_value = old_backends
+        mock_get_evicted.return_value = evicted_backends
+        mock_deploy_replicas.return_value = [
+            (self.nodes[1], ({'port': '4568'}, 200))]
+        mock_health.return_value = new_backends
+        response = self.c.get('/?user={}&repo={}&mode=rolling'.format(
+            conf.get('user'), conf.get('repo')))
+
+        assert response.status_code == 200
+        assert 'success' in response.data
+        assert not mock_contact_nodes.called
+        assert not mock_stop.called
+        mock_health.assert_called_once_with(new_backends)
+        mock_swap.assert_called_once_with(
+            mock_redis.StrictRedis(), self.expected_job_conf(conf),
+            new_backends)
+        # The evicted old containers are stopped too.
+        mock_drain.assert_called_once_with(
+            old_backends + evicted_backends, self.expected_job_conf(conf))
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.get_app_backends')
+    @patch('src.server.get_evicted_backends', Mock(return_value=[]))
+    @patch('src.server.deploy_replicas')
+    @patch('src.server.check_backends_health')
+    @patch('src.server.stop_backends')
+    @patch('src.server.swap_backends')
+    @patch('src.server.drain_backends')
+    def test_rolling_deploy_keeps_old_routing_if_health_check_fails(
+            self, mock_drain, mock_swap, mock_stop, mock_health,
+            mock_deploy_replicas, mock_get_backends, mock_redis):
+        conf = {
+            'user': 'git',
+            'repo': 'apache'
+        }
+
+        new_backends = [(self.nodes[1], 4568)]
+        mock_get_backends.return_value = [(self.nodes[0], 4567)]
+        mock_deploy_replicas.return_value = [
+            (self.nodes[1], ({'port': '4568'}, 200))]
+        mock_health.return_value = []
+        response = self.c.get('/?user={}&repo={}&mode=rolling'.format(
+            conf.get('user'), conf.get('repo')))
+
+        assert response.status_code == 503
+        assert 'health check' in response.data
+        mock_stop.assert_called_once_with(
+            new_backends, self.expected_job_conf(conf))
+        assert not mock_swap.called
+        assert not mock_drain.called
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.create_job')
+    @patch('src.server.job_queue')
+    def test_async_push_returns_the_job_right_away(
+            self, mock_job_queue, mock_create_job, mock_redis):
+        mock_create_job.return_value = 'abc'
+        response = self.c.get('/?user=git&repo=apache&async=1')
+
+        assert response.status_code == 202
+        assert json.loads(response.data)['logs'] == '/jobs/logs?id=abc'
+        mock_create_job.assert_called_once_with(
+            mock_redis.StrictRedis(),
+            self.expected_conf({'user': 'git', 'repo': 'apache'}), 'deploy')
+        job = mock_job_queue.submit.call_args[0][1]
+        assert job.id == 'abc'
+        assert job.app == 'apache.git.localhost'
+        assert not job.wait(0)
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.get_job')
+    @patch('src.server.read_job_log')
+    def test_the_log_of_a_job_is_streamed_until_it_finishes(
+            self, mock_read_job_log, mock_get_job, mock_redis):
+        mock_get_job.side_effect = [{'status': 'running'},
+                                    {'status': 'running'},
+                                    {'status': 'succeeded'}]
+        mock_read_job_log.side_effect = [['Step 0 : FROM ubuntu'],
+                                         ['App successfully deployed!']]
+        with patch('src.server.LOG_POLL_INTERVAL', 0):
+            response = self.c.get('/jobs/logs?id=abc')
+            assert response.data == (
+                'Step 0 : FROM ubuntu\nApp successfully deployed!\n')
+        assert mock_read_job_log.call_args_list[1][0][2] == 1
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.get_job', Mock(return_value={'status': 'running'}))
+    @patch('src.server.read_job_log')
+    def test_the_log_of_a_job_can_be_polled_from_an_offset(
+            self, mock_read_job_log, mock_redis):
+        mock_read_job_log.return_value = ['App successfully deployed!']
+        response = self.c.get('/jobs/logs?id=abc&offset=3&follow=0')
+
+        assert response.data == 'App successfully deployed!\n'
+        assert mock_read_job_log.call_args[0][1:] == ('abc', 3)
+
+        for offset in ('x', '-1'):
+            response = self.c.get(
+                '/jobs/logs?id=abc&offset={}&follow=0'.format(offset))
+            assert response.status_code == 400
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.get_job')
+    def test_the_status_of_an_unknown_job(self, mock_get_job, mock_redis):
+        mock_get_job.return_value = None
+        response = self.c.get('/jobs?id=abc')
+
+        assert response.status_code == 404
+
+    @patch('src.server.redis')
+    def test_metrics_are_exposed(self, mock_redis):
+        response = self.c.get('/metrics')
+
+        assert response.status_code == 200
+        assert ('# TYPE dookio_server_stage_seconds histogram'
+                in response.data)
+
+    @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
+    @patch('src.server.redis')
+    @patch('src.server.get_manifest')
+    def test_nodes_can_fetch_the_manifest_of_the_code(
+            self, mock_get_manifest, mock_redis):
+        manifest = {'Dockerfile': {'sha1': 'abc', 'mode': 420}}
+        mock_get_manifest.return_value = manifest
+        response = self.c.get('/manifest?user=git&repo=apache')
+
+        assert response.status_code == 200
+        assert json.loads(response.data) == manifest
+
+        mock_get_manifest.side_effect = OSError()
+        response = self.c.get('/manifest?user=git&repo=apache')
+        assert response.status_code == 404
 
     @patch.dict('os.environ', {'DOOKIO_DOMAIN': 'localhost'})
     @patch('src.server.redis')
@@ -1,16 +1,29 @@
 import unittest
 import json
+import threading
+import requests
 from mock import patch, Mock
 
+from src.scheduler import ClusterState
 from src.utils import (pick_up_node,
-                       fetch_apps,
+                       refresh_cluster_state,
+                       get_nodes,
                        contact_containers,
                        contact_nodes,
-                       add_app_to_webserver_routing,
-                       remove_app_from_webserver_routing,
+                       get_session,
+                       NODE_TIMEOUT,
                        exist_application,
-                       add_container_to_webserver_routing,
-                       was_applied)
+                       deploy_replicas,
+                       deploy_container,
+                       claim_warm_replicas,
+                       get_app_backends,
+                       check_backend_health,
+                       check_backends_health,
+                       get_fanout_pool,
+                       get_health_check_pool,
+                       stop_backends,
+                       was_applied,
+                       stopped_everywhere)
 
 
 class ServerUtilsTestSuite(unittest.TestCase):
@@ -25,30 +38,143 @@ class ServerUtilsTestSuite(unittest.TestCase):
         assert mock_get_nodes.called
         assert node in self.nodes
 
-    def test_that_apps_are_fetch_from_redis(self):
-        redis_apps = ['1', '2']
-
+    @patch('src.utils.cluster_state', ClusterState('spread'))
+    @patch('src.utils.get_session')
+    def test_claim_warm_replicas_from_the_nodes_that_have_them(
+            self, mock_get_session):
+        from src.utils import cluster_state
+        cluster_state.update(self.nodes[0], {'warm': {'git_nginx': 3}})
+        cluster_state.update(self.nodes[1], {'warm': {'git_apache': 3}})
+        session = mock_get_session.return_value
+        session.get.return_value = Mock(
+            status_code=200, content=json.dumps([{'id': 'a', 'port': 4567}]))
+
+        backends = claim_warm_replicas({'user': 'git', 'repo': 'apache'}, 1)
+
+        assert backends == [(self.nodes[1], 4567)]
+        mock_get_session.assert_called_once_with(self.nodes[1])
+        assert session.get.call_args[1]['params']['count'] == 1
+        assert session.get.call_args[1]['params']['action'] == 'claim'
+
+    @patch('src.utils.cluster_state', ClusterState('spread'))
+    @patch('src.utils.get_nodes')
+    def test_that_nodes_are_picked_from_the_cluster_state(
+            self, mock_get_nodes):
+        from src.utils import cluster_state
+        cluster_state.update(self.nodes[1], {'cpus': 1, 'load': 0})
+        node = pick_up_node('git_apache')
+
+        assert node == self.nodes[1]
+        assert not mock_get_nodes.called
+
+    @patch('src.utils.cluster_state', ClusterState('spread'))
+    @patch('src.utils.deploy_container')
+    def test_replicas_without_room_in_any_node_are_not_deployed(
+            self, mock_deploy_container):
+        from src.utils import cluster_state
+        cluster_state.update(self.nodes[1], {'memory_allocatable': 100,
+                                             'memory_allocated': 90})
+        conf = {'user': 'git', 'repo': 'apache', 'multiplicator': 1,
+                'resources': {'memory': 20}}
+
+        deployed = deploy_replicas(conf)
+
+        assert deployed[0][0] is None
+        assert deployed[0][1][1] == 503
+        assert not mock_deploy_container.called
+
+    @patch('src.utils.cluster_state', ClusterState('spread'))
+    @patch('src.utils.live_nodes')
+    def test_refresh_cluster_state_leaves_dead_nodes_out(
+            self, mock_live_nodes):
+        from src.utils import cluster_state
         redis_cli = Mock()
-        redis_cli.scan_iter.return_value = redis_apps
-        redis_cli.lrange.return_value = True
-        apps = fetch_apps(redis_cli)
+        cluster_state.update(self.nodes[1], {'cpus': 1, 'load': 0})
+        report = {'cpus': 2, 'load': 1}
+        mock_live_nodes.return_value = {self.nodes[0]: report}
 
-        assert len(apps) == 2
-        for a in redis_apps:
-            assert apps[a] is True
+        refresh_cluster_state(redis_cli)
 
-    @patch('src.utils.requests.get')
-    def test_that_containers_are_being_contacted(self, mock_requests):
+        mock_live_nodes.assert_called_once_with(redis_cli)
+        assert cluster_state.reports() == {self.nodes[0]: report}
+
+    @patch('src.utils.cluster_state', ClusterState('spread'))
+    @patch('src.utils.get_static_nodes')
+    def test_live_nodes_are_preferred_over_the_nodes_file(
+            self, mock_get_static_nodes):
+        from src.utils import cluster_state
+        mock_get_static_nodes.return_value = self.nodes
+        assert get_nodes() == self.nodes
+
+        cluster_state.update(self.nodes[1], {})
+        assert get_nodes() == [self.nodes[1]]
+
+    @patch('src.utils.cluster_state', ClusterState('spread'))
+    @patch('src.utils.contact_containers')
+    @patch('src.utils.get_nodes')
+    def test_unreachable_nodes_are_dropped_from_the_cluster_state(
+            self, mock_get_nodes, mock_contact_containers):
+        from src.utils import cluster_state
+        cluster_state.update(self.nodes[0], {})
+        mock_get_nodes.return_value = [self.nodes[0]]
+        mock_contact_containers.side_effect = \
+            requests.exceptions.ConnectionError()
+
+        contact_nodes({'action': 'get', 'user': 'git', 'repo': 'apache'})
+
+        assert cluster_state.nodes() == []
+
+    @patch('src.utils.cluster_state', ClusterState('spread'))
+    @patch('src.utils.contact_containers')
+    @patch('src.utils.get_nodes')
+    def test_busy_nodes_are_kept_in_the_cluster_state(
+            self, mock_get_nodes, mock_contact_containers):
+        from src.utils import cluster_state
+        cluster_state.update(self.nodes[0], {})
+        cluster_state.update(self.nodes[1], {})
+        mock_get_nodes.return_value = self.nodes
+        def contact(action, node, user, repo):
+            if node == self.nodes[1]:
+                raise requests.exceptions.ReadTimeout()
+            return Mock(status_code=503, content='The node is busy')
+        mock_contact_containers.side_effect = contact
+
+        nodes = contact_nodes(
+            {'action': 'get', 'user': 'git', 'repo': 'apache'})
+
+        assert nodes[self.nodes[0]] == ('The node is busy', 503)
+        assert nodes[self.nodes[1]][1] == 503
+        assert sorted(cluster_state.nodes()) == sorted(self.nodes)
+
+    @patch('src.utils.get_session')
+    def test_that_containers_are_being_contacted(self, mock_get_session):
         action = 'stop'
         node = 'http://0.0.0.0'
         user = 'git'
         repo = 'apache'
 
         contact_containers(action, node, user, repo)
-        assert mock_requests.called
-        mock_requests.assert_called_once_with(
+        mock_get_session.assert_called_once_with(node)
+        mock_get_session.return_value.get.assert_called_once_with(
             '{}:5000/containers?action={}&user={}&repo={}'.format(
-                node, action, user, repo))
+                node, action, user, repo), timeout=NODE_TIMEOUT)
+
+    @patch('src.utils.DEPLOY_TIMEOUT', 600)
+    @patch('src.utils.DEPLOY_DEADLINE_MARGIN', 30)
+    @patch('src.utils.get_session')
+    def test_deploys_tell_the_node_when_the_server_gives_up(
+            self, mock_get_session):
+        deploy_container(self.nodes[0], {'user': 'git', 'repo': 'apache'})
+
+        mock_get_session.return_value.get.assert_called_once_with(
+            '{}:5000'.format(self.nodes[0]),
+            params={'user': 'git', 'repo': 'apache', 'job': None,
+                    'digest': None, 'timeout': 570},
+            timeout=600)
+
+    def test_that_sessions_are_reused_per_node(self):
+        assert get_session(self.nodes[0]) is get_session(self.nodes[0])
+        assert get_session(self.nodes[0]) is not get_session(self.nodes[1])
 
     @patch('src.utils.contact_containers')
     @patch('src.utils.get_nodes')
@@ -112,26 +238,29 @@ class ServerUtilsTestSuite(unittest.TestCase):
         assert mock_get_nodes.called
         assert mock_contact_containers.call_count == len(self.nodes)
 
-    def test_add_app_to_webserver_routing(self):
-        redis_cli = Mock()
+    @patch('src.utils.contact_containers')
+    @patch('src.utils.get_nodes')
+    def test_that_contact_nodes_keeps_partial_results(
+            self, mock_get_nodes, mock_contact_containers):
         conf = {
-            'repo': 'apache',
-            'application_address': 'git.apache.example.com'
+            'action': 'get',
+            'user': 'git',
+            'repo': 'apache'
         }
-        add_app_to_webserver_routing(redis_cli, conf)
-
-        redis_cli.rpush.assert_called_once_with('frontend:{}'.format(
-            conf.get('application_address')), conf.get('repo'))
 
-    def test_remove_app_from_webserver_routing(self):
-        redis_cli = Mock()
-        conf = {
-            'application_address': 'git.apache.example.com'
-        }
-        remove_app_from_webserver_routing(redis_cli, conf)
+        def side_effect(action, node, user, repo):
+            if node == self.nodes[1]:
+                raise requests.exceptions.Timeout('Node timed out')
+            mock = Mock()
+            mock.status_code = 200
+            mock.content = json.dumps([])
+            return mock
+        mock_get_nodes.return_value = self.nodes
+        mock_contact_containers.side_effect = side_effect
 
-        redis_cli.delete.assert_called_once_with(
-            'frontend:{}'.format(conf.get('application_address')))
+        response = contact_nodes(conf)
+        assert response[self.nodes[0]] == ([], 200)
+        assert response[self.nodes[1]] == ('Node timed out', 503)
 
     def test_exists_application(self):
         redis_cli = Mock()
@@ -145,18 +274,103 @@ class ServerUtilsTestSuite(unittest.TestCase):
         redis_cli.lrange.assert_called_once_with(
             'frontend:{}'.format(conf.get('application_address')), 0, -1)
 
-    def test_add_container_to_webserver_routing(self):
+    @patch('src.utils.deploy_container')
+    @patch('src.utils.pick_up_node')
+    def test_deploy_replicas_keeps_going_when_one_fails(
+            self, mock_pick_up_node, mock_deploy_container):
+        conf = {
+            'user': 'git',
+            'repo': 'apache',
+            'multiplicator': 3
+        }
+        responses = iter([(200, json.dumps({'port': 4567})),
+                          (400, 'Node unreachable'),
+                          (200, json.dumps({'port': 4568}))])
+
+        def side_effect(node, conf):
+            mock = Mock()
+            mock.status_code, mock.content = next(responses)
+            return mock
+        mock_pick_up_node.return_value = self.nodes[0]
+        mock_deploy_container.side_effect = side_effect
+
+        deployed = deploy_replicas(conf)
+
+        assert len(deployed) == 3
+        assert mock_pick_up_node.call_count == 3
+        statuses = sorted(response[1] for node, response in deployed)
+        assert statuses == [200, 200, 400]
+
+    def test_get_app_backends(self):
         redis_cli = Mock()
+        redis_cli.lrange.return_value = ['http://0.0.0.0:4567']
         conf = {
             'application_address': 'git.apache.example.com'
         }
-        node = self.nodes[0]
-        port = 4678
-        add_container_to_webserver_routing(redis_cli, node, port, conf)
+        backends = get_app_backends(redis_cli, conf)
+
+        assert backends == [('http://0.0.0.0', 4567)]
+        redis_cli.lrange.assert_called_once_with(
+            'frontend:{}'.format(conf.get('application_address')), 1, -1)
+
+    @patch('src.utils.HEALTH_CHECK_TIMEOUT', 0)
+    @patch('src.utils.requests.get')
+    def test_check_backend_health(self, mock_get):
+        mock_get.return_value.status_code = 404
+        assert check_backend_health((self.nodes[0], 4567)) is True
+
+        mock_get.return_value.status_code = 502
+        assert check_backend_health((self.nodes[0], 4567)) is False
+
+        mock_get.side_effect = requests.exceptions.ConnectionError()
+        assert check_backend_health((self.nodes[0], 4567)) is False
+
+    @patch('src.utils.check_backend_health')
+    def test_health_checks_do_not_use_the_fanout_threads(self, mock_check):
+        release = threading.Event()
+        mock_check.side_effect = lambda backend: release.wait(1) or True
+        checking = threading.Thread(
+            target=check_backends_health, args=([(self.nodes[0], 4567)],))
+        checking.start()
+
+        # The fan-outs don't wait for the health check to finish.
+        assert get_fanout_pool().apply_async(lambda: 1).get(1) == 1
+        assert get_health_check_pool() is not get_fanout_pool()
+        release.set()
+        checking.join()
+
+    @patch('src.utils.contact_containers')
+    def test_stop_backends_groups_ports_by_node(self, mock_contact_containers):
+        conf = {
+            'user': 'git',
+            'repo': 'apache'
+        }
+        stop_backends([(self.nodes[0], 4567), (self.nodes[0], 4568)], conf)
 
-        redis_cli.rpush.assert_called_once_with(
-            'frontend:{}'.format(
-                conf.get('application_address')), '{}:{}'.format(node, port))
+        mock_contact_containers.assert_called_once_with(
+            'stop', self.nodes[0], 'git', 'apache', [4567, 4568])
+
+    @patch('src.utils.REGISTRY', 'localhost:5001')
+    @patch('src.utils._deploy_replica')
+    def test_deploy_replicas_builds_once_when_there_is_a_registry(
+            self, mock_deploy_replica):
+        conf = {
+            'user': 'git',
+            'repo': 'apache',
+            'multiplicator': 3
+        }
+        calls = []
+
+        def side_effect(conf):
+            calls.append(threading.current_thread())
+            return self.nodes[0], ({'port': 4567}, 200)
+        mock_deploy_replica.side_effect = side_effect
+
+        deployed = deploy_replicas(conf)
+
+        assert len(deployed) == 3
+        # The first replica is deployed by the caller, before the pool.
+        assert calls[0] is threading.current_thread()
 
     def test_was_applied_when_zero_nodes_were_affected(self):
         content = {
@@ -185,3 +399,9 @@ class ServerUtilsTestSuite(unittest.TestCase):
         response = was_applied(response_nodes)
 
         assert response is True
+
+    def test_stopped_everywhere_unless_a_node_did_not_answer(self):
+        assert stopped_everywhere({self.nodes[0]: ([], 200),
+                                   self.nodes[1]: ('Not running', 400)})
+        assert not stopped_everywhere({self.nodes[0]: ([], 200),
+                                       self.nodes[1]: ('Timeout', 503)})
@@ -1,77 +1,420 @@
 import random
 import os
 import json
+import time
+import logging
+import threading
+import redis
 import requests
 
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
+from src.scheduler import ClusterState
+from src.registry import NODES_KEY, live_nodes, node_report
+from src.metrics import span, app_label
+from src.routing import evicted_key
+
+logger = logging.getLogger(__name__)
+
 dir = os.path.dirname(__file__)
 
+# Seconds to wait for a node before giving up on it.
+NODE_TIMEOUT = float(os.environ.get('DOOKIO_NODE_TIMEOUT', 30))
+# Keep-alive connections kept open per node.
+NODE_POOL_SIZE = int(os.environ.get('DOOKIO_NODE_POOL_SIZE', 10))
+# Threads used for contacting the nodes concurrently.
+FANOUT_WORKERS = int(os.environ.get('DOOKIO_FANOUT_WORKERS', 20))
+# Replicas being built/started at the same time during a deploy.
+DEPLOY_CONCURRENCY = int(os.environ.get('DOOKIO_DEPLOY_CONCURRENCY', 5))
+# When the nodes share their images through a registry, the first replica
+# is deployed alone so the image is only built once.
+REGISTRY = os.environ.get('DOOKIO_REGISTRY')
+# Seconds to wait for a node to build and start a replica.
+DEPLOY_TIMEOUT = float(os.environ.get('DOOKIO_DEPLOY_TIMEOUT', 600))
+# The nodes give up on a replica this many seconds before the server stops
+# waiting for it, so a late container is stopped by its node instead of
+# being left running without a route.
+DEPLOY_DEADLINE_MARGIN = float(
+    os.environ.get('DOOKIO_DEPLOY_DEADLINE_MARGIN', 30))
+# Seconds a new container has to start answering HTTP requests.
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('DOOKIO_HEALTH_CHECK_TIMEOUT', 30))
+HEALTH_CHECK_INTERVAL = float(
+    os.environ.get('DOOKIO_HEALTH_CHECK_INTERVAL', 1))
+# Threads used for health checking new containers (apart from the fan-out
+# ones, as every check can take up to HEALTH_CHECK_TIMEOUT).
+HEALTH_CHECK_WORKERS = int(os.environ.get('DOOKIO_HEALTH_CHECK_WORKERS', 20))
+# Seconds old containers keep running after being removed from routing.
+DRAIN_SECONDS = float(os.environ.get('DOOKIO_DRAIN_SECONDS', 10))
+
+# Placement strategy: least_loaded, spread or binpack.
+SCHEDULER = os.environ.get('DOOKIO_SCHEDULER', 'spread')
+# Seconds between two sweeps of the node registry.
+CAPACITY_INTERVAL = float(os.environ.get('DOOKIO_CAPACITY_INTERVAL', 5))
+
+cluster_state = ClusterState(SCHEDULER)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+_static_nodes = None
+
+
+def get_static_nodes():
+    """
+    Get the nodes listed in the NODES file (read only once).
+    """
+    global _static_nodes
+    if _static_nodes is None:
+        with open(os.path.join(dir, 'NODES')) as f:
+            _static_nodes = [line.rstrip() for line in f if line.strip()]
+    return _static_nodes
+
+
 def get_nodes():
     """
-    Get all the available nodes.
+    Get all the available nodes: the ones sending heartbeats or, until
+    the first heartbeat arrives, the ones in the NODES file.
     """
-    with open(os.path.join(dir, 'NODES')) as f:
-        nodes = [line.rstrip() for line in f]
-    return nodes
+    return cluster_state.nodes() or get_static_nodes()
 
 
-def pick_up_node():
+def pick_up_node(app=None, resources=None):
     """
-    Pick a random node.
+    Pick a node for a new container of the (user_repo) application using
+    the capacity reports of the nodes. Until the first reports arrive a
+    random node is picked. None if no node has room for its `resources`.
     """
+    node = cluster_state.place(app, resources)
+    if node is not None:
+        return node
+    if resources and cluster_state.nodes():
+        return None
     nodes = get_nodes()
     idx = random.randint(0, len(nodes) - 1)
     return nodes[idx]
 
 
-def fetch_apps(redis_cli):
+def refresh_cluster_state(redis_cli):
     """
-    Fetch all the deployed applications.
+    Sync the cluster state with the node registry. Nodes whose heartbeat
+    expired are left out of the fan-outs and placement decisions.
     """
-    apps = {}
-    for app in redis_cli.scan_iter():
-        apps[app] = redis_cli.lrange(app, 1, -1)
-    return apps
+    nodes = live_nodes(redis_cli)
+    for node in cluster_state.nodes():
+        if node not in nodes:
+            cluster_state.remove(node)
+    for node, report in nodes.iteritems():
+        cluster_state.update(node, report)
+
+
+def follow_heartbeats(redis_cli):
+    """
+    Update the cluster state as soon as a node sends a heartbeat.
+    """
+    pubsub = redis_cli.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(NODES_KEY)
+    for message in pubsub.listen():
+        node = message.get('data')
+        report = node_report(redis_cli, node)
+        if report is not None:
+            cluster_state.update(node, report)
+
+
+def start_cluster_monitor():
+    """
+    Keep the cluster state up to date from background threads: one pushed
+    by the heartbeats of the nodes and one sweeping the expired ones.
+    """
+    redis_cli = redis.StrictRedis(host='localhost', port=6379, db=0)
+
+    def sweep():
+        while True:
+            try:
+                refresh_cluster_state(redis_cli)
+            except Exception:
+                logger.exception('The cluster state could not be refreshed')
+            time.sleep(CAPACITY_INTERVAL)
+
+    def follow():
+        while True:
+            try:
+                follow_heartbeats(redis_cli)
+            except Exception:
+                logger.exception('Lost the node heartbeats')
+            time.sleep(CAPACITY_INTERVAL)
+
+    threads = [threading.Thread(target=sweep), threading.Thread(target=follow)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads
+
+
+def get_session(node):
+    """
+    Get the keep-alive session used for talking with a certain node.
+    """
+    with _sessions_lock:
+        session = _sessions.get(node)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=NODE_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[node] = session
+    return session
+
+
+def get_thread_pool(name, size):
+    """
+    Get the thread pool shared by all the tasks of a kind (created with
+    `size` threads the first time).
+    """
+    with _thread_pools_lock:
+        if name not in _thread_pools:
+            _thread_pools[name] = ThreadPool(size)
+        return _thread_pools[name]
+
+
+def get_fanout_pool():
+    """
+    Get the thread pool shared by all the node fan-outs.
+    """
+    return get_thread_pool('fanout', FANOUT_WORKERS)
+
+
+def get_health_check_pool():
+    """
+    Get the thread pool shared by all the health checks of new containers.
+    """
+    return get_thread_pool('health_check', HEALTH_CHECK_WORKERS)
+
+
+def _contact_node(args):
+    """
+    Apply an action in a single node. Unreachable nodes are reported
+    with a 503 instead of aborting the whole fan-out. Returns the node,
+    its response and whether it could be connected to.
+    """
+    node, action, user, repo = args
+    try:
+        with span('contact_node', '{}/{}'.format(user, repo), node):
+            response = contact_containers(action, node, user, repo)
+    except requests.exceptions.ConnectionError, e:
+        return node, (str(e), 503), False
+    except requests.exceptions.RequestException, e:
+        # e.g. a timeout: the node is there, but busy.
+        return node, (str(e), 503), True
+    if response.status_code == 200:
+        return node, (json.loads(response.content), 200), True
+    return node, (response.content, response.status_code), True
 
 
 def contact_nodes(conf):
     """
-    Contact all nodes in order to apply actions.
+    Contact all nodes (concurrently) in order to apply actions.
     """
     user = conf.get('user')
     repo = conf.get('repo')
     action = conf.get('action')
 
-    nodes = {}
-    for node in get_nodes():
-        response = contact_containers(action, node, user, repo)
-        if response.status_code == 200:
-            clean_content = json.loads(response.content)
-            nodes[node] = (clean_content, 200)
-        else:
-            nodes[node] = (response.content, response.status_code)
-    return nodes
+    tasks = [(node, action, user, repo) for node in get_nodes()]
+    with span('fanout', app_label(conf)):
+        results = get_fanout_pool().map(_contact_node, tasks)
+    for node, response, connected in results:
+        if not connected:
+            # Don't wait for its heartbeat to expire. Nodes that answer
+            # (even with an error) are only dropped by their heartbeat.
+            cluster_state.remove(node)
+    return dict((node, response) for node, response, connected in results)
 
 
-def contact_containers(action, node, user, repo):
+def contact_containers(action, node, user, repo, ports=None):
     """
     Contact with the different containers spread in a certain node.
+    The action can be limited to the containers published on 'ports'.
     """
-    response = requests.get(
-        '{}:5000/containers?action={}&user={}&repo={}'.format(
-            node, action, user, repo))
+    url = '{}:5000/containers?action={}&user={}&repo={}'.format(
+        node, action, user, repo)
+    if ports:
+        url = '{}&ports={}'.format(url, ','.join(str(p) for p in ports))
+    response = get_session(node).get(url, timeout=NODE_TIMEOUT)
     return response
 
 
-def add_app_to_webserver_routing(redis_cli, conf):
-    repo = conf.get('repo')
+def claim_warm_replicas(conf, count, digest=None):
+    """
+    Claim up to `count` warm containers of the application (of the image
+    of `digest`, if given) from the nodes that report some. Returns their
+    (node, port) backends.
+    """
+    app = '{}_{}'.format(conf.get('user'), conf.get('repo'))
+    backends = []
+    for node, report in sorted(cluster_state.reports().iteritems()):
+        warm = report.get('warm', {}).get(app, 0)
+        if not warm or len(backends) >= count:
+            continue
+        try:
+            with span('claim_warm', app_label(conf), node):
+                response = get_session(node).get(
+                    '{}:5000/containers'.format(node),
+                    params={'action': 'claim', 'user': conf.get('user'),
+                            'repo': conf.get('repo'), 'digest': digest,
+                            'count': min(warm, count - len(backends))},
+                    timeout=NODE_TIMEOUT)
+        except requests.exceptions.RequestException:
+            continue
+        if response.status_code == 200:
+            backends.extend((node, int(container.get('port')))
+                            for container in json.loads(response.content))
+    return backends
+
+
+def check_backend_health(backend):
+    """
+    Wait until a (node, port) backend answers HTTP requests without a
+    server error, or HEALTH_CHECK_TIMEOUT expires.
+    """
+    node, port = backend
+    with span('health_check', node=node):
+        return _wait_until_healthy(node, port)
+
+
+def _wait_until_healthy(node, port):
+    deadline = time.time() + HEALTH_CHECK_TIMEOUT
+    while True:
+        try:
+            response = requests.get('{}:{}'.format(node, port),
+                                    timeout=HEALTH_CHECK_INTERVAL)
+            if response.status_code < 500:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        if time.time() >= deadline:
+            return False
+        time.sleep(HEALTH_CHECK_INTERVAL)
+
+
+def check_backends_health(backends):
+    """
+    Health check several backends concurrently and return the healthy ones.
+    """
+    results = get_health_check_pool().map(check_backend_health, backends)
+    return [backend for backend, healthy in zip(backends, results)
+            if healthy]
+
+
+def stop_backends(backends, conf):
+    """
+    Stop the containers behind the given (node, port) backends.
+    """
+    ports_by_node = {}
+    for node, port in backends:
+        ports_by_node.setdefault(node, []).append(port)
+    for node, ports in ports_by_node.iteritems():
+        try:
+            contact_containers('stop', node, conf.get('user'),
+                               conf.get('repo'), ports)
+        except requests.exceptions.RequestException:
+            # The node is gone, and so are its containers.
+            pass
+
+
+def drain_backends(backends, conf):
+    """
+    Stop the given backends once DRAIN_SECONDS have passed, so the
+    requests they are serving can finish.
+    """
+    if not backends:
+        return
+    timer = threading.Timer(DRAIN_SECONDS, stop_backends, (backends, conf))
+    timer.daemon = True
+    timer.start()
+
+
+def deploy_container(node, conf):
+    """
+    Ask a node to build and start a new container for the application
+    within the time the server waits for it.
+    """
+    response = get_session(node).get(
+        '{}:5000'.format(node),
+        params={'user': conf.get('user'), 'repo': conf.get('repo'),
+                'job': conf.get('job'), 'digest': conf.get('digest'),
+                'timeout': max(DEPLOY_TIMEOUT - DEPLOY_DEADLINE_MARGIN, 1)},
+        timeout=DEPLOY_TIMEOUT)
+    return response
+
+
+def _deploy_replica(conf):
+    """
+    Place and launch a single replica. Failures are returned (not raised)
+    so the rest of the replicas can go on.
+    """
+    node = pick_up_node('{}_{}'.format(conf.get('user'), conf.get('repo')),
+                        conf.get('resources'))
+    if node is None:
+        return node, ('No node has room for another replica of {}/{}.\n'
+                      .format(conf.get('user'), conf.get('repo')), 503)
+    try:
+        with span('deploy_replica', app_label(conf), node):
+            response = deploy_container(node, conf)
+    except requests.exceptions.RequestException, e:
+        return node, (str(e), 503)
+    if response.status_code == 200:
+        return node, (json.loads(response.content), 200)
+    return node, (response.content, response.status_code)
+
+
+def deploy_replicas(conf):
+    """
+    Deploy `multiplicator` replicas concurrently (at most DEPLOY_CONCURRENCY
+    at the same time) and return a list of (node, (content, status)).
+    """
+    replicas = conf.get('multiplicator')
+    if replicas < 1:
+        return []
+    deployed = []
+    if REGISTRY and replicas > 1:
+        # The rest of the nodes will pull the image built by this one.
+        deployed.append(_deploy_replica(conf))
+        replicas -= 1
+    pool = ThreadPool(min(DEPLOY_CONCURRENCY, replicas))
+    try:
+        return deployed + pool.map(_deploy_replica, [conf] * replicas)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_app_backends(redis_cli, conf):
+    """
+    Get the (node, port) backends currently routed for the application.
+    """
     application_address = conf.get('application_address')
     webserver_application_name = 'frontend:{}'.format(application_address)
-    redis_cli.rpush(webserver_application_name, repo)
+    return [parse_backend(backend) for backend in
+            redis_cli.lrange(webserver_application_name, 1, -1)]
 
 
-def remove_app_from_webserver_routing(redis_cli, conf):
-    application_address = conf.get('application_address')
-    redis_cli.delete('frontend:{}'.format(application_address))
+def get_evicted_backends(redis_cli, conf):
+    """
+    Get the (node, port) backends of the application evicted by the health
+    monitor.
+    """
+    return [parse_backend(backend)
+            for backend in redis_cli.hkeys(evicted_key(conf))]
+
+
+def parse_backend(backend):
+    """
+    The (node, port) of a "node:port" backend.
+    """
+    node, port = backend.rsplit(':', 1)
+    return node, int(port)
 
 
 def exist_application(redis_cli, conf):
@@ -80,13 +423,6 @@ def exist_application(redis_cli, conf):
     return bool(redis_cli.lrange(webserver_application_name, 0, -1))
 
 
-def add_container_to_webserver_routing(redis_cli, node, port, conf):
-    application_address = conf.get('application_address')
-    webserver_application_name = 'frontend:{}'.format(
-        application_address)
-    redis_cli.rpush(webserver_application_name, '{}:{}'.format(node, port))
-
-
 def was_applied(response_nodes):
     """
     Was applied in at least one node?
@@ -96,3 +432,12 @@ def was_applied(response_nodes):
         if status_code == 200:
             return True
     return False
+
+
+def stopped_everywhere(response_nodes):
+    """
+    Is the app stopped in every node? (The nodes answer 400 when there was
+    nothing running to stop.)
+    """
+    return all(response[1] in (200, 400)
+               for node_ip, response in response_nodes.iteritems())
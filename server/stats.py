@@ -0,0 +1,78 @@
+"""
+Report the requests, throughput, 5xx rate and latency percentiles of every
+app and backend in the Hipache access log. With --state, only the requests
+logged since the last run are read (and added to the ones in the file).
+"""
+import os
+import sys
+import json
+import argparse
+
+from src.accesslog import ACCESS_LOG, LogTailer
+from src.analytics import AccessStats
+
+COLUMNS = ('requests', 'rps', 'error_rate', 'p50', 'p95', 'p99')
+
+
+def load(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return AccessStats.from_dict(json.load(f))
+    return AccessStats()
+
+
+def save(path, stats):
+    aux_path = '{}.aux'.format(path)
+    with open(aux_path, 'w') as f:
+        json.dump(stats.to_dict(), f)
+    os.rename(aux_path, path)
+
+
+def table(title, summaries, sort, limit):
+    lines = ['{:<40} {:>9} {:>9} {:>7} {:>9} {:>9} {:>9}'.format(
+        title, 'requests', 'req/s', '5xx', 'p50 ms', 'p95 ms', 'p99 ms')]
+    rows = sorted(summaries.iteritems(), key=lambda item: item[1][sort],
+                  reverse=True)
+    for name, summary in rows[:limit]:
+        latencies = ['{:>9.1f}'.format(summary[q] * 1000)
+                     if summary[q] is not None else '{:>9}'.format('-')
+                     for q in ('p50', 'p95', 'p99')]
+        lines.append('{:<40} {:>9} {:>9.2f} {:>6.1%} {}'.format(
+            name[:40], summary['requests'], summary['rps'],
+            summary['error_rate'], ' '.join(latencies)))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--log', default=ACCESS_LOG)
+    parser.add_argument('--state',
+                        help='file with the stats of the previous runs')
+    parser.add_argument('--sort', default='p99', choices=COLUMNS)
+    parser.add_argument('--limit', type=int, default=20,
+                        help='rows per table')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args()
+
+    stats = load(args.state)
+    tailer = LogTailer(args.log, stats.position)
+    while stats.update(tailer):
+        pass
+    tailer.close()
+    if args.state:
+        save(args.state, stats)
+
+    report = stats.report()
+    if args.json:
+        print json.dumps(report)
+        return 0
+    print table('app', report['apps'], args.sort, args.limit)
+    if report['backends']:
+        print
+        print table('backend', report['backends'], args.sort, args.limit)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,26 @@
+import json
+
+# Node registry: sorted set of node -> expiration of its last heartbeat
+# (nodes also announce every heartbeat in the channel of the same name),
+# plus the capacity report sent with the last heartbeat of every node.
+NODES_KEY = 'dookio:nodes'
+NODE_KEY = 'dookio:node:{}'
+# Output of a job, one line per item (the nodes append the output of their
+# builds).
+JOB_LOG_KEY = 'dookio:job:{}:log'
+# Hash of user/repo -> warm containers every node keeps of the app.
+WARM_POOL_KEY = 'dookio:warm_pool'
+# Hash of user/repo -> resource profile of the app (JSON): the memory limit
+# (bytes) and CPU shares of each of its containers.
+RESOURCES_KEY = 'dookio:resources'
+
+
+def get_resources(redis_cli, conf):
+    """
+    The resource profile of the application ({} if it has no limits).
+    """
+    profile = redis_cli.hget(RESOURCES_KEY, '{}/{}'.format(
+        conf.get('user'), conf.get('repo')))
+    if profile:
+        return json.loads(profile)
+    return {}
@@ -0,0 +1,63 @@
+import threading
+
+# Upper bounds (in seconds) of the histogram buckets: from port
+# allocations and redis calls up to image builds.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+class Histogram(object):
+    """
+    A Prometheus-style histogram: cumulative bucket counts, sum and count
+    for every combination of label values.
+    """
+    def __init__(self, name, description, labels, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label values -> [bucket counts..., sum, count]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (
+                    len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self):
+        """
+        The histogram in the Prometheus text format.
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((key, list(values))
+                            for key, values in self._series.iteritems())
+        for label_values, values in series:
+            labels = ','.join('{}="{}"'.format(label, _escape(value))
+                              for label, value in zip(self.labels,
+                                                      label_values))
+            prefix = labels + ',' if labels else ''
+            for bound, count in zip(self.buckets, values):
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                    self.name, prefix, bound, count))
+            lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(
+                self.name, prefix, values[-1]))
+            lines.append('{}_sum{{{}}} {}'.format(
+                self.name, labels, repr(values[-2])))
+            lines.append('{}_count{{{}}} {}'.format(
+                self.name, labels, values[-1]))
+        return '\n'.join(lines) + '\n'
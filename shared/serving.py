@@ -0,0 +1,176 @@
+import os
+import logging
+import signal
+import thread
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+# Threads answering requests at the same time.
+WORKERS = int(os.environ.get('DOOKIO_WORKERS', 16))
+# Seconds given to the in-flight requests to finish when stopping.
+SHUTDOWN_TIMEOUT = float(os.environ.get('DOOKIO_SHUTDOWN_TIMEOUT', 30))
+
+
+class InFlight(object):
+    """
+    WSGI middleware that keeps count of the requests being answered, so
+    stopping the process can wait for them. A request is answered once the
+    server closes its response (streamed responses are still being sent
+    after the application returns).
+    """
+    def __init__(self, application):
+        self.application = application
+        self.count = 0
+        self._condition = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._condition:
+            self.count += 1
+        try:
+            body = self.application(environ, start_response)
+        except:
+            self._finished()
+            raise
+        return ClosingBody(body, self._finished)
+
+    def _finished(self):
+        with self._condition:
+            self.count -= 1
+            self._condition.notify_all()
+
+    def wait(self, timeout):
+        """
+        Wait until no request is being answered (False on timeout).
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+
+class ClosingBody(object):
+    """
+    The body of a response that calls `on_close` (once) when it is closed
+    by the server, after closing the body itself.
+    """
+    def __init__(self, body, on_close):
+        self._body = body
+        self._iterator = iter(body)
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._iterator)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._on_close()
+
+
+def _on_stop_signal(stop, interrupt=False):
+    """
+    Run `stop` from its own thread on SIGTERM/SIGINT (the main thread is
+    busy running the server loop). With `interrupt`, the main thread gets
+    a KeyboardInterrupt once `stop` is done.
+    """
+    stopping = threading.Event()
+    stopped = threading.Event()
+
+    def run_stop():
+        stop()
+        stopped.set()
+        if interrupt:
+            # Delivered to the handler below, in the main thread.
+            thread.interrupt_main()
+
+    def handler(signum, frame):
+        if stopped.is_set():
+            raise KeyboardInterrupt
+        if not stopping.is_set():
+            stopping.set()
+            stopper = threading.Thread(target=run_stop)
+            stopper.daemon = True
+            stopper.start()
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+
+def serve_waitress(create_server, app, host, port):
+    """
+    waitress answers the requests from a pool of WORKERS threads, while
+    idle keep-alive connections wait in its event loop without holding
+    a thread.
+    """
+    server = create_server(app, host=host, port=port, threads=WORKERS)
+
+    def stop():
+        server.accepting = False
+        app.wait(SHUTDOWN_TIMEOUT)
+        # Let the event loop flush the last responses.
+        time.sleep(1)
+
+    _on_stop_signal(stop, interrupt=True)
+    # waitress stops its worker threads on KeyboardInterrupt.
+    server.run()
+
+
+def serve_werkzeug(app, host, port):
+    """
+    Fallback for when waitress is not installed: werkzeug's server with
+    its requests handed to a pool of WORKERS threads.
+    """
+    from werkzeug.serving import BaseWSGIServer
+
+    pool = ThreadPool(WORKERS)
+
+    class PooledWSGIServer(BaseWSGIServer):
+        def process_request(self, request, client_address):
+            pool.apply_async(self._process, (request, client_address))
+
+        def _process(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    server = PooledWSGIServer(host, port, app)
+    _on_stop_signal(server.shutdown)
+    server.serve_forever()
+    app.wait(SHUTDOWN_TIMEOUT)
+    pool.close()
+
+
+def serve(application, host, port):
+    """
+    Serve the application with a bounded number of worker threads. On
+    SIGTERM no more connections are accepted and the in-flight requests
+    get up to SHUTDOWN_TIMEOUT seconds to finish.
+    """
+    app = InFlight(application)
+    try:
+        from waitress.server import create_server
+    except ImportError:
+        logger.warning('waitress is not installed, using the werkzeug '
+                       'server.')
+        serve_werkzeug(app, host, port)
+    else:
+        serve_waitress(create_server, app, host, port)
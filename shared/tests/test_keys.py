@@ -0,0 +1,16 @@
+import unittest
+from mock import Mock
+
+from shared.keys import get_resources
+
+
+class KeysTestSuite(unittest.TestCase):
+    def test_resources_of_an_app(self):
+        redis_cli = Mock(**{'hget.return_value': '{"memory": 512}'})
+        conf = {'user': 'git', 'repo': 'portfolio'}
+
+        assert get_resources(redis_cli, conf) == {'memory': 512}
+        redis_cli.hget.assert_called_once_with('dookio:resources',
+                                               'git/portfolio')
+        redis_cli.hget.return_value = None
+        assert get_resources(redis_cli, conf) == {}
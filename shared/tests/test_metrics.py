@@ -0,0 +1,29 @@
+import unittest
+
+from shared.metrics import Histogram
+
+
+class HistogramTestSuite(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('dookio_test_seconds', 'Test.', ('stage',),
+                              buckets=(0.1, 1))
+        histogram.observe(0.05, 'build')
+        histogram.observe(0.5, 'build')
+        histogram.observe(5, 'build')
+
+        lines = histogram.expose().splitlines()
+        assert lines[:2] == ['# HELP dookio_test_seconds Test.',
+                             '# TYPE dookio_test_seconds histogram']
+        assert lines[2:] == [
+            'dookio_test_seconds_bucket{stage="build",le="0.1"} 1',
+            'dookio_test_seconds_bucket{stage="build",le="1"} 2',
+            'dookio_test_seconds_bucket{stage="build",le="+Inf"} 3',
+            'dookio_test_seconds_sum{stage="build"} 5.55',
+            'dookio_test_seconds_count{stage="build"} 3']
+
+    def test_label_values_are_escaped(self):
+        histogram = Histogram('dookio_test_seconds', 'Test.', ('app',),
+                              buckets=())
+        histogram.observe(1, 'git/"apache"')
+
+        assert 'app="git/\\"apache\\""' in histogram.expose()
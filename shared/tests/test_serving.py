@@ -0,0 +1,69 @@
+import threading
+import time
+import unittest
+
+from shared.serving import InFlight
+
+
+class InFlightTestSuite(unittest.TestCase):
+    def test_counts_the_requests_until_their_response_is_closed(self):
+        counts = []
+
+        def application(environ, start_response):
+            counts.append(app.count)
+            return ['ok']
+        app = InFlight(application)
+
+        body = app(None, None)
+        assert list(body) == ['ok']
+        assert counts == [1]
+        assert app.count == 1
+        body.close()
+        body.close()
+        assert app.count == 0
+
+    def test_counts_streamed_responses_until_they_are_closed(self):
+        closed = []
+
+        def stream():
+            try:
+                yield 'line 1'
+                yield 'line 2'
+            finally:
+                closed.append(True)
+        app = InFlight(lambda environ, start_response: stream())
+
+        body = app(None, None)
+        assert next(body) == 'line 1'
+        assert app.wait(0.01) is False
+        body.close()
+        assert closed == [True]
+        assert app.wait(0.01) is True
+
+    def test_failed_requests_are_not_counted(self):
+        def application(environ, start_response):
+            raise ValueError()
+        app = InFlight(application)
+
+        with self.assertRaises(ValueError):
+            app(None, None)
+        assert app.count == 0
+
+    def test_wait_for_the_requests_being_answered(self):
+        release = threading.Event()
+
+        def application(environ, start_response):
+            release.wait()
+            return ['ok']
+        app = InFlight(application)
+
+        def request():
+            app(None, None).close()
+        thread = threading.Thread(target=request)
+        thread.start()
+        time.sleep(0.05)
+
+        assert app.wait(0.05) is False
+        release.set()
+        assert app.wait(1) is True
+        thread.join()